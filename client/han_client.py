@@ -0,0 +1,248 @@
+"""
+
+Networking for the desktop interface to the home automation nodes
+
+Requests are pickled messages sent over a one-shot TCP connection, the
+same protocol the nodes' serverThread speaks. Node addresses come from
+the discovery directory (server/han_discovery.py) that listens to the
+nodes' announcements, so a connect doesn't wait on a name lookup.
+
+Messages to a group of nodes are sent concurrently from a thread pool, so
+a fence-wide change takes as long as the slowest node rather than the sum
+of all of them.
+
+Nothing here may be called on the Tk thread directly: the Dispatcher runs
+requests on worker threads and hands results back to Tk through a queue
+that the UI drains with root.after(). Queries with the same key share one
+request. Commands that set state, e.g. DISPLAY, go through a channel that
+sends one at a time in the order they were given, and a command still
+waiting is replaced by a newer one, so the last command given is always
+the last one the nodes receive.
+
+"""
+
+import os
+import sys
+import socket
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# discovery and the BUSY reply are shared with the nodes
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+import han_admission
+import han_discovery
+
+HOME_AUTOMATION_PORT = 6445         # The port used by the server
+
+# must match han.py
+SYSTEM_HOSTS = ("magicmirror", "flowmeter", "lidar", "fencepost-back-1", "fencepost-back-2", "fencepost-front-1")
+
+# queries that make up a node's dashboard row, by node type
+NODE_QUERIES = { 'fencepost'   : ("VI_QUERY", "LIGHTING_QUERY"),
+                 'flowmeter'   : ("VI_QUERY", "FLOW_QUERY"),
+                 'magicmirror' : ("METRICS", ),
+                 'lidar'       : ("METRICS", ) }
+
+# named groups of nodes
+GROUPS = { "back"  : ("fencepost-back-1", "fencepost-back-2"),
+           "front" : ("fencepost-front-1", ),
+           "all"   : ("fencepost-back-1", "fencepost-back-2", "fencepost-front-1") }
+
+REQUEST_TIMEOUT = 1.0               # seconds, connect + reply
+FRAME_TIME      = 0.100             # fence-wide changes should land within one frame
+NODE_DEADLINE   = 2.0               # seconds, a fleet refresh waits at most this long
+
+_pool = ThreadPoolExecutor(max_workers=16)
+
+
+def request(host, msg, timeout=REQUEST_TIMEOUT):
+    # send msg to host and return the unpickled reply, None if there is no reply
+    # raises OSError if the node can't be reached, han_admission.Busy if it shed the request
+    try:
+        s = socket.create_connection(han_discovery.resolve(host, HOME_AUTOMATION_PORT), timeout=timeout)
+    except OSError:
+        han_discovery.mark_failed(host)
+        raise
+    han_discovery.mark_ok(host)
+    try:
+        s.sendall(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+        s.shutdown(socket.SHUT_WR) # Tell server message is complete, client still available to read response
+        outb = b''
+        while True:
+            data = s.recv(4096)
+            if not data:
+                break
+            outb += data
+    finally:
+        s.close()
+    reply = pickle.loads(outb) if outb else None
+    if reply == han_admission.BUSY:             # the caller backs off and asks again later
+        raise han_admission.Busy(host)
+    return reply
+
+
+def start_discovery():
+    # listen for node announcements, call once at startup
+    han_discovery.start_listener(HOME_AUTOMATION_PORT)
+
+
+def _timed_request(host, msg, timeout):
+    t0 = time.perf_counter()
+    try:
+        reply = request(host, msg, timeout)
+        return (True, time.perf_counter() - t0, reply)
+    except Exception as e:
+        return (False, time.perf_counter() - t0, e)
+
+
+def send_group(group, msg, timeout=REQUEST_TIMEOUT):
+    # send msg to every node in group (a GROUPS name or a tuple of hosts) in parallel
+    # returns { host : (replied, latency seconds, reply or exception) }
+    hosts = GROUPS[group] if group in GROUPS else tuple(group)
+    futures = { host : _pool.submit(_timed_request, host, msg, timeout) for host in hosts }
+    wait(futures.values())
+    return { host : f.result() for (host, f) in futures.items() }
+
+
+def summarize(results):
+    # one line summary of a send_group result
+    # only an "ACK" reply is an ack, e.g. a node that doesn't handle the message replies None
+    acked = [h for (h, r) in results.items() if r[0] and r[2] == "ACK"]
+    slowest = max((r[1] for r in results.values()), default=0.0)
+    line = "%d/%d acked, slowest %.0f ms" % (len(acked), len(results), 1000 * slowest)
+    failed = [h for h in results if h not in acked]
+    if failed:
+        line += ", no ack from " + ", ".join(failed)
+    if slowest > FRAME_TIME:
+        line += " (over frame time)"
+    return line
+
+
+class Superseded(Exception):
+    # a channel command replaced by a newer one before it was sent
+    pass
+
+
+class Dispatcher:
+    # runs blocking calls off the Tk thread
+    # submit(), submit_latest() and poll() must be called on the Tk thread
+    def __init__(self, workers=4):
+        self._pool     = ThreadPoolExecutor(max_workers=workers)   # separate from the fan-out pool
+        self._results  = queue.Queue()
+        self._inflight = {}     # key -> [callbacks waiting for the result]
+        self._lock     = threading.Lock()
+        self._waiting  = {}     # channel -> (callback, fn, args) of the next command to send
+        self._sending  = set()  # channels with a worker sending their commands
+
+    def submit(self, key, callback, fn, *args):
+        # run fn(*args) on a worker, later call callback(ok, result) on the Tk thread
+        # a call with the same key as one still in flight is not repeated,
+        # the callback just waits for the result of the first one
+        # returns False if the call was deduplicated
+        if key in self._inflight:
+            self._inflight[key].append(callback)
+            return False
+        self._inflight[key] = [callback]
+        self._pool.submit(self._run, key, fn, args)
+        return True
+
+    def submit_latest(self, channel, callback, fn, *args):
+        # run fn(*args) once the channel's earlier commands have run, for commands that set state
+        # a command still waiting to run is replaced, its callback gets (False, Superseded)
+        with self._lock:
+            replaced = self._waiting.get(channel)
+            self._waiting[channel] = (callback, fn, args)
+            if channel not in self._sending:
+                self._sending.add(channel)
+                self._pool.submit(self._run_channel, channel)
+        if replaced is not None:
+            self._results.put((None, replaced[0], (False, Superseded())))
+
+    def _call(self, fn, args):
+        try:
+            return (True, fn(*args))
+        except Exception as e:
+            return (False, e)
+
+    def _run(self, key, fn, args):
+        self._results.put((key, None, self._call(fn, args)))
+
+    def _run_channel(self, channel):
+        # one worker per busy channel, so its commands are sent one at a time, in order
+        while True:
+            with self._lock:
+                job = self._waiting.pop(channel, None)
+                if job is None:
+                    self._sending.discard(channel)
+                    return
+            (callback, fn, args) = job
+            self._results.put((None, callback, self._call(fn, args)))
+
+    def poll(self):
+        # deliver finished results, never blocks
+        while True:
+            try:
+                (key, callback, (ok, result)) = self._results.get_nowait()
+            except queue.Empty:
+                return
+            callbacks = [callback] if callback is not None else self._inflight.pop(key, ())
+            for callback in callbacks:
+                callback(ok, result)
+
+
+def node_type(host):
+    return host.split('-')[0]
+
+
+def scatter_gather(hosts=SYSTEM_HOSTS, deadline=NODE_DEADLINE):
+    # send every node its dashboard queries at once
+    # returns { (host, msg_t) : (ok, reply or exception) }, a query that
+    # didn't answer before the deadline is reported as failed
+    futures = {}
+    for host in hosts:
+        for msg_t in NODE_QUERIES.get(node_type(host), ()):
+            futures[(host, msg_t)] = _pool.submit(request, host, (msg_t, ), deadline)
+    wait(futures.values(), timeout=deadline)
+    results = {}
+    for (key, f) in futures.items():
+        if not f.done():
+            results[key] = (False, TimeoutError("no reply within %.1f s" % deadline))
+        elif f.exception() is not None:
+            results[key] = (False, f.exception())
+        else:
+            results[key] = (True, f.result())
+    return results
+
+
+class FleetCache:
+    # last known value of every query on every node, so a node that is
+    # down still shows what it reported last
+    def __init__(self):
+        self.values  = {}       # (host, msg_t) -> reply
+        self.last_ok = {}       # host -> time.time() of last reply
+        self.up      = {}       # host -> True if it answered the last refresh
+
+    def update(self, results):
+        now = time.time()
+        answered = set()
+        for ((host, msg_t), (ok, reply)) in results.items():
+            if ok:
+                self.values[(host, msg_t)] = reply
+                answered.add(host)
+            self.up.setdefault(host, False)
+        for host in self.up:
+            self.up[host] = host in answered
+            if host in answered:
+                self.last_ok[host] = now
+
+    def get(self, host, msg_t):
+        return self.values.get((host, msg_t))
+
+    def age(self, host):
+        # seconds since host last answered, None if never
+        if host not in self.last_ok:
+            return None
+        return time.time() - self.last_ok[host]
@@ -11,95 +11,116 @@ import tkinter as tk
 import tk_tools
 from   tk_tools.images import rotary_gauge_volt
 
-import socket
-import pickle
+import han_client
 
-FENCEPOST = "fencepost_back_1"
+FENCEPOST = "fencepost-back-1"
 FLOWMETER = "flowmeter"
 
-
-HOME_AUTOMATION_PORT = 6554         # The port used by the server
-
 # Display parameters
 colors      = ["RED","GREEN","BLUE","WHITE","RAINBOW"]
 intensities = ["LOW","MEDIUM","HIGH"]
 patterns    = ["STEADY","STROBE","THROB","MARCH","TWINKLE"]
+groups      = ["all","back","front"]
 
 
-def get_vi():
-    outb = b''
-    msg = ("VI_QUERY", )      # message must be a list
+POLL_INTERVAL = 16     # ms, deliver network results to the UI at ~60 fps
+BUSY_BACKOFF  = 5000   # ms, a node that answered BUSY isn't asked again for this long
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        s.connect((FLOWMETER, HOME_AUTOMATION_PORT))
-    except:
-        print('Connect attempt failed')
+# all networking runs on worker threads, the Tk thread never blocks
+dispatcher = han_client.Dispatcher()
 
-    else:
-        s.sendall(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
-        s.shutdown(socket.SHUT_WR) # Tell server message is complete, client still available to read response
 
-        while True:
-            data = s.recv(1024)
-            if data:
-                outb += data
-            if not data:
-                break
+def poll_results():
+    dispatcher.poll()
+    root.after(POLL_INTERVAL, poll_results)
 
-        (power.volts, power.ma) = pickle.loads(outb)
-        s.close()
 
-        power["text"] = "%.1f V, %.1f mA" % (power.volts, power.ma)
+def get_vi():
+    msg = ("VI_QUERY", )      # message must be a list
+    dispatcher.submit((FLOWMETER, msg), show_vi, han_client.request, FLOWMETER, msg)
 
-    root.after(60*1000, get_vi) # sample every minute
+def show_vi(ok, reply):
+    try:
+        if ok:
+            (power.volts, power.ma) = reply
+            power["text"] = "%.1f V, %.1f mA" % (power.volts, power.ma)
+        elif isinstance(reply, han_client.han_admission.Busy):
+            print('Node busy, VI_QUERY retried later')
+        else:
+            print('Connect attempt failed')
+    except (TypeError, ValueError):
+        print('Unexpected VI_QUERY reply', reply)
+    finally:
+        root.after(60*1000, get_vi) # sample every minute
 
 
 def get_flow():
-    outb = b''
     msg = ("FLOW_QUERY", )      # message must be a list
+    dispatcher.submit((FLOWMETER, msg), show_flow, han_client.request, FLOWMETER, msg)
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def show_flow(ok, reply):
+    delay = 1000
     try:
-        s.connect((FLOWMETER, HOME_AUTOMATION_PORT))
-    except:
-        print('Connect attempt failed')
-
-    else:
-        s.sendall(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
-        s.shutdown(socket.SHUT_WR) # Tell server message is complete, client still available to read response
-
-        meter.gpm = 0.0
-
-        while True:
-            data = s.recv(1024)
-            if data:
-                outb += data
-            if not data:
-                break
-
-        (meter.gpm, totalizer.gal) = pickle.loads(outb)
-        s.close()
-
-        meter.set_value(int(meter.gpm*10)/10)
-        totalizer["text"] = "%.1f gallons" % totalizer.gal
-
-    root.after(1000, get_flow)
+        if ok:
+            (meter.gpm, totalizer.gal, zone) = reply
+            meter.set_value(int(meter.gpm*10)/10)
+            totalizer["text"] = "%.1f gallons" % totalizer.gal
+        elif isinstance(reply, han_client.han_admission.Busy):
+            print('Node busy, FLOW_QUERY retried later')
+            delay = BUSY_BACKOFF
+        else:
+            print('Connect attempt failed')
+    except (TypeError, ValueError):
+        print('Unexpected FLOW_QUERY reply', reply)
+    finally:
+        root.after(delay, get_flow) # next sample a second after this reply, never piles up
+
+
+FLEET_REFRESH = 5000    # ms between fleet dashboard refreshes
+fleet_cache = han_client.FleetCache()
+
+def get_fleet():
+    # one concurrent round to every node, takes as long as the slowest node
+    dispatcher.submit("fleet", show_fleet, han_client.scatter_gather)
+
+def show_fleet(ok, results):
+    if ok:
+        fleet_cache.update(results)
+    for host in han_client.SYSTEM_HOSTS:
+        row = fleet_rows[host]
+        age = fleet_cache.age(host)
+        if fleet_cache.up.get(host):
+            row['status']["text"] = "up"
+        elif age is None:
+            row['status']["text"] = "down"
+        else:
+            row['status']["text"] = "down, %d s ago" % age
+
+        vi = fleet_cache.get(host, "VI_QUERY")
+        row['vi']["text"] = "%.1f V, %.0f mA" % vi if vi else "-"
+        flow = fleet_cache.get(host, "FLOW_QUERY")
+        row['flow']["text"] = "%.1f gpm, %.0f gal" % flow[:2] if flow else "-"
+        row['zone']["text"] = flow[2] if flow else "-"
+        style = fleet_cache.get(host, "LIGHTING_QUERY")
+        row['lighting']["text"] = " ".join(str(x) for x in style[1:]) if style else "-"
+
+    root.after(FLEET_REFRESH, get_fleet)
 
 
 def updateDisplay():
     msg = ("DISPLAY", colors[color_rb.get()], intensities[intensity_rb.get()], patterns[pattern_rb.get()])
-    print (msg)
+    group = groups[group_rb.get()]
+    print (group, msg)
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        s.connect((FLOWMETER, HOME_AUTOMATION_PORT))
-    except:
-        print('Connect attempt failed')
+    # send to every fencepost in the group at once, each node acks
+    # one DISPLAY at a time and the latest wins, so the fence ends on the last style clicked
+    dispatcher.submit_latest("display", show_display, han_client.send_group, group, msg)
 
-    else:
-        s.sendall(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
-        s.close()
+def show_display(ok, results):
+    if ok:
+        print (han_client.summarize(results))
+    elif not isinstance(results, han_client.Superseded):
+        print (results)
 
 
 
@@ -109,7 +130,7 @@ def updateDisplay():
 
 root = tk.Tk()
 root.title("Mitchell Home Automation")
-root.geometry('640x480')
+root.geometry('960x600')
 
 #
 # Set up flowmeter
@@ -162,7 +183,34 @@ for val, pattern in enumerate(patterns):
     tk.Radiobutton(root, text=pattern, padx = 20, variable=pattern_rb, command=updateDisplay, value=val).grid(column=5, row=rb_row, sticky='W')
     rb_row += 1
 
+group_rb = tk.IntVar()
+group_rb.set(0)  # initializing the choice to all fenceposts
+tk.Label(root, text="""FENCEPOSTS""", justify = tk.LEFT, padx = 20).grid(column=6, row=0)
+rb_row = 1
+for val, group in enumerate(groups):
+    tk.Radiobutton(root, text=group, padx = 20, variable=group_rb, command=updateDisplay, value=val).grid(column=6, row=rb_row, sticky='W')
+    rb_row += 1
 
+#
+# Set up fleet dashboard, one row per node
+#
+fleet = tk.Frame(root)
+fleet.grid(column=0, row=8, columnspan=7, sticky='W', pady=20)
+fleet_columns = ("host", "status", "vi", "flow", "zone", "lighting")
+for col, name in enumerate(fleet_columns):
+    tk.Label(fleet, text=name.upper(), padx=10).grid(column=col, row=0, sticky='W')
+fleet_rows = {}
+for r, host in enumerate(han_client.SYSTEM_HOSTS):
+    fleet_rows[host] = { name : tk.Label(fleet, padx=10) for name in fleet_columns }
+    fleet_rows[host]['host']["text"] = host
+    for col, name in enumerate(fleet_columns):
+        fleet_rows[host][name].grid(column=col, row=r+1, sticky='W')
+
+
+han_client.start_discovery()
+
+root.after(0, poll_results)
 root.after(0, get_flow)
 root.after(0, get_vi)
+root.after(0, get_fleet)
 root.mainloop()
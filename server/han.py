@@ -20,27 +20,49 @@ The Flow meter repurposes the LED driver GPIO to interface to the
 reed relay interruptor in the flow sensor. It also monitors the
 control lines to the solenoids and can detect when a zone is active.
 
+Each subsystem is a plugin (see PLUGINS) that is only imported and
+started on the node types that use it. The server starts accepting
+before the plugins load, and the time taken by each startup phase is
+logged and exported as the han_startup_seconds metric.
+
 """
 
+import time
+T_START = time.perf_counter()   # startup timing starts with the imports
+
 import threading
 import queue
-import time
 import os
+import sys
 import socket
-import requests
+import selectors
 import pickle
+import importlib
+import contextlib
 import logging
 import logging.handlers # separate module from logging
-import board
-import busio
-import digitalio
-import adafruit_bus_device.spi_device
 import random
-import fencepost_neopixel_driver as npdrvr
+import han_metrics as hm
+import han_mailbox
+import han_bus
+import han_discovery
+import han_history
+import han_config
+import han_admission
+import han_state
+import array
+
+# hardware drivers and subsystem modules are imported by load_plugin() on
+# the nodes that use them, see PLUGINS
+board = busio = digitalio = adafruit_bus_device = npdrvr = requests = None
+han_vi = han_audio = han_flow_shm = han_flow_analytics = han_checkpoint = multiprocessing = None
 
 SYSTEM_HOSTS = ("magicmirror", "flowmeter", "lidar", "fencepost-back-1", "fencepost-back-2", "fencepost-front-1")
 HOME_AUTOMATION_PORT = 6445
 
+# nodes that light up and sound the alarm when the lidar publishes lidar/detect on the event bus
+DETECT_RESPONDERS = ("fencepost-front-1", )
+
 # log files running as a linux service require an absolute path
 LOG_PATH_BASE = "/home/pi/home_automation/server/logs/"
 MASTER_LOG    = LOG_PATH_BASE + "master_log.txt"      # messages from all loggers
@@ -48,15 +70,25 @@ SERVER_LOG    = LOG_PATH_BASE + "server_log.txt"
 FLOW_LOG      = LOG_PATH_BASE + "flow_log.txt"
 VI_LOG        = LOG_PATH_BASE + "vi_log.txt"
 
-lighting_cmd_q = queue.Queue()          # unbounded, but will empty as soon as a record is added
+SUPERVISE_INTERVAL = 10     # seconds between checks that serverThread is running
+
+# tunables applied at startup and on CONFIG_RELOAD, see han_config
+CONFIG_FILE   = "/home/pi/home_automation/server/han_config.json"
+
+# record hardware inputs and received messages for han_trace to replay, None = off
+# e.g. LOG_PATH_BASE + "trace.bin", record with flowThread.USE_PROCESS off
+TRACE_PATH    = None
+
+lighting_mailbox = han_mailbox.CommandMailbox("lighting")   # latest command per target, bounded by number of targets
 vi_q           = queue.Queue(10000)     # a week's worth of samples at 1 sample/min
 
-g_vi_latest    = (0, 0)                 # global variable containing latest (v, i) sample
-g_vi_lock      = threading.Lock()
+# node state shared between threads, readers never wait for writers, see han_state
+state = han_state.StateRegistry()
+state.define("vi",   tuple, (0, 0))     # latest (v, i) sample
+state.define("flow", tuple, (1, 2))     # latest (gpm, gal) sample
+state.define("zone", str,   "Off")      # currently active (ON) sprinkler zone
 
-g_flow_latest  = (1, 2)                 # global variable containing latest (gpm, gal) sample
-g_active_zone  = "Off"                  # global variable containing currently active (ON) sprinkler zone
-g_flow_lock    = threading.Lock()
+g_flow_record  = None                   # shared memory (gpm, gal, zone) record when flow sampler runs in its own process
 
 # message types and supporting node types
 MSG_TYPES = { 'DISPLAY'      : ('fencepost', ),
@@ -65,7 +97,25 @@ MSG_TYPES = { 'DISPLAY'      : ('fencepost', ),
               'FLOW_QUERY'   : ('flowmeter', ),
               'FLOW_HISTORY' : ('flowmeter', ),
               'PLAY_AUDIO'   : ('fencepost', ),
-              'HEALTH_NOTICE': ('magicmirror', ), }
+              'HEALTH_NOTICE': ('magicmirror', ),
+              'METRICS'      : ('magicmirror', 'flowmeter', 'lidar', 'fencepost'),
+              'LIGHTING_QUERY': ('fencepost', ),
+              'CONFIG_RELOAD': ('magicmirror', 'flowmeter', 'lidar', 'fencepost'), }
+
+# priority class of each message type, see han_admission and serverThread
+MSG_PRIORITY = { 'DISPLAY'       : han_admission.CONTROL,
+                 'PLAY_AUDIO'    : han_admission.CONTROL,
+                 'CONFIG_RELOAD' : han_admission.CONTROL,
+                 'VI_QUERY'      : han_admission.REALTIME,
+                 'FLOW_QUERY'    : han_admission.REALTIME,
+                 'LIGHTING_QUERY': han_admission.REALTIME,
+                 'METRICS'       : han_admission.REALTIME,
+                 'VI_HISTORY'    : han_admission.BULK,
+                 'FLOW_HISTORY'  : han_admission.BULK,
+                 'HEALTH_NOTICE' : han_admission.TELEMETRY, }
+
+# queue depth gauge, updated by producer
+vi_q_depth = hm.gauge("han_queue_depth", queue="vi_q")
 
 class audioThread(threading.Thread):
     #
@@ -96,37 +146,124 @@ class audioThread(threading.Thread):
     # aplay for .wav files
     #   aplay audio/filename.wav
     #
+    # Clips are decoded once into a PCM cache and mixed into a persistent
+    # ALSA stream by han_audio.AudioEngine. PLAY_AUDIO messages are
+    #   (PLAY_AUDIO, CLIP, [VOLUME 0..1], [START TIME])
+    # where START TIME is a time.time() value, so several nodes can start a
+    # clip together.
+    #
+    # play() only queues the clip. A clip that isn't cached yet is decoded on
+    # the decoder thread, so neither serverThread nor the event bus nor the
+    # mixer waits for ffmpeg.
+    #
 
-    SAMPLE_INTERVAL = 10.0     # sample every second
+    AUDIO_PATH   = "/home/pi/home_automation/server/audio/"
+    PRELOAD      = ("intruder_alert.mp3", )      # decoded at startup
+    DETECT_CLIP  = "intruder_alert.mp3"         # played on lidar/detect
+    QUEUE_DEPTH  = 8                            # clips waiting for the decoder, more are dropped
 
     def __init__(self):
         threading.Thread.__init__(self)
         self.daemon = True
+        self.engine = han_audio.AudioEngine(han_audio.AlsaSink())
+        self.requests = queue.Queue(self.QUEUE_DEPTH)
+
+    def play(self, clip, volume=1.0, start_time=None):
+        # clip is a file name in AUDIO_PATH, returns at once
+        try:
+            self.requests.put_nowait((clip, volume, start_time))
+        except queue.Full:
+            server_log.warning("Audio queue full, clip %s dropped", clip)
+
+    def _decoder(self):
+        for clip in self.PRELOAD:
+            try:
+                self.engine.cache.get(self.AUDIO_PATH + clip)
+            except Exception:
+                server_log.warning("Unable to preload audio clip %s", clip)
 
-    def run(self):
-        log.info("audioThread running")
+        while True:
+            (clip, volume, start_time) = self.requests.get()
+            try:
+                self.engine.play(self.AUDIO_PATH + os.path.basename(clip), volume, start_time)
+            except Exception:
+                server_log.warning("Unable to play audio clip %s", clip)
+
+    def _on_event(self, topic, host, payload):
+        # event bus callback, audio/play payload is (CLIP, [VOLUME], [START TIME])
+        if topic == "lidar/detect":
+            self.play(self.DETECT_CLIP)
+        else:
+            self.play(*payload[:3])
 
-        # Set up
+    def run(self):
+        server_log.info("audioThread running")
 
+        bus.subscribe("audio/play", self._on_event)
+        if host_name in DETECT_RESPONDERS:
+            bus.subscribe("lidar/detect", self._on_event)
 
-        while True:
-            os.system("omxplayer -o alsa --no-keys audio/intruder_alert.mp3 > /dev/null 2>&1 &")
-            time.sleep(audioThread.SAMPLE_INTERVAL)
+        threading.Thread(target=self._decoder, name="audioDecoder", daemon=True).start()
+        self.engine.run()   # mix and play forever
 
 
 class viThread(threading.Thread):
+    #
+    #   By default one VIN and one CUR conversion are taken every SAMPLE_INTERVAL.
+    #
+    #   With HIGH_RATE the ADC is sampled at SAMPLE_RATE Hz. Samples are read in
+    #   blocks of BLOCK_SIZE with the SPI bus locked and configured once per block,
+    #   into preallocated buffers of raw ADC codes. Each block is reduced on the node
+    #   (han_vi) to per-minute mean/min/max/RMS, and checked for supply dips and
+    #   overcurrent, capturing PRE_SAMPLES before and POST_SAMPLES after the event.
+    #   Only the reduced values are queued and logged.
+    #
     SAMPLE_INTERVAL = 60    # sample voltage and current once every minute
     READ_VIN = 0xD0
     READ_CUR = 0xF0
+    VIN_SCALE = 33 / 4096       # adc input is Vin/10
+    CUR_SCALE = 1000 / 4096     # adc input is 3.3V @ 1000 mA of current
+
+    HIGH_RATE       = False     # oversample and decimate on the node
+    SAMPLE_RATE     = 500       # Hz, per channel
+    BLOCK_SIZE      = 50        # samples per batched SPI transaction
+    DIP_VOLTS       = 4.60      # vin below this is a brownout event
+    OVERCURRENT_MA  = 900       # current above this is an overcurrent event
+    PRE_SAMPLES     = 250       # samples captured before an event
+    POST_SAMPLES    = 500       # samples captured after an event
 
     def __init__(self):
         threading.Thread.__init__(self)
         self.daemon = True
 
-    def run(self):
-        global g_vi_latest
-        global g_vi_lock
+    def _convert(self, spi, command, result, read_cmd):
+        # one conversion, returns the raw adc code
+        command[0] = read_cmd
+        command[1] = 0x00
+        command[2] = 0x00
+        spi.write_readinto(command, result)
+        return int.from_bytes(result, byteorder='big')>>7 # bits 8-19 are valid
+
+    def _store(self, vin, cur, record):
+        if vi_q.full(): # remove oldest item if queue full
+            try:
+                vi_q.get_nowait()
+            except:
+                pass    # ignore if something else emptied queue first
+
+        try:
+            vi_q.put_nowait((vin, cur))
+        except:
+            server_log.error("Unable to add record to vi_q")
+        vi_q_depth.set(vi_q.qsize())
 
+        # latest sample for VI_QUERY
+        state.set("vi", (vin, cur))
+
+        # add to log file
+        vi_log.info(time.strftime("%m/%d/%Y %H:%M") + record)
+
+    def run(self):
         server_log.info("viThread running")
 
         # Set up SPI communications
@@ -134,48 +271,86 @@ class viThread(threading.Thread):
         comm_port = busio.SPI(board.SCK, MOSI=board.MOSI, MISO=board.MISO)
         device = adafruit_bus_device.spi_device.SPIDevice(comm_port, cs)
 
+        if viThread.HIGH_RATE:
+            self._run_high_rate(device)
+            return
+
         command = bytearray(3)
         result  = bytearray(3)
 
-        while True:
-            with device as spi:
-                command[0] = viThread.READ_VIN
-                command[1] = 0x00
-                command[2] = 0x00
-                spi.write_readinto(command, result)
+        loop_time = hm.histogram("han_loop_seconds", thread="viThread")
 
-            adc_value = int.from_bytes(result, byteorder='big')>>7 # bits 8-19 are valid
-            vin = (33 * adc_value) / 4096     # adc input is Vin/10
+        while True:
+            t_start = time.perf_counter()
 
             with device as spi:
-                command[0] = viThread.READ_CUR
-                command[1] = 0x00
-                command[2] = 0x00
-                spi.write_readinto(command, result)
+                vin = viThread.VIN_SCALE * self._convert(spi, command, result, viThread.READ_VIN)
 
-            adc_value = int.from_bytes(result, byteorder='big')>>7 # bits 8-19 are valid
-            cur = (1000 * adc_value) / 4096      # adc input is 3.3V @ 1000 mA of current
-
-            if vi_q.full(): # remove oldest item if queue full
-                try:
-                    vi_q.get_nowait()
-                except:
-                    pass    # ignore if something else emptied queue first
+            with device as spi:
+                cur = viThread.CUR_SCALE * self._convert(spi, command, result, viThread.READ_CUR)
 
-            try:
-                vi_q.put_nowait((vin, cur))
-            except:
-                server_log.error("Unable to add record to vi_q")
+            self._store(vin, cur, "\t%.1f"%vin+"\t%d"%cur)
 
-            # update global variable with latest sample
-            with g_vi_lock:
-                g_vi_latest = (vin, cur)
+            loop_time.observe(time.perf_counter() - t_start)
+            time.sleep(viThread.SAMPLE_INTERVAL)
 
-            # add to log file
-            record = time.strftime("%m/%d/%Y %H:%M")+"\t%.1f"%vin+"\t%d"%cur
-            vi_log.info(record)
+    def _run_high_rate(self, device):
+        server_log.info("viThread sampling at %d Hz", viThread.SAMPLE_RATE)
 
-            time.sleep(viThread.SAMPLE_INTERVAL)
+        command = bytearray(3)
+        result  = bytearray(3)
+        n       = viThread.BLOCK_SIZE
+        period  = 1.0 / viThread.SAMPLE_RATE
+        vbuf    = array.array('I', bytes(4 * n))    # raw codes, reused for every block
+        ibuf    = array.array('I', bytes(4 * n))
+
+        vin_stats = han_vi.MinuteStats(viThread.VIN_SCALE)
+        cur_stats = han_vi.MinuteStats(viThread.CUR_SCALE)
+        trigger   = han_vi.EventTrigger(int(viThread.DIP_VOLTS / viThread.VIN_SCALE),
+                                        int(viThread.OVERCURRENT_MA / viThread.CUR_SCALE),
+                                        viThread.PRE_SAMPLES, viThread.POST_SAMPLES)
+
+        block_time = hm.histogram("han_loop_seconds", thread="viThread")
+        overruns   = hm.counter("han_vi_sample_overruns_total")
+        events     = hm.counter("han_vi_events_total")
+
+        last_minute = time.localtime().tm_min
+        due = time.monotonic()
+        while True:
+            t0 = due
+            t_start = time.perf_counter()
+            with device as spi:                     # one bus lock/configure per block
+                for k in range(n):
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif delay < -period:
+                        overruns.inc()
+                    vbuf[k] = self._convert(spi, command, result, viThread.READ_VIN)
+                    ibuf[k] = self._convert(spi, command, result, viThread.READ_CUR)
+                    due += period
+            if due < time.monotonic() - period:     # fell behind, don't try to catch up
+                due = time.monotonic()
+
+            vin_stats.add_block(vbuf, n)
+            cur_stats.add_block(ibuf, n)
+            event = trigger.feed(vbuf, ibuf, n, t0, period)
+            if event is not None:
+                events.inc()
+                vi_log.warning("%s event: vin min %.2f V, cur max %.0f mA",
+                               event['cause'],
+                               viThread.VIN_SCALE * min(event['post_v']),
+                               viThread.CUR_SCALE * max(event['post_i']))
+            block_time.observe(time.perf_counter() - t_start)
+
+            minute = time.localtime().tm_min
+            if minute != last_minute:               # report on the minute
+                last_minute = minute
+                (vin, vin_min, vin_max, vin_rms) = vin_stats.report()
+                (cur, cur_min, cur_max, cur_rms) = cur_stats.report()
+                self._store(vin, cur, "\t%.1f"%vin+"\t%d"%cur +
+                            "\t%.2f\t%.2f\t%.2f"%(vin_min, vin_max, vin_rms) +
+                            "\t%d\t%d\t%d"%(cur_min, cur_max, cur_rms))
 
 
 class flowThread(threading.Thread):
@@ -200,6 +375,8 @@ class flowThread(threading.Thread):
     #   and a ceiling of < 0.5 gpm is rounded down to zero.
     #
     #   A logfile records cumulative gallons every minute when water is flowing.
+    #   The totalizer is checkpointed (han_checkpoint) on every pulse and
+    #   restored when the thread starts, so it survives restarts and crashes.
     #   Each record is a line in the file of format <timestamp> cumgal.x gpm.x
     #
     #
@@ -211,55 +388,145 @@ class flowThread(threading.Thread):
     #   The LED is flashed at a proportional rate to water flow, or slowly if
     #   there is no flow.
     #
+    #   Every sample is fed to han_flow_analytics, which detects flow with no
+    #   zone on, zones on at once, and zones running well above or below their
+    #   learned flow. Alerts are published to the mirror as flow/alert events.
+    #
+    #   With USE_PROCESS the sampling loop runs in a dedicated process so it
+    #   doesn't share the GIL with the lighting, server and health threads.
+    #   The process publishes (gpm, gallons, zone) through a shared memory
+    #   record (han_flow_shm) that serverThread reads directly. The thread
+    #   supervises the process and restarts it if it exits.
+    #
 
     SAMPLE_INTERVAL = 0.050     # sample flow pulse every 50 ms
     MIN_FLOW_RATE   = 0.35      # gpm, flow rates below this are rounded to zero
     LEAK_DETECT_DT  = 300       # seconds between pulses indicates possible leak
 
-    # sprinker zones mapped to GPIO
-    ZONE_MAP = { "led"      : board.D27,
-                 "flow_sns" : board.D4,
-                 "pump"     : board.D17,
-                 "zone_1"   : board.D22,
-                 "zone_2"   : board.D23,
-                 "zone_3"   : board.D24,
-                 "zone_4"   : board.D25,
-                 "zone_5"   : board.D5,
-                 "zone_6"   : board.D12,
-                 "zone_7"   : board.D6,
-                 "zone_8"   : board.D13,
-                 "zone_9"   : board.D16,
-                 "zone_10"  : board.D26,
-                 "zone_11"  : board.D20 }
+    USE_PROCESS     = False     # run the sampling loop in its own process
+    RT_PRIORITY     = 0         # SCHED_FIFO priority of the sampling process, 0 = normal scheduling
+    CPU_AFFINITY    = None      # set of cpus for the sampling process, e.g. {3}, None = any
+    CHECKPOINT_PATH = LOG_PATH_BASE + "flow_checkpoint"    # totalizer snapshot and journal, see han_checkpoint
+
+    # sprinker zones mapped to GPIO pin names on board
+    ZONE_MAP = { "led"      : "D27",
+                 "flow_sns" : "D4",
+                 "pump"     : "D17",
+                 "zone_1"   : "D22",
+                 "zone_2"   : "D23",
+                 "zone_3"   : "D24",
+                 "zone_4"   : "D25",
+                 "zone_5"   : "D5",
+                 "zone_6"   : "D12",
+                 "zone_7"   : "D6",
+                 "zone_8"   : "D13",
+                 "zone_9"   : "D16",
+                 "zone_10"  : "D26",
+                 "zone_11"  : "D20" }
+    default_zone_map = ZONE_MAP # opened if a configured ZONE_MAP can't be at startup
+    ZONE_PREFIX = "zone_"       # ZONE_MAP names of the sprinkler zones, the others are the led, flowmeter and pump
+
+    @staticmethod
+    def zone_names(zone_map):
+        return [name for name in zone_map if name.startswith(flowThread.ZONE_PREFIX)]
 
     def __init__(self):
         threading.Thread.__init__(self)
         self.daemon = True
 
     def run(self):
-        global g_flow_latest
-        global g_flow_lock
-        global g_active_zone
+        global g_flow_record
 
         server_log.info("flowThread running")
 
-        # iniitalize gpio, replacing gpio number with pin object
-        for zone in flowThread.ZONE_MAP.keys():
-            io = digitalio.DigitalInOut(flowThread.ZONE_MAP[zone]) # create pin object
-            flowThread.ZONE_MAP[zone] = io # save in dict in place of io number
-            if zone is "led":
-                io.direction = digitalio.Direction.OUTPUT
-            else:
-                io.direction = digitalio.Direction.INPUT
-
-        gallons    = 0.0
+        if flowThread.USE_PROCESS:
+            # the sampler inherits this process's gpio, bus, state and logs, which needs fork
+            try:
+                fork = multiprocessing.get_context("fork")
+            except ValueError:
+                server_log.warning("fork not available, flow sampler runs in flowThread")
+                fork = None
+        if not flowThread.USE_PROCESS or fork is None:
+            self._sample(None)
+            return
+
+        zones = ("Off", ) + tuple(flowThread.zone_names(flowThread.ZONE_MAP))
+        g_flow_record = han_flow_shm.FlowRecord(zones)
+        while True:
+            p = fork.Process(target=_flow_sampler_process, args=(g_flow_record.name, zones), daemon=True)
+            p.start()
+            server_log.info("flow sampler process started, pid %d", p.pid)
+            p.join()
+            server_log.error("flow sampler process exited with code %s, restarting", p.exitcode)
+            time.sleep(1.0)
+
+    def _open_pins(self, zone_map, old_pins):
+        # { zone : pin object } for zone_map's pin names, releasing the old pins first
+        # as the maps may share pins, if a pin can't be opened none are left open
+        for io in old_pins.values():
+            io.deinit()
+        pins = {}
+        try:
+            for zone in zone_map:
+                io = digitalio.DigitalInOut(getattr(board, zone_map[zone])) # create pin object
+                pins[zone] = io
+                if zone == "led":
+                    io.direction = digitalio.Direction.OUTPUT
+                else:
+                    io.direction = digitalio.Direction.INPUT
+        except Exception:
+            for io in pins.values():
+                io.deinit()
+            raise
+        return pins
+
+    def _reopen_pins(self, zone_map, pins):
+        # (zone_map, pins) for flowThread.ZONE_MAP, or zone_map and its pins reopened if the new map can't be opened
+        # on the first pass there is no zone_map yet, and the default map is opened instead
+        new_map = flowThread.ZONE_MAP
+        try:
+            return (new_map, self._open_pins(new_map, pins))
+        except Exception:
+            if zone_map is None:
+                if new_map is flowThread.default_zone_map:
+                    raise                       # nothing to go back to
+                zone_map = flowThread.default_zone_map
+            server_log.exception("ZONE_MAP %s can't be opened, using %s", new_map, zone_map)
+            flowThread.ZONE_MAP = zone_map
+            return (zone_map, self._open_pins(zone_map, {}))
+
+    def _sample(self, shm_record):
+        # sampling loop, shm_record is the shared memory record to publish to, or None
+        # totalizer and zone baselines from the last checkpoint
+        t_restore  = time.perf_counter()
+        checkpoint = han_checkpoint.Checkpoint(flowThread.CHECKPOINT_PATH)
+        (saved, tenths) = checkpoint.restore()  # totalizer in tenths of a gallon, one per pulse
+        analytics  = han_flow_analytics.FlowAnalytics()
+        if saved is not None:
+            analytics.restore(saved['analytics'])
+        gallons    = tenths / 10
+        server_log.info("Totalizer restored to %.1f gallons in %.1f ms", gallons, 1000 * (time.perf_counter() - t_restore))
+
+        zone_map   = None
+        pins       = {}
         igpm       = 0.0
+        last_gpm   = state.value("flow")[0]
         last_state = False
         last_pulse = 0
         last_record_time = 0
+        last_zone  = "Off"
         flowing    = False         # flowmeter activity detected
 
+        loop_time  = hm.histogram("han_loop_seconds", thread="flowThread")
+
         while True:
+            t_start = time.perf_counter()
+
+            # (re)initialize gpio on the first pass and when CONFIG_RELOAD replaces ZONE_MAP
+            if zone_map is not flowThread.ZONE_MAP:
+                (zone_map, pins) = self._reopen_pins(zone_map, pins)
+                zone_names = flowThread.zone_names(zone_map)
+
             # determine instantaneous gpm assuming a pulse has been received
             # this is the ceiling of the current flow rate
             now = time.monotonic()
@@ -277,28 +544,29 @@ class flowThread(threading.Thread):
             #
             # Pulse received, so computed igpm (ceiling) is actual igpm
             #
-            current_state = flowThread.ZONE_MAP["flow_sns"].value  # is pulse line high or low
+            current_state = pins["flow_sns"].value      # is pulse line high or low
             if (not last_state) and current_state:      # on rising edge of pulse
                 flowing = True                          # flowmeter activity detected
-                gallons += 0.1                          # increment totalizer
+                tenths += 1                             # increment totalizer
+                gallons = tenths / 10
+                checkpoint.count(tenths)
                 last_pulse = now                        # save to determine next interval
-                with g_flow_lock: g_flow_latest = (igpm, gallons)
-            else:
-                if g_flow_latest[0] < igpm:    # record lesser of last sample or ceiling
-                    igpm = g_flow_latest[0]
-                with g_flow_lock: g_flow_latest = (igpm, gallons)
+            elif last_gpm < igpm:              # record lesser of last sample or ceiling
+                igpm = last_gpm
+            last_gpm = igpm
+
+            # monitor zone control lines
+            active = [zone for zone in zone_names if pins[zone].value]
+            zone = active[-1] if active else "Off"
+            state.update({ "flow" : (igpm, gallons), "zone" : zone })    # readers see both or neither
 
             # pulse the LED proportionally to the flow rate sensor
             # with the same 60/40 on/off duty cycle
             # flash at 1 Hz if there is no flow
             if flowing:
-                flowThread.ZONE_MAP["led"].value = current_state
+                pins["led"].value = current_state
             else:
-                flowThread.ZONE_MAP["led"].value = int(now) % 2
-
-            # first pulse in a long time
-            if flowing and (dt > flowThread.LEAK_DETECT_DT):
-                server_log.info("Flow startup or Possible Leak")
+                pins["led"].value = int(now) % 2
 
             # log time, flow rate, and zone activation
             last_state = current_state
@@ -306,27 +574,38 @@ class flowThread(threading.Thread):
             if ((now != last_record_time) and flowing):   # record on the minute
                 record = time.strftime("%m/%d/%Y %H:%M")+"\t%.1f"%igpm+"\t%.0f"%gallons+'\n'
                 server_log.debug(record)
-                record = time.strftime("%m/%d/%Y %H:%M")+"\t%.1f"%igpm+"\t%.0f"%gallons+"\t%s"%g_active_zone+'\n'
-                log.debug(record)
-                with open(FLOW_FILE, 'a') as f:
-                    f.write(record)
+                flow_log.info(time.strftime("%m/%d/%Y %H:%M")+"\t%.1f"%igpm+"\t%.0f"%gallons+"\t%s"%zone)
+                bus.publish("flow/update", { 'gpm' : igpm, 'gallons' : gallons, 'zone' : zone })
                 last_record_time = now
                 flowing = False                     # reset flag after logging to start next minute anew
 
-            # monitor zone control lines
-            g_active_zone = "Off"
-            for zone in list(flowThread.ZONE_MAP.keys())[3:]:    # ignore led, flowmeter, and pump
-                if flowThread.ZONE_MAP[zone].value:
-                    if g_active_zone != "Off":
-                        log.warning("More than one zone active. %s, %s", (g_active_zone, zone) )
-                    with g_flow_lock: g_active_zone = zone
+            # leak, overlap and zone flow anomalies, alerts go to the mirror over the event bus
+            for alert in analytics.feed(time.time(), igpm, gallons, active):
+                server_log.warning("Flow alert: %s", alert)
+                bus.publish("flow/alert", alert)
+
+            if zone != last_zone:                   # tell subscribers, e.g. the mirror dashboard
+                bus.publish("flow/zone", { 'gpm' : igpm, 'gallons' : gallons, 'zone' : zone })
+                last_zone = zone
+
+            if shm_record is not None:
+                shm_record.publish(igpm, gallons, zone)
+
+            if checkpoint.due():                    # written by the checkpoint's own thread
+                checkpoint.snapshot(tenths, { 'analytics' : analytics.state() })
 
+            loop_time.observe(time.perf_counter() - t_start)
             time.sleep(flowThread.SAMPLE_INTERVAL)
 
 
+def _flow_sampler_process(record_name, zones):
+    # entry point of the dedicated flow sampling process
+    for error in han_flow_shm.set_realtime(flowThread.RT_PRIORITY, flowThread.CPU_AFFINITY):
+        server_log.warning(error)
+    flowThread()._sample(han_flow_shm.FlowRecord(zones, name=record_name))
+
+
 class fpLightingThread(threading.Thread):
-    STD_COLOR     = { "RED" : npdrvr.COLOR_RED, "GREEN" : npdrvr.COLOR_GREEN, "BLUE" : npdrvr.COLOR_BLUE, "WHITE" : npdrvr.COLOR_WHITE }
-    STD_INTENSITY = { "LOW" : npdrvr.INTENSITY_LOW, "MEDIUM" : npdrvr.INTENSITY_MEDIUM, "HIGH" : npdrvr.INTENSITY_HIGH }
     STROBE_ON_TIME      = 0.010     # 10 mS
     STROBE_INTERVAL     = 1.0       # flash every 1 second
     THROB_INTERVAL      = 4.0       # seconds from dark to set intensity and back to dark
@@ -334,12 +613,17 @@ class fpLightingThread(threading.Thread):
     MARCH_POSTS         = 2         # MARCH patters is 2 posts on, 2 posts off, stepping 1 post per interval
     MARCH_INTERVAL      = 1.0       # post pattern marches every second
     TWINKLE_INTERVAL    = 0.5       # sec
+    OVERRUN_TOLERANCE   = 0.005     # tick later than delay by more than this is an overrun
+    DETECT_STYLE        = ("DISPLAY", "WHITE", "HIGH", "STROBE")     # displayed on lidar/detect
 
     def __init__(self):
         threading.Thread.__init__(self)
         self.daemon = True
         self.light_style = ("DISPLAY", "WHITE", "LOW", "STEADY")
         self.delay = 1.0      # 10 ms
+        # driver constants, the driver is imported with the lighting plugin
+        self.STD_COLOR     = { "RED" : npdrvr.COLOR_RED, "GREEN" : npdrvr.COLOR_GREEN, "BLUE" : npdrvr.COLOR_BLUE, "WHITE" : npdrvr.COLOR_WHITE }
+        self.STD_INTENSITY = { "LOW" : npdrvr.INTENSITY_LOW, "MEDIUM" : npdrvr.INTENSITY_MEDIUM, "HIGH" : npdrvr.INTENSITY_HIGH }
         self.color = npdrvr.COLOR_WHITE
         self.intensity = npdrvr.INTENSITY_LOW
         self.strobe = False     # True = ON (flash), False = OFF
@@ -348,6 +632,22 @@ class fpLightingThread(threading.Thread):
         self.march_on   = True  # True = turn post LEDs on, False = turn post LEDs off
         self.march_step = 0
 
+    @staticmethod
+    def target(msg):
+        # mailbox target of a lighting message, a newer message for the
+        # same target replaces an older one that has not been displayed
+        if msg[0] == "LIGHTING":    # (LIGHTING, FENCEPOST NUMBER, ORIENTATION, ...)
+            return ("post", msg[1], msg[2])
+        return han_mailbox.ALL      # DISPLAY restyles the whole string
+
+    def _on_event(self, topic, host, payload):
+        # event bus callback, lighting/display payload is a DISPLAY or LIGHTING message
+        if topic == "lidar/detect":
+            msg = self.DETECT_STYLE
+        else:
+            msg = tuple(payload)
+        lighting_mailbox.put(fpLightingThread.target(msg), msg)
+
     def _colorLookup(self, color):
         if color in self.STD_COLOR:
             pixel_color = self.STD_COLOR[color]
@@ -363,112 +663,132 @@ class fpLightingThread(threading.Thread):
     def run(self):
         server_log.info("fpLightingThread running")
 
+        bus.subscribe("lighting/display", self._on_event)
+        if host_name in DETECT_RESPONDERS:
+            bus.subscribe("lidar/detect", self._on_event)
+
+        loop_time = hm.histogram("han_loop_seconds", thread="fpLightingThread")
+        lateness  = hm.histogram("han_lighting_tick_late_seconds")
+        overruns  = hm.counter("han_lighting_overruns_total")
+
         # set LED string to default condition
         npdrvr.set_all_pixels(self.color, self.intensity)
+        t_tick = time.perf_counter()
 
         while True:
 
-            # sleep until display needs updating
-            # check for incoming messages, update light_style
+            # sleep until display needs updating or a command arrives
+            # take the pending (already coalesced) commands, update light_style
             # do whatever is needed to display light_style
 
-            time.sleep(self.delay)
-
-            try:
-                msg = lighting_cmd_q.get_nowait()
-                lighting_cmd_q.task_done()
-                self.light_style = msg
-            except:
-                pass
-
-            if self.light_style[0] == "DISPLAY" :       # message type = (DISPLAY, COLOR, INTENSITY, PATTERN)
-
-                # display color is one of (RED, GREEN, BLUE, WHITE, RAINBOW)
-                self.color = self._colorLookup(self.light_style[1])
-
-                # display intensity is one of (LOW, MEDIUM, HIGH)
-                self.intensity = self._intensityLookup(self.light_style[2])
+            msgs = lighting_mailbox.get(timeout=self.delay)
+            t_start = time.perf_counter()
+            if not msgs:
+                # the tick is due self.delay after the previous tick started,
+                # anything later (render time + sleep oversleep) is an overrun
+                late = (t_start - t_tick) - self.delay
+                if late > self.OVERRUN_TOLERANCE:
+                    overruns.inc()
+                lateness.observe(max(late, 0.0))
+                self._render()
+            else:
+                for msg in msgs:
+                    self.light_style = msg
+                    self._render()
+            t_tick = t_start
+
+            loop_time.observe(time.perf_counter() - t_start)
+
+    def _render(self):
+        # display one step of self.light_style and set self.delay until the next step
+        if self.light_style[0] == "DISPLAY" :       # message type = (DISPLAY, COLOR, INTENSITY, PATTERN)
+
+            # display color is one of (RED, GREEN, BLUE, WHITE, RAINBOW)
+            self.color = self._colorLookup(self.light_style[1])
+
+            # display intensity is one of (LOW, MEDIUM, HIGH)
+            self.intensity = self._intensityLookup(self.light_style[2])
+
+            # display pattern is one of (STEADY, STROBE, THROB, MARCH, TWINKLE)
+            if   self.light_style[3] == "STEADY":
+                self.delay = 0.1
+                npdrvr.set_all_pixels(self.color, self.intensity)
+
+            elif self.light_style[3] == "STROBE":
+                if self.strobe:
+                    self.strobe = False
+                    self.intensity = npdrvr.INTENSITY_OFF
+                    self.delay = self.STROBE_INTERVAL
+                else:
+                    self.strobe = True
+                    self.delay = self.STROBE_ON_TIME
+                npdrvr.set_all_pixels(self.color, self.intensity)
+
+            elif self.light_style[3] == "THROB":
+                if self.throb:                              # increasing intensity
+                    self.throb_step += 1
+                    if self.throb_step >= self.THROB_STEPS: # full intensity
+                        self.throb = False                  # now start reducing intensity
+                else:                                       # decreasing intensity
+                    self.throb_step -= 1
+                    if self.throb_step <= 0:                # min intensity (off)
+                        self.throb = True                   # now start increasing intensity
+                # scale intensity INTENSITY_LOW -> 1
+                intensity = npdrvr.INTENSITY_LOW + (((self.intensity - npdrvr.INTENSITY_LOW) * self.throb_step) / self.THROB_STEPS)
+                npdrvr.set_all_pixels(self.color, intensity)
+                self.delay = (self.THROB_INTERVAL / 2) / (self.THROB_STEPS + 1)
+
+            elif self.light_style[3] == "MARCH":
+                pixel_list = npdrvr.get_all_pixels()
+                for i in reversed(range(npdrvr.N_LEDS_PER_POST, npdrvr.N_LEDS_PER_STRING[0])):  # scroll pixels one post
+                    pixel_list[i] = pixel_list[i-npdrvr.N_LEDS_PER_POST]
+
+                npdrvr.set_all_pixels(self.color, 0.0)
+                '''
+
+                self.march_step += 1
+                if self.march_step >= self.MARCH_POSTS:
+                    self.march_step = 0
+                    self.march_on = not self.march_on   # toggle on/off state of post at start of string
+                if not self.march_on:
+                    self.intensity = npdrvr.INTENSITY_OFF
+                for i in range(npdrvr.N_LEDS_PER_POST):
+                    pixel_list[i] = npdrvr.set_intensity(self.color, self.intensity)
+                '''
 
-                # display pattern is one of (STEADY, STROBE, THROB, MARCH, TWINKLE)
-                if   self.light_style[3] == "STEADY":
-                    self.delay = 0.1
-                    npdrvr.set_all_pixels(self.color, self.intensity)
+                npdrvr.copy_all_pixels(pixel_list)
+                self.delay = self.MARCH_INTERVAL
 
-                elif self.light_style[3] == "STROBE":
-                    if self.strobe:
-                        self.strobe = False
-                        self.intensity = npdrvr.INTENSITY_OFF
-                        self.delay = self.STROBE_INTERVAL
-                    else:
-                        self.strobe = True
-                        self.delay = self.STROBE_ON_TIME
-                    npdrvr.set_all_pixels(self.color, self.intensity)
-
-                elif self.light_style[3] == "THROB":
-                    if self.throb:                              # increasing intensity
-                        self.throb_step += 1
-                        if self.throb_step >= self.THROB_STEPS: # full intensity
-                            self.throb = False                  # now start reducing intensity
-                    else:                                       # decreasing intensity
-                        self.throb_step -= 1
-                        if self.throb_step <= 0:                # min intensity (off)
-                            self.throb = True                   # now start increasing intensity
-                    # scale intensity INTENSITY_LOW -> 1
-                    intensity = npdrvr.INTENSITY_LOW + (((self.intensity - npdrvr.INTENSITY_LOW) * self.throb_step) / self.THROB_STEPS)
-                    npdrvr.set_all_pixels(self.color, intensity)
-                    self.delay = (self.THROB_INTERVAL / 2) / (self.THROB_STEPS + 1)
-
-                elif self.light_style[3] == "MARCH":
-                    pixel_list = npdrvr.get_all_pixels()
-                    for i in reversed(range(npdrvr.N_LEDS_PER_POST, npdrvr.N_LEDS_PER_STRING[0])):  # scroll pixels one post
-                        pixel_list[i] = pixel_list[i-npdrvr.N_LEDS_PER_POST]
-
-                    npdrvr.set_all_pixels(self.color, 0.0)
-                    '''
-
-                    self.march_step += 1
-                    if self.march_step >= self.MARCH_POSTS:
-                        self.march_step = 0
-                        self.march_on = not self.march_on   # toggle on/off state of post at start of string
-                    if not self.march_on:
-                        self.intensity = npdrvr.INTENSITY_OFF
-                    for i in range(npdrvr.N_LEDS_PER_POST):
-                        pixel_list[i] = npdrvr.set_intensity(self.color, self.intensity)
-                    '''
-
-                    npdrvr.copy_all_pixels(pixel_list)
-                    self.delay = self.MARCH_INTERVAL
-
-                elif self.light_style[3] == "TWINKLE":
-                    pixel_list = npdrvr.get_all_pixels()
-                    n_pixels = len(pixel_list)
-                    for j in range(int(n_pixels/4)):     # randomly change state of 1/4 of the pixels
-                        i = random.randint(0, n_pixels-1)
-                        if pixel_list[i] == (0, 0, 0):
-                            pixel_list[i] = npdrvr.set_intensity(self.color, self.intensity)
-                        else:
-                            pixel_list[i] = (0, 0, 0)
-                    npdrvr.copy_all_pixels(pixel_list)
-                    self.delay = self.TWINKLE_INTERVAL
-
-                else:   # unrecognized pattern, reset to default
-                    self.light_style[3] = "STEADY"
-                    self.delay = 0.0
-                    server_log.warning("Unrecognized lighting pattern = %s", self.light_style[3])
-
-            elif self.light_style[0] == "LIGHTING":       # message type = (LIGHTING, FENCEPOST NUMBER, ORIENTATION, COLOR, BRIGHTNESS)
-                self.color = self.light_style[3]
-                self.intensity = self.light_style[4]
+            elif self.light_style[3] == "TWINKLE":
                 pixel_list = npdrvr.get_all_pixels()
-                i_start = pixel_index(int(int(self.light_style[1])), self.light_style[2], position=1)
-                for i in range(i_start, i_start+npdrvr.N_LEDS_PER_POST):
-                    pixel_list[i] = npdrvr.set_intensity(self.color, self.intensity)
+                n_pixels = len(pixel_list)
+                for j in range(int(n_pixels/4)):     # randomly change state of 1/4 of the pixels
+                    i = random.randint(0, n_pixels-1)
+                    if pixel_list[i] == (0, 0, 0):
+                        pixel_list[i] = npdrvr.set_intensity(self.color, self.intensity)
+                    else:
+                        pixel_list[i] = (0, 0, 0)
                 npdrvr.copy_all_pixels(pixel_list)
+                self.delay = self.TWINKLE_INTERVAL
 
-            else:   # unrecognized type, reset to default
-                self.light_style = ("DISPLAY", "WHITE", "LOW", "STEADY")
+            else:   # unrecognized pattern, reset to default
+                self.light_style[3] = "STEADY"
                 self.delay = 0.0
-                server_log.warning("Unrecognized lighting message type = %s", self.light_style[0])
+                server_log.warning("Unrecognized lighting pattern = %s", self.light_style[3])
+
+        elif self.light_style[0] == "LIGHTING":       # message type = (LIGHTING, FENCEPOST NUMBER, ORIENTATION, COLOR, BRIGHTNESS)
+            self.color = self.light_style[3]
+            self.intensity = self.light_style[4]
+            pixel_list = npdrvr.get_all_pixels()
+            i_start = pixel_index(int(int(self.light_style[1])), self.light_style[2], position=1)
+            for i in range(i_start, i_start+npdrvr.N_LEDS_PER_POST):
+                pixel_list[i] = npdrvr.set_intensity(self.color, self.intensity)
+            npdrvr.copy_all_pixels(pixel_list)
+
+        else:   # unrecognized type, reset to default
+            self.light_style = ("DISPLAY", "WHITE", "LOW", "STEADY")
+            self.delay = 0.0
+            server_log.warning("Unrecognized lighting message type = %s", self.light_style[0])
 
 class healthThread(threading.Thread):
     HEARTBEAT_INTERVAL = 60    # report health every minute
@@ -493,10 +813,12 @@ class healthThread(threading.Thread):
             msg = ("HEALTH_NOTICE", health_status)  # message must be a list
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             try:
-                s.connect(("magicmirror", HOME_AUTOMATION_PORT))
+                s.connect(han_discovery.resolve("magicmirror", HOME_AUTOMATION_PORT))
             except:
+                han_discovery.mark_failed("magicmirror")
                 server_log.warning("healthThread failed to report to magic mirror, socket could not be established.")
             else:
+                han_discovery.mark_ok("magicmirror")
                 s.sendall(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
                 s.close()
 
@@ -505,39 +827,170 @@ class healthThread(threading.Thread):
 
 
 class serverThread(threading.Thread):
+    #
+    # Messages are handled by priority class (MSG_PRIORITY, see han_admission).
+    # Control and realtime messages are answered on this thread as soon as they
+    # are read, bulk history replies stream from a small pool, and telemetry is
+    # handled by one worker. A full pool queue sheds the message with a BUSY reply.
+    #
+    # Connections are read without blocking, all at once, so a client that
+    # sends slowly or not at all holds up nobody but itself. A client over its
+    # rate or with too many connections open is disconnected at accept, before
+    # anything is read, and a message not received within CLIENT_TIMEOUT of
+    # the connect is dropped.
+    #
+    CLIENT_RATE     = 20.0      # messages per second per client (IP address) ...
+    CLIENT_BURST    = 40        # ... with bursts of up to this many
+    CLIENT_TIMEOUT  = 5.0       # seconds to receive a whole message, or to send a reply
+    CLIENT_READS    = 8         # connections per client being read at once
+    MAX_READS       = 64        # connections being read at once, from all clients
+    MAX_MESSAGE     = 64 * 1024 # bytes, longer messages are dropped
+    BULK_WORKERS    = 2         # history replies streamed at once
+    BULK_QUEUE      = 4         # history requests waiting, more are answered BUSY
+    TELEMETRY_QUEUE = 32        # telemetry messages waiting, more are dropped
+
     def __init__(self, node_t):
         threading.Thread.__init__(self)
         node_type = node_t
         self.daemon = True
 
     def run(self):
-        global g_vi_latest
-        global g_vi_lock
-        global g_flow_latest
-        global g_flow_lock
-
         server_log.info("serverThread running")
 
+        pools   = { han_admission.BULK      : han_admission.BoundedPool("bulk", serverThread.BULK_WORKERS,
+                                                                        serverThread.BULK_QUEUE, server_log),
+                    han_admission.TELEMETRY : han_admission.BoundedPool("telemetry", 1,
+                                                                        serverThread.TELEMETRY_QUEUE, server_log) }
+        limiter = han_admission.RateLimiter()
+
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)    # rebind at once if restarted
         s.bind(('', HOME_AUTOMATION_PORT)) # listen on all IP addresses on this host
         s.listen(5)
         server_log.info("Listening on port (%s, %d)", "''", HOME_AUTOMATION_PORT)
 
-        while True:
-            buf = b''
-            client, addr = s.accept()   # block until connection request
-            while True:
-                data = client.recv(4096)
-                if data:
-                    buf += data
-                if not data:
-                    # client has sent message and shut down connection
-                    break
+        s.setblocking(False)
+        sel = selectors.DefaultSelector()
+        sel.register(s, selectors.EVENT_READ)
+        reading = {}    # client socket -> (ip, t_start, bytearray received so far)
 
+        while True:
+            # wait for a connection, data, or the next read deadline
+            if reading:
+                first = min(r[1] for r in reading.values())
+                timeout = max(0.0, first + serverThread.CLIENT_TIMEOUT - time.perf_counter())
+            else:
+                timeout = None
+            for (key, events) in sel.select(timeout):
+                if key.fileobj is s:
+                    self.accept(s, sel, reading, limiter)
+                else:
+                    self.read(key.fileobj, sel, reading, pools)
+
+            now = time.perf_counter()
+            for (client, (ip, t_start, buf)) in list(reading.items()):
+                if now - t_start >= serverThread.CLIENT_TIMEOUT:
+                    server_log.warning("Message from %s not received within %.1f s", ip, serverThread.CLIENT_TIMEOUT)
+                    hm.counter("han_server_shed_total", msg_type="unknown", reason="timeout").inc()
+                    self.stop_reading(client, sel, reading)
+                    client.close()
+
+    def accept(self, s, sel, reading, limiter):
+        # start reading a new connection, unless its client is over its rate or its connections
+        try:
+            client, addr = s.accept()
+        except OSError:
+            return                      # the client gave up before it was accepted
+        t_start = time.perf_counter()
+        ip = addr[0]
+        if not limiter.take(ip, serverThread.CLIENT_RATE, serverThread.CLIENT_BURST):
+            reason = "rate"
+        elif (len(reading) >= serverThread.MAX_READS or
+              sum(1 for r in reading.values() if r[0] == ip) >= serverThread.CLIENT_READS):
+            reason = "connections"
+        else:
+            client.setblocking(False)
+            sel.register(client, selectors.EVENT_READ)
+            reading[client] = (ip, t_start, bytearray())
+            return
+        hm.counter("han_server_shed_total", msg_type="unknown", reason=reason).inc()
+        client.close()
+
+    def stop_reading(self, client, sel, reading):
+        sel.unregister(client)
+        del reading[client]
+
+    def read(self, client, sel, reading, pools):
+        # take what the client has sent, dispatch the message once the client shuts down its side
+        (ip, t_start, buf) = reading[client]
+        try:
+            data = client.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = None
+        if data == b'':
+            # client has sent message and shut down connection
+            self.stop_reading(client, sel, reading)
+            client.setblocking(True)
+            client.settimeout(serverThread.CLIENT_TIMEOUT)   # for the reply
+            self.dispatch(client, ip, bytes(buf), t_start, pools)
+            return
+        if data is None:
+            server_log.warning("Message from %s not received", ip)
+        else:
+            buf += data
+            if len(buf) <= serverThread.MAX_MESSAGE:
+                return
+            server_log.warning("Message from %s longer than %d bytes", ip, serverThread.MAX_MESSAGE)
+        self.stop_reading(client, sel, reading)
+        client.close()
+
+    def dispatch(self, client, ip, buf, t_start, pools):
+        # answer the message on this thread or hand it to its class's pool
+        if trace is not None:
+            trace.message(buf)
+        try:
             msg = pickle.loads(buf) # depickle network message back to a message list
             server_log.debug("Received message: %s", str(msg))
             msg_t = msg[0]
+            msg_label = msg_t if msg_t in MSG_TYPES else "unknown"   # bound the number of metrics
+        except Exception:
+            # empty or not a pickled message, e.g. a port scan
+            server_log.warning("Malformed message from %s: %r", ip, buf[:64])
+            hm.counter("han_server_requests_total", msg_type="malformed").inc()
+            client.close()
+            return
+        hm.counter("han_server_requests_total", msg_type=msg_label).inc()
+
+        try:
+            priority = MSG_PRIORITY.get(msg_t, han_admission.REALTIME)
+            if priority in pools:
+                if not pools[priority].submit(self.handle, client, msg, msg_label, t_start):
+                    self.shed(client, msg_label, priority, "queue")
+            else:
+                self.handle(client, msg, msg_label, t_start)
+        except Exception:
+            # one bad message must not stop the server
+            server_log.exception("Unable to handle message %s", msg_label)
+            client.close()
 
+    def shed(self, client, msg_label, priority, reason):
+        # answer BUSY, telemetry senders don't wait for a reply
+        hm.counter("han_server_shed_total", msg_type=msg_label, reason=reason).inc()
+        try:
+            if priority == han_admission.BULK:
+                han_history.send_busy(client)           # in the chunked reply format
+            elif priority != han_admission.TELEMETRY:
+                client.sendall(pickle.dumps(han_admission.BUSY, pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            pass
+        client.close()
+
+    def handle(self, client, msg, msg_label, t_start):
+        # answer msg and close the connection, on this thread or a pool thread
+        msg_t = msg[0]
+        try:
             # validate message can be handled by this node type
             if msg_t not in MSG_TYPES:
                 server_log.warning("Unknown message type received: %s" % msg_t)
@@ -547,41 +1000,164 @@ class serverThread(threading.Thread):
 
                 else:   # decode and respond to message
                     if msg_t == "VI_QUERY":
-                        # fetch global variable with latest vi sample
-                        with g_vi_lock:
-                            (vin, cur) = g_vi_latest
+                        # latest vi sample
+                        (vin, cur) = state.value("vi")
                         client.sendall(pickle.dumps((vin, cur), pickle.HIGHEST_PROTOCOL))
 
-                    elif msg_t == "SOUND":
-                        # get mp3 file and drive output
-                        pass
+                    elif msg_t == "PLAY_AUDIO":
+                        # (PLAY_AUDIO, CLIP, [VOLUME], [START TIME]), dropped while the audio plugin loads
+                        # queued for the audio thread's decoder, so a cache miss doesn't hold up the server
+                        if audio_t is not None:
+                            audio_t.play(*msg[1:4])
 
                     elif msg_t == "VI_HISTORY":
-                        vi_list = []
-                        if not vi_q.empty():
-                            vi_list.append(vi_q.get_nowait())
-                        client.sendall(pickle.dumps(vi_list, pickle.HIGHEST_PROTOCOL))
+                        # (VI_HISTORY, [START], [END]) -> frames of (t, vin, cur)
+                        (start, end) = han_history.time_range(msg)
+                        han_history.send_chunked(client, han_history.iter_log(VI_LOG, start, end, han_history.parse_vi))
 
                     elif msg_t == "DISPLAY":
-                        lighting_cmd_q.put(msg)
+                        lighting_mailbox.put(fpLightingThread.target(msg), msg)
+                        try:
+                            client.sendall(pickle.dumps("ACK", pickle.HIGHEST_PROTOCOL))
+                        except OSError:
+                            pass    # sender didn't wait for the ack
 
                     elif msg_t == "FLOW_QUERY":
-                        # fetch global variable with latest flow sample and zone activation
-                        with g_flow_lock:
-                            (gpm, gal) = g_flow_latest
-                            zone = g_active_zone
+                        # latest flow sample and zone activation
+                        if g_flow_record is not None:   # sampler in its own process
+                            (gpm, gal, zone) = g_flow_record.read()
+                        else:
+                            snapshot = state.snapshot("flow", "zone")
+                            (gpm, gal) = snapshot["flow"][0]
+                            zone = snapshot["zone"][0]
                         client.sendall(pickle.dumps((gpm, gal, zone), pickle.HIGHEST_PROTOCOL))
 
                     elif msg_t == "FLOW_HISTORY":
-                        with open('flowrecord.txt', 'r') as f:
-                            history = f.readlines()
-                            client.sendall(pickle.dumps(history.reverse(), pickle.HIGHEST_PROTOCOL))
+                        # (FLOW_HISTORY, [START], [END]) -> frames of (t, gpm, gallons, zone)
+                        (start, end) = han_history.time_range(msg)
+                        han_history.send_chunked(client, han_history.iter_log(FLOW_LOG, start, end, han_history.parse_flow))
 
                     elif msg_t == "HEALTH_NOTICE":
-                        mm.nodeStatusHandler(msg[1])    # pass JSON payload
-                        pass
-
+                        if mm is not None:              # mirror plugin still loading
+                            mm.nodeStatusHandler(msg[1])    # pass JSON payload
+
+                    elif msg_t == "LIGHTING_QUERY":
+                        # current lighting message, e.g. (DISPLAY, COLOR, INTENSITY, PATTERN)
+                        if fpl_t is not None:           # no reply while the lighting plugin loads
+                            client.sendall(pickle.dumps(tuple(fpl_t.light_style), pickle.HIGHEST_PROTOCOL))
+
+                    elif msg_t == "METRICS":
+                        client.sendall(pickle.dumps(hm.snapshot(host_name), pickle.HIGHEST_PROTOCOL))
+
+                    elif msg_t == "CONFIG_RELOAD":
+                        # (CONFIG_RELOAD, [CHANGES]) -> { target : [names] } or "ERROR: ..."
+                        # reloads CONFIG_FILE, or applies the changes in the message
+                        reply = reload_config(msg[1] if len(msg) > 1 else None)
+                        client.sendall(pickle.dumps(reply, pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            server_log.warning("%s reply not sent", msg_label)     # client gone or stalled
+        except Exception:
+            server_log.exception("Unable to handle message %s", msg_label)   # e.g. missing arguments
+        finally:
             client.close()
+            hm.histogram("han_server_request_seconds", msg_type=msg_label).observe(time.perf_counter() - t_start)
+
+
+#
+# subsystems are plugins, started in this order on the node types that handle
+# their message type (all nodes if None). A plugin's modules are imported only
+# on those nodes, so e.g. the magicmirror never loads the neopixel driver, which
+# takes over board.D12 on import. Every plugin's modules are imported before
+# any plugin's thread starts, so the configuration is checked against them.
+#
+# name : (message type, global set to the started thread, { global name : module })
+# a dotted module name binds the top level package, like "import a.b"
+#
+PLUGINS = { 'lighting' : ('DISPLAY', 'fpl_t',
+                          { 'npdrvr' : 'fencepost_neopixel_driver' }),
+            'vi'       : ('VI_QUERY', 'vi_t',
+                          { 'board' : 'board', 'busio' : 'busio', 'digitalio' : 'digitalio',
+                            'adafruit_bus_device' : 'adafruit_bus_device.spi_device', 'han_vi' : 'han_vi' }),
+            'flow'     : ('FLOW_QUERY', 'flow_t',
+                          { 'board' : 'board', 'digitalio' : 'digitalio', 'han_flow_shm' : 'han_flow_shm',
+                            'han_flow_analytics' : 'han_flow_analytics', 'han_checkpoint' : 'han_checkpoint',
+                            'multiprocessing' : 'multiprocessing' }),
+            'audio'    : ('PLAY_AUDIO', 'audio_t',
+                          { 'han_audio' : 'han_audio' }),
+            'mirror'   : ('HEALTH_NOTICE', None,            # magicmirror threads start on import
+                          { 'mm' : 'han_mm' }),
+            'health'   : (None, 'health_t',
+                          { 'requests' : 'requests' }) }
+
+PLUGIN_THREADS = { 'lighting' : lambda: fpLightingThread(),
+                   'vi'       : lambda: viThread(),
+                   'flow'     : lambda: flowThread(),
+                   'audio'    : lambda: audioThread(),
+                   'health'   : lambda: healthThread(host_name, node_type) }
+
+def load_plugin(name):
+    # import the plugin's modules into this module's globals
+    (msg_t, thread_global, modules) = PLUGINS[name]
+    for (global_name, module_name) in modules.items():
+        module = importlib.import_module(module_name)
+        if global_name == module_name.split('.')[0]:
+            module = sys.modules[global_name]
+        if trace is not None:
+            module = trace.recording(global_name, module)    # record what the hardware returns
+        globals()[global_name] = module
+
+def start_plugin(name):
+    # start the plugin's thread, if it has one
+    (msg_t, thread_global, modules) = PLUGINS[name]
+    if thread_global is not None:
+        t = PLUGIN_THREADS[name]()
+        t.start()
+        globals()[thread_global] = t
+
+def config_targets():
+    # han_config targets, the neopixel driver only on nodes running the lighting plugin
+    return { 'flowThread' : flowThread, 'viThread' : viThread, 'fpLightingThread' : fpLightingThread,
+             'audioThread' : audioThread, 'healthThread' : healthThread, 'npdrvr' : npdrvr }
+
+def config_checks():
+    # han_config checks of the values that have a range, beyond their type
+    positive = han_config.positive
+    return { 'flowThread'       : { 'SAMPLE_INTERVAL' : positive, 'MIN_FLOW_RATE' : positive,
+                                    'LEAK_DETECT_DT' : positive, 'RT_PRIORITY' : han_config.in_range(0, 99),
+                                    'ZONE_MAP' : han_config.pin_map(board, ("led", "flow_sns")) },
+             'viThread'         : { 'SAMPLE_INTERVAL' : positive, 'SAMPLE_RATE' : positive,
+                                    'BLOCK_SIZE' : positive, 'VIN_SCALE' : positive, 'CUR_SCALE' : positive },
+             'fpLightingThread' : { 'STROBE_ON_TIME' : positive, 'STROBE_INTERVAL' : positive,
+                                    'THROB_INTERVAL' : positive, 'THROB_STEPS' : positive,
+                                    'MARCH_POSTS' : positive, 'MARCH_INTERVAL' : positive,
+                                    'TWINKLE_INTERVAL' : positive },
+             'audioThread'      : { 'QUEUE_DEPTH' : positive },
+             'healthThread'     : { 'HEARTBEAT_INTERVAL' : positive } }
+
+def reload_config(changes=None):
+    # apply changes, or CONFIG_FILE if None, returns what was applied or an error string
+    try:
+        if changes is None:
+            changes = han_config.load(CONFIG_FILE)
+        applied = han_config.apply(config_targets(), changes, config_checks())
+    except han_config.ConfigError as e:
+        server_log.warning("Configuration not applied: %s", e)
+        return "ERROR: %s" % e
+    if applied:
+        server_log.info("Configuration applied: %s", applied)
+    return applied
+
+startup_times = []      # [(phase, seconds)] in startup order
+
+def record_phase(phase, seconds):
+    startup_times.append((phase, seconds))
+    hm.gauge("han_startup_seconds", phase=phase).set(seconds)
+
+@contextlib.contextmanager
+def startup_phase(phase):
+    t0 = time.perf_counter()
+    yield
+    record_phase(phase, time.perf_counter() - t0)
 
 
 host_name = socket.gethostname()
@@ -631,35 +1207,68 @@ if (node_type == 'flowmeter') or (node_type == 'fencepost'):
         flow_log = logging.getLogger('han.flow')
         flow_log.addHandler(flow_log_fh)
 
-server_log.info("")
-server_log.info("SERVER STARTING...")
-server_log.info("Host name is %s", host_name)
-server_log.info("Node type is %s", node_type)
-
-# start threads
-if node_type in MSG_TYPES['DISPLAY']:
-    fpl_t = fpLightingThread()
-    fpl_t.start()
-if node_type in MSG_TYPES['VI_QUERY']:
-    vi_t = viThread()
-    vi_t.start()
-if node_type in MSG_TYPES['FLOW_QUERY']:
-    flow_t = flowThread()
-    flow_t.start()
-if node_type in MSG_TYPES['PLAY_AUDIO']:
-    audio_t = audioThread()
-    audio_t.start()
-if node_type == 'magicmirror':
-    # magicmirror node has additional functionality and incorporates a communication
-    # channed to the magicmirror Javascript app
-    # setup code will run and magicmirror threads will start on import
-    import han_mm as mm
-
-health_t = healthThread(host_name, node_type)
-health_t.start()
-
-server_t = serverThread(node_type)
-server_t.start()
-
-while True:
-    pass
+# started plugin threads and the mirror module, None until loaded
+fpl_t = vi_t = flow_t = audio_t = health_t = mm = None
+trace = None            # han_trace.TraceWriter when recording
+
+# importing this module (e.g. han_trace replaying a trace) doesn't start the node
+if __name__ == "__main__":
+    server_log.info("")
+    server_log.info("SERVER STARTING...")
+    server_log.info("Host name is %s", host_name)
+    server_log.info("Node type is %s", node_type)
+
+    record_phase("imports", time.perf_counter() - T_START)
+
+    if TRACE_PATH is not None:
+        import han_trace
+        trace = han_trace.TraceWriter(TRACE_PATH, host_name, node_type)
+
+    # announce this node and the message types it handles, and resolve other nodes from the announcements
+    with startup_phase("discovery"):
+        han_discovery.start(host_name, node_type, HOME_AUTOMATION_PORT,
+                            [msg_t for msg_t in MSG_TYPES if node_type in MSG_TYPES[msg_t]])
+
+    # inter-node event bus, any thread may publish, threads subscribe when they start
+    with startup_phase("bus"):
+        bus = han_bus.init(host_name)
+
+    # the server accepts connections while the plugins load, messages for a
+    # plugin that isn't running yet are answered or dropped by serverThread
+    with startup_phase("server"):
+        server_t = serverThread(node_type)
+        server_t.start()
+
+    loaded = []
+    for name in PLUGINS:
+        if PLUGINS[name][0] is None or node_type in MSG_TYPES[PLUGINS[name][0]]:
+            try:
+                with startup_phase(name):
+                    load_plugin(name)
+                loaded.append(name)
+            except Exception:
+                server_log.exception("Unable to load plugin %s", name)    # the rest of the node still runs
+
+    # tunables after the plugins' modules are imported, so ZONE_MAP is checked against
+    # board and the driver's constants are set, and before the threads start, e.g. flowThread.USE_PROCESS
+    with startup_phase("config"):
+        reload_config()
+
+    for name in loaded:
+        try:
+            start_plugin(name)
+        except Exception:
+            server_log.exception("Unable to start plugin %s", name)
+
+    bus.start()
+
+    server_log.info("Startup %.2f s: %s", time.perf_counter() - T_START,
+                    ", ".join("%s %.2f" % (phase, seconds) for (phase, seconds) in startup_times))
+
+    # threads run until the service is stopped, the server is restarted should it ever exit
+    while True:
+        server_t.join(SUPERVISE_INTERVAL)
+        if not server_t.is_alive():
+            server_log.error("serverThread exited, restarting it")
+            server_t = serverThread(node_type)
+            server_t.start()
@@ -0,0 +1,192 @@
+"""
+
+Priority classes and admission control for serverThread.
+
+Every message type has a priority class (han.MSG_PRIORITY):
+
+    control     commands that change what the node does, e.g. DISPLAY
+    realtime    small queries answered from memory, e.g. FLOW_QUERY
+    bulk        history replies that read the logs and stream many frames
+    telemetry   reports nobody waits on, e.g. HEALTH_NOTICE
+
+serverThread answers control and realtime messages itself as soon as they
+are read, so they never wait behind a reply that is streaming. Bulk and
+telemetry messages go to small worker pools with bounded queues. When a
+pool's queue is full the message is shed: a bulk request is answered BUSY,
+so the sender backs off and retries, and telemetry is dropped, the next
+report replaces it.
+
+Each client (IP address) also has a token bucket, so one misbehaving
+client can't starve the others. A client over its rate is disconnected as
+soon as it connects, before anything is read from it.
+
+Run this module for DISPLAY latency on a node flooded with history
+requests, answered in arrival order and by priority class.
+
+"""
+
+import logging
+import queue
+import threading
+import time
+
+import han_metrics as hm
+
+CONTROL   = "control"
+REALTIME  = "realtime"
+BULK      = "bulk"
+TELEMETRY = "telemetry"
+
+BUSY      = "BUSY"          # reply to a shed request
+IDLE_CLIENTS = 256          # buckets kept before idle (full) ones are dropped
+
+
+class Busy(ConnectionError):
+    # the node shed the request, try again later
+    pass
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'last')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.last   = now
+
+    def take(self, rate, burst, now):
+        # True if a token was available
+        self.tokens = min(burst, self.tokens + (now - self.last) * rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateLimiter:
+    # a token bucket per client, rate and burst are passed on every call so they can be reloaded
+    def __init__(self):
+        self._buckets = {}
+
+    def take(self, client, rate, burst, now=None):
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            if len(self._buckets) >= IDLE_CLIENTS:
+                self._buckets = { c : b for (c, b) in self._buckets.items() if now - b.last < burst / rate }
+            bucket = self._buckets[client] = TokenBucket(burst, now)
+        return bucket.take(rate, burst, now)
+
+
+class BoundedPool:
+    # worker threads running jobs from a bounded queue, submit() never blocks
+    def __init__(self, name, workers, depth, log=None):
+        self._q     = queue.Queue(depth)
+        self._log   = log if log is not None else logging.getLogger(__name__)
+        self.depth  = hm.gauge("han_pool_depth", pool=name)
+        self.errors = hm.counter("han_pool_errors_total", pool=name)
+        for i in range(workers):
+            threading.Thread(target=self._work, name="%sPool-%d" % (name, i), daemon=True).start()
+
+    def submit(self, fn, *args):
+        # False if the queue is full and the job was not taken
+        try:
+            self._q.put_nowait((fn, args))
+        except queue.Full:
+            return False
+        self.depth.set(self._q.qsize())
+        return True
+
+    def _work(self):
+        while True:
+            (fn, args) = self._q.get()
+            self.depth.set(self._q.qsize())
+            try:
+                fn(*args)
+            except Exception:
+                self.errors.inc()
+                self._log.exception("pool job failed")
+
+
+#
+# DISPLAY latency while other clients stream history from the node
+#
+
+def _benchmark(days=7, flooders=4, seconds=5.0, interval=0.020):
+    import os
+    import pickle
+    import socket
+    import sys
+    import tempfile
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import han
+    import han_admission    # han raises the module's Busy, not this script's __main__.Busy
+    import han_history
+
+    log = logging.getLogger("han_admission.benchmark")   # outside han's hierarchy, no log files
+    log.propagate = False
+    log.addHandler(logging.NullHandler())
+    han.server_log = log
+    han.node_type = "fencepost"
+    han.VI_LOG = os.path.join(tempfile.mkdtemp(), "vi_log.txt")
+    t0 = time.time() - days * 24 * 60 * 60
+    with open(han.VI_LOG, 'w') as f:
+        for i in range(days * 24 * 60):
+            stamp = time.strftime(han_history.STAMP_FORMAT, time.localtime(t0 + 60 * i))
+            f.write("01/01/2024 00:00:00  fencepost-back-1 INFO %s\t%.1f\t%d\n" % (stamp, 12.0 + i % 10 / 10, 200 + i % 50))
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        han.HOME_AUTOMATION_PORT = s.getsockname()[1]
+    han.serverThread.CLIENT_RATE = 1e6      # every client is 127.0.0.1 here
+    han.serverThread("fencepost").start()
+    time.sleep(0.2)
+
+    def display():
+        t_start = time.perf_counter()
+        s = socket.create_connection(('127.0.0.1', han.HOME_AUTOMATION_PORT))
+        s.sendall(pickle.dumps(("DISPLAY", "WHITE", "LOW", "ON"), pickle.HIGHEST_PROTOCOL))
+        s.shutdown(socket.SHUT_WR)
+        while s.recv(4096):
+            pass
+        s.close()
+        return time.perf_counter() - t_start
+
+    def flood(stop, counts):
+        while not stop.is_set():
+            try:
+                counts[0] += sum(1 for r in han_history.query('127.0.0.1', ("VI_HISTORY", 0, None),
+                                                             han.HOME_AUTOMATION_PORT, 10.0))
+            except han_admission.Busy:
+                counts[1] += 1
+                time.sleep(0.1)     # back off
+            except OSError:
+                counts[2] += 1      # refused or reset, the listen backlog overflowed
+                time.sleep(0.1)
+
+    print("%d flooding clients, %d day VI_HISTORY replies, a DISPLAY every %d ms" % (flooders, days, 1000 * interval))
+    priorities = han.MSG_PRIORITY
+    for (name, priority) in (("arrival order", {}), ("priority classes", priorities)):
+        han.MSG_PRIORITY = priority         # {} handles every message on serverThread, as it arrives
+        stop = threading.Event()
+        counts = [0, 0, 0]          # history records received, BUSY replies, connection errors
+        threads = [threading.Thread(target=flood, args=(stop, counts), daemon=True) for i in range(flooders)]
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+        latencies = []
+        t_end = time.perf_counter() + seconds
+        while time.perf_counter() < t_end:
+            latencies.append(display())
+            time.sleep(interval)
+        stop.set()
+        for t in threads:
+            t.join()
+        latencies.sort()
+        p = lambda q: 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+        print("%-16s DISPLAY p50 %6.1f ms  p99 %6.1f ms  max %6.1f ms  history %7d records, %d BUSY, %d errors" % (
+              name, p(0.5), p(0.99), 1000 * latencies[-1], counts[0], counts[1], counts[2]))
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,252 @@
+"""
+
+In-process audio engine for HAN nodes.
+
+Clips are decoded once to 16 bit stereo PCM and kept in an LRU cache with
+a byte budget. A single mixer loop writes fixed size periods to a
+persistent output stream, so playing a clip is a cache lookup and a list
+append rather than a fork/exec of a player that decodes the file again.
+
+Overlapping clips are mixed with per-clip volume and saturating addition.
+A clip can be scheduled to start at a wall clock time, which is honoured to
+the sample.
+
+Sinks:
+    AlsaSink  - pyalsaaudio if installed, otherwise a persistent aplay process
+    NullSink  - discards audio, optionally paced in real time
+    FileSink  - writes the mixed output to a .wav file, for tests
+
+Mixing uses numpy when it is installed, otherwise audioop, and where
+neither is available (audioop was removed in Python 3.13) plain Python
+over array, which is slower but mixes exactly as audioop does.
+
+"""
+
+import array
+import collections
+import math
+import os
+import sys
+import subprocess
+import threading
+import time
+import wave
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+RATE         = 44100
+CHANNELS     = 2
+SAMPLE_BYTES = 2
+FRAME_BYTES  = CHANNELS * SAMPLE_BYTES
+PERIOD       = 512              # frames per mixer period, 11.6 ms
+BUFFER_TIME  = 0.040            # output device buffer, seconds
+
+
+def decode(path):
+    # return the clip as raw 16 bit stereo PCM at RATE
+    if path.endswith(".wav"):
+        with wave.open(path, 'rb') as w:
+            if (w.getframerate(), w.getnchannels(), w.getsampwidth()) == (RATE, CHANNELS, SAMPLE_BYTES):
+                return w.readframes(w.getnframes())
+    # anything else (mp3, other wav formats) is converted by ffmpeg, once
+    cmd = ["ffmpeg", "-v", "quiet", "-i", path, "-f", "s16le", "-acodec", "pcm_s16le",
+           "-ac", str(CHANNELS), "-ar", str(RATE), "-"]
+    return subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+
+
+class PcmCache:
+    # LRU cache of decoded clips, bounded by total PCM bytes
+    def __init__(self, max_bytes=32*1024*1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._clips = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            pcm = self._clips.get(path)
+            if pcm is not None:
+                self._clips.move_to_end(path)
+                return pcm
+        pcm = decode(path)              # decode outside the lock
+        with self._lock:
+            if path not in self._clips:
+                self._clips[path] = pcm
+                self.bytes += len(pcm)
+                while self.bytes > self.max_bytes and len(self._clips) > 1:
+                    (old, old_pcm) = self._clips.popitem(last=False)
+                    self.bytes -= len(old_pcm)
+        return pcm
+
+
+class NullSink:
+    # discards audio, paced in real time unless realtime=False
+    def __init__(self, realtime=True):
+        self.realtime = realtime
+        self.frames = 0
+        self._due = None
+
+    def write(self, data):
+        n = len(data) // FRAME_BYTES
+        self.frames += n
+        if self.realtime:
+            now = time.monotonic()
+            if self._due is None or self._due < now - BUFFER_TIME:
+                self._due = now
+            self._due += n / RATE
+            if self._due - now > BUFFER_TIME:   # behave like a device with BUFFER_TIME of buffering
+                time.sleep(self._due - now - BUFFER_TIME)
+
+    def close(self):
+        pass
+
+
+class FileSink(NullSink):
+    # writes the mixed output to a wav file
+    def __init__(self, path, realtime=False):
+        NullSink.__init__(self, realtime)
+        self.wav = wave.open(path, 'wb')
+        self.wav.setnchannels(CHANNELS)
+        self.wav.setsampwidth(SAMPLE_BYTES)
+        self.wav.setframerate(RATE)
+
+    def write(self, data):
+        self.wav.writeframes(data)
+        NullSink.write(self, data)
+
+    def close(self):
+        self.wav.close()
+
+
+class AlsaSink:
+    # persistent ALSA output stream, write() blocks when the device buffer is full
+    def __init__(self, device="default"):
+        try:
+            import alsaaudio
+            self.pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, device=device, channels=CHANNELS,
+                                     rate=RATE, format=alsaaudio.PCM_FORMAT_S16_LE, periodsize=PERIOD)
+            self.proc = None
+        except ImportError:
+            self.pcm = None
+            self.proc = subprocess.Popen(["aplay", "-q", "-D", device, "-t", "raw", "-f", "S16_LE",
+                                          "-c", str(CHANNELS), "-r", str(RATE),
+                                          "--buffer-time=%d" % int(BUFFER_TIME * 1000000)],
+                                         stdin=subprocess.PIPE)
+
+    def write(self, data):
+        if self.pcm is not None:
+            self.pcm.write(data)
+        else:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
+class _Voice:
+    __slots__ = ('pcm', 'pos', 'volume', 'start_frame')
+
+    def __init__(self, pcm, volume, start_frame):
+        self.pcm = pcm
+        self.pos = 0                    # byte offset of next sample to mix
+        self.volume = volume
+        self.start_frame = start_frame  # engine frame the clip starts on
+
+
+class AudioEngine:
+    # mixer loop, run() never returns
+    def __init__(self, sink, cache=None):
+        self.sink   = sink
+        self.cache  = cache if cache is not None else PcmCache()
+        self.frame  = 0                 # frames written to the sink since start
+        self.voices = []                # owned by the mixer loop
+        self._new   = collections.deque()
+        self._silence = bytes(PERIOD * FRAME_BYTES)
+        if np is not None:
+            self._acc = np.zeros(PERIOD * CHANNELS, dtype=np.float32)
+
+    def play(self, path, volume=1.0, start_time=None):
+        # start_time is a time.time() value, None = as soon as possible
+        pcm = self.cache.get(path)
+        self._new.append((pcm, min(max(volume, 0.0), 1.0), start_time))
+
+    def _admit(self):
+        # move newly requested clips into the voice list
+        # the sink is at most BUFFER_TIME ahead of the speaker
+        now = time.time()
+        while self._new:
+            (pcm, volume, start_time) = self._new.popleft()
+            start_frame = self.frame
+            if start_time is not None and start_time > now + BUFFER_TIME:
+                start_frame += int((start_time - now - BUFFER_TIME) * RATE)
+            self.voices.append(_Voice(pcm, volume, start_frame))
+
+    def _take(self, voice, end_frame):
+        # next fragment of voice for the period ending at end_frame,
+        # returned with the byte offset at which it starts in the period
+        offset = max(0, voice.start_frame - (end_frame - PERIOD)) * FRAME_BYTES
+        n = PERIOD * FRAME_BYTES - offset
+        frag = voice.pcm[voice.pos:voice.pos + n]
+        voice.pos += len(frag)
+        return (offset, frag)
+
+    def mix(self):
+        # return one period of mixed output
+        self._admit()
+        end_frame = self.frame + PERIOD
+        active = [v for v in self.voices if v.start_frame < end_frame]
+        if not active:
+            return self._silence
+
+        if np is not None:
+            acc = self._acc
+            acc.fill(0.0)
+            for v in active:
+                (offset, frag) = self._take(v, end_frame)
+                s = offset // SAMPLE_BYTES
+                samples = np.frombuffer(frag, dtype=np.int16)
+                acc[s:s + len(samples)] += samples * v.volume
+            out = np.clip(acc, -32768, 32767).astype(np.int16).tobytes()
+        elif audioop is not None:
+            out = self._silence
+            for v in active:
+                (offset, frag) = self._take(v, end_frame)
+                frag = bytes(offset) + audioop.mul(frag, SAMPLE_BYTES, v.volume)
+                frag += bytes(len(out) - len(frag))
+                out = audioop.add(out, frag, SAMPLE_BYTES)     # saturating
+        else:
+            # as audioop: each voice scaled and rounded down, then added with saturation
+            acc = [0] * (PERIOD * CHANNELS)
+            for v in active:
+                (offset, frag) = self._take(v, end_frame)
+                samples = array.array('h', frag)
+                if sys.byteorder == 'big':
+                    samples.byteswap()          # PCM is little endian
+                volume = v.volume
+                for (i, x) in enumerate(samples, offset // SAMPLE_BYTES):
+                    y = acc[i] + math.floor(x * volume)
+                    acc[i] = 32767 if y > 32767 else -32768 if y < -32768 else y
+            samples = array.array('h', acc)
+            if sys.byteorder == 'big':
+                samples.byteswap()
+            out = samples.tobytes()
+
+        self.voices = [v for v in self.voices if v.pos < len(v.pcm)]
+        return out
+
+    def run(self):
+        while True:
+            data = self.mix()
+            self.sink.write(data)           # blocks to pace the loop
+            self.frame += PERIOD
@@ -0,0 +1,152 @@
+"""
+
+Low latency publish/subscribe event bus between HAN nodes.
+
+Events are single UDP multicast datagrams on the local network, so a
+publisher never waits for a connection and one datagram reaches every
+node. Delivery is at most once: there are no acks or retries, and a
+receiver drops any event whose sequence number is not newer than the last
+one it saw from that publisher. Gaps in the sequence are counted as lost.
+
+Topics are '/' separated strings, e.g. "lidar/detect". A subscription to
+"lidar/" receives every lidar topic, a subscription to "lidar/detect"
+receives only that topic.
+
+Subscriber callbacks run on the bus receive thread and must be quick,
+e.g. post to a mailbox or queue.
+
+Run this module directly for a loopback latency benchmark.
+
+"""
+
+import itertools
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
+
+import han_metrics as hm
+
+BUS_GROUP = "239.255.64.45"     # administratively scoped multicast group
+BUS_PORT  = 6447                # HAN TCP is 6445, javascript http is 6446
+MAX_EVENT = 8192                # bytes, events must fit in one datagram
+
+
+class EventBus:
+    def __init__(self, host, group=BUS_GROUP, port=BUS_PORT):
+        self.host  = host
+        self.group = group
+        self.port  = port
+        self.incarnation = (os.getpid(), time.time())  # distinguishes a restarted publisher
+        self._seq  = itertools.count(1)
+        self._subs = []                                 # (topic prefix, callback)
+        self._last = {}                                 # (host, incarnation) -> last seq received
+
+        self._tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self._tx.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self._tx.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self._rx = None
+
+        self.published  = hm.counter("han_bus_published_total")
+        self.received   = hm.counter("han_bus_received_total")
+        self.duplicates = hm.counter("han_bus_duplicates_total")
+        self.lost       = hm.counter("han_bus_lost_total")
+        self.latency    = hm.histogram("han_bus_latency_seconds")
+
+    def publish(self, topic, payload=None):
+        # may be called from any thread, returns the sequence number
+        seq = next(self._seq)
+        data = pickle.dumps((topic, self.host, self.incarnation, seq, time.time(), payload), pickle.HIGHEST_PROTOCOL)
+        if len(data) > MAX_EVENT:
+            raise ValueError("event too large for the bus: %d bytes" % len(data))
+        self._tx.sendto(data, (self.group, self.port))
+        self.published.inc()
+        return seq
+
+    def subscribe(self, prefix, callback):
+        # callback(topic, host, payload) is called for every event whose topic starts with prefix
+        self._subs.append((prefix, callback))
+
+    def start(self):
+        # join the multicast group and start the receive thread
+        rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        rx.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        rx.bind(('', self.port))
+        mreq = struct.pack('4sl', socket.inet_aton(self.group), socket.INADDR_ANY)
+        rx.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self._rx = rx
+        t = threading.Thread(target=self._receive, name="busThread", daemon=True)
+        t.start()
+        return t
+
+    def _receive(self):
+        bad = hm.counter("han_bus_bad_events_total")
+        while True:
+            data = self._rx.recv(MAX_EVENT)
+            try:
+                (topic, host, incarnation, seq, t_sent, payload) = pickle.loads(data)
+            except Exception:
+                bad.inc()
+                continue
+
+            # at most once, drop anything not newer than the last event from this publisher
+            key  = (host, incarnation)
+            last = self._last.get(key, 0)
+            if seq <= last:
+                self.duplicates.inc()
+                continue
+            if last and seq > last + 1:
+                self.lost.inc(seq - last - 1)
+            self._last[key] = seq
+            self.received.inc()
+            if host == self.host:           # clocks only agree on the same node
+                self.latency.observe(time.time() - t_sent)
+
+            for (prefix, callback) in self._subs:
+                if topic.startswith(prefix):
+                    try:
+                        callback(topic, host, payload)
+                    except Exception:
+                        bad.inc()
+
+
+# the process-wide bus, created by init()
+bus = None
+
+def init(host):
+    # create the process-wide bus, subscribers may be added before or after start()
+    global bus
+    bus = EventBus(host)
+    return bus
+
+
+def _benchmark(n=1000):
+    # publish to ourselves over multicast loopback, report delivery latency
+    bus = EventBus(socket.gethostname())
+    done = threading.Event()
+    late = []
+
+    def on_ping(topic, host, payload):
+        late.append(time.perf_counter() - payload)
+        if len(late) == n:
+            done.set()
+
+    bus.subscribe("bench/ping", on_ping)
+    bus.start()
+    for i in range(n):
+        bus.publish("bench/ping", time.perf_counter())
+        time.sleep(0.001)
+    done.wait(5.0)
+
+    late.sort()
+    if not late:
+        print("no events received, is multicast routed on this host?")
+        return
+    print("%d/%d events  p50 %.3f ms  p99 %.3f ms  max %.3f ms" %
+          (len(late), n, 1000 * late[len(late) // 2], 1000 * late[int(len(late) * 0.99)], 1000 * late[-1]))
+
+
+if __name__ == "__main__":
+    _benchmark()
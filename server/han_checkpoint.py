@@ -0,0 +1,111 @@
+"""
+
+Crash-safe checkpoints for state that must survive a restart, e.g. the
+flowmeter totalizer.
+
+A checkpoint is a snapshot plus a journal:
+
+    <path>.snapshot     pickled state, replaced atomically (write a temporary
+                        file, fsync, rename over the old one), so it is always
+                        either the old or the new state, never half of one
+    <path>.journal      8 byte records of a counter (e.g. totalizer tenths of a
+                        gallon) appended as it changes, and started afresh with
+                        each snapshot
+
+The owner calls count() on every change, which is one small unbuffered
+write, and snapshot() every SNAPSHOT_INTERVAL seconds. snapshot() restarts
+the journal with the current count and hands the state to a writer thread,
+so the caller never waits for the disk. restore() returns the snapshot
+state and the higher of the snapshot's count and the journal's last
+count, in a few milliseconds.
+
+The journal survives a crash or restart of the service. A power cut can
+lose the journal writes the kernel had not yet written out, so after one
+the count can go back as far as the last snapshot.
+
+"""
+
+import os
+import pickle
+import struct
+import threading
+import time
+
+SNAPSHOT_INTERVAL = 60          # seconds between snapshots
+JOURNAL_RECORD    = struct.Struct("<Q")
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.snapshot_path = path + ".snapshot"
+        self.journal_path  = path + ".journal"
+        self._journal      = None
+        self._pending      = None                   # latest state waiting for the writer thread
+        self._cond         = threading.Condition()
+        self._writer       = None
+        self.last_snapshot = 0.0                    # time.monotonic() of the last snapshot()
+
+    def restore(self):
+        # returns (state or None, count), count is 0 with no checkpoint
+        state = None
+        count = 0
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                (count, state) = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            pass
+        try:
+            with open(self.journal_path, 'rb') as f:
+                data = f.read()
+            n = len(data) // JOURNAL_RECORD.size    # ignore a record torn by a crash
+            if n:
+                count = max(count, JOURNAL_RECORD.unpack_from(data, (n - 1) * JOURNAL_RECORD.size)[0])
+        except OSError:
+            pass
+        self._open_journal(count)
+        return (state, count)
+
+    def _open_journal(self, count):
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_path, 'wb', buffering=0)
+        self._journal.write(JOURNAL_RECORD.pack(count))
+
+    def count(self, count):
+        # record the counter, call on every change
+        self._journal.write(JOURNAL_RECORD.pack(count))
+
+    def due(self):
+        return time.monotonic() - self.last_snapshot >= SNAPSHOT_INTERVAL
+
+    def snapshot(self, count, state):
+        # checkpoint count and state (anything picklable), returns without waiting for the disk
+        self.last_snapshot = time.monotonic()
+        self._open_journal(count)                   # the snapshot covers everything journaled so far
+        with self._cond:
+            self._pending = (count, state)
+            self._cond.notify()
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_snapshots, name="checkpointThread", daemon=True)
+            self._writer.start()
+
+    def _write_snapshots(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                (data, self._pending) = (self._pending, None)
+            tmp = self.snapshot_path + ".tmp"
+            with open(tmp, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snapshot_path)
+            try:
+                fd = os.open(os.path.dirname(os.path.abspath(self.snapshot_path)), os.O_RDONLY)
+                try:
+                    os.fsync(fd)                    # make the rename itself durable
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
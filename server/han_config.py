@@ -0,0 +1,142 @@
+"""
+
+Live reload of a node's tunables.
+
+Tunables are the UPPERCASE class attributes of the node's threads, e.g.
+flowThread.SAMPLE_INTERVAL or fpLightingThread.THROB_INTERVAL, and the
+UPPERCASE constants of the neopixel driver. The threads read them on every
+loop, so a new value takes effect on the thread's next loop, without a
+restart and without dropping samples.
+
+A change set is a JSON object of { target : { name : value } }, e.g.
+
+    { "flowThread" : { "SAMPLE_INTERVAL" : 0.04,
+                       "ZONE_MAP" : { "led" : "D27", "flow_sns" : "D4", ... } } }
+
+A change set is checked as a whole before anything is applied, so a bad
+one changes nothing:
+
+    - the target must be known, targets not running on this node are skipped,
+      so every node can share one file
+    - the name must be an existing UPPERCASE attribute of the target
+    - the value must have the type of the value it replaces, ints and
+      floats are interchangeable and a JSON list replaces a tuple
+    - a number that replaces one that isn't negative can't be negative
+    - the value must pass the target's checks, if it has any, e.g. an
+      interval must be more than 0 or a pin map must name real pins
+
+Each value is replaced with one assignment, so a thread sees either the
+old or the new value, never a mix.
+
+"""
+
+import json
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def load(path):
+    # change set from a JSON file, {} if there is no file
+    try:
+        with open(path, 'r') as f:
+            changes = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        raise ConfigError("%s: %s" % (path, e))
+    if not isinstance(changes, dict):
+        raise ConfigError("%s: expected an object of targets" % path)
+    return changes
+
+def _tuples(value):
+    # JSON has no tuples, convert lists back, e.g. CONFIGURATION's rows
+    return tuple(_tuples(v) for v in value) if isinstance(value, list) else value
+
+def _convert(target, name, old, new):
+    # new converted to old's type, raises ConfigError if it can't be
+    if old is None:
+        return new                          # e.g. CPU_AFFINITY, any value replaces None
+    if isinstance(old, bool) or isinstance(new, bool):
+        if type(old) is type(new):
+            return new
+    elif isinstance(old, (int, float)) and isinstance(new, (int, float)):
+        return float(new) if isinstance(old, float) else new
+    elif isinstance(old, tuple) and isinstance(new, list):
+        return _tuples(new)
+    elif isinstance(new, type(old)):
+        return new
+    raise ConfigError("%s.%s is %s, not %s" % (target, name, type(old).__name__, type(new).__name__))
+
+def positive(value):
+    # check for intervals, rates and sizes
+    if value <= 0:
+        return "must be more than 0"
+
+def in_range(low, high):
+    # check for a number from low to high inclusive
+    def check(value):
+        if not low <= value <= high:
+            return "must be from %s to %s" % (low, high)
+    return check
+
+def pin_map(board, required):
+    # check for a { name : pin } map, e.g. flowThread.ZONE_MAP
+    # required names must be mapped, pins must be board pins if board is loaded
+    def check(value):
+        missing = [name for name in required if name not in value]
+        if missing:
+            return "missing " + ", ".join(missing)
+        for (name, pin) in value.items():
+            if not isinstance(name, str) or not isinstance(pin, str):
+                return "%r : %r is not a name and a pin" % (name, pin)
+            if board is not None and not hasattr(board, pin):
+                return "%s : %s is not a pin" % (name, pin)
+    return check
+
+def _check(target, name, old, new, check):
+    # new converted, raises ConfigError if it isn't an acceptable value
+    value = _convert(target, name, old, new)
+    if isinstance(old, (int, float)) and not isinstance(old, bool) and old >= 0 and value < 0:
+        raise ConfigError("%s.%s can't be negative" % (target, name))
+    problem = check(value) if check is not None else None
+    if problem:
+        raise ConfigError("%s.%s %s" % (target, name, problem))
+    return value
+
+def apply(targets, changes, checks={}):
+    # targets is { name : class or module, None if not running on this node }
+    # checks is { target : { name : check } }, a check returns what's wrong with a value, or None
+    # returns { target : [names applied] }, raises ConfigError with every problem found
+    if not isinstance(changes, dict):
+        raise ConfigError("expected an object of targets, not %s" % type(changes).__name__)
+    errors  = []
+    updates = []
+    for (target, values) in changes.items():
+        if target not in targets:
+            errors.append("unknown target %s" % target)
+            continue
+        if not isinstance(values, dict):
+            errors.append("%s: expected an object of names" % target)
+            continue
+        obj = targets[target]
+        if obj is None:
+            continue                        # not on this node
+        for (name, value) in values.items():
+            if not isinstance(name, str) or not name.isupper() or not hasattr(obj, name):
+                errors.append("%s has no tunable %s" % (target, name))
+                continue
+            check = checks.get(target, {}).get(name)
+            try:
+                updates.append((target, obj, name, _check(target, name, getattr(obj, name), value, check)))
+            except ConfigError as e:
+                errors.append(str(e))
+    if errors:
+        raise ConfigError("; ".join(errors))
+
+    applied = {}
+    for (target, obj, name, value) in updates:
+        setattr(obj, name, value)
+        applied.setdefault(target, []).append(name)
+    return applied
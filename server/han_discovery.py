@@ -0,0 +1,197 @@
+"""
+
+Node discovery and cached address resolution.
+
+Every node announces its host name, node type, server port and the
+message types it handles in a UDP multicast datagram every
+ANNOUNCE_INTERVAL seconds, and immediately when it sees a probe from a
+newly started listener. Listeners keep a directory of the announcements.
+
+resolve(host) returns (address, port) from the directory, so a connect
+doesn't need an mDNS/DNS lookup. A host that has not announced is looked
+up once by name and the result cached for DNS_TTL seconds. Callers
+report failed connects with mark_failed() so the next resolve looks the
+address up again. The entry keeps what the node announced, its node
+type, port and message types, only the address is replaced.
+
+Datagrams that aren't a well formed PROBE or ANNOUNCE are logged and
+ignored.
+
+One directory per process, started with start() on a node or
+start_listener() on a client that doesn't announce.
+
+"""
+
+import logging
+import pickle
+import socket
+import struct
+import threading
+import time
+
+DISCOVERY_GROUP   = "239.255.64.45"     # same group as the event bus, different port
+DISCOVERY_PORT    = 6448
+ANNOUNCE_INTERVAL = 10                  # seconds between announcements
+ENTRY_TTL         = 3 * ANNOUNCE_INTERVAL   # entry expires after 3 missed announcements
+DNS_TTL           = 300                 # seconds to cache a name lookup for a silent host
+
+log = logging.getLogger('han.discovery')
+
+
+class NodeEntry:
+    __slots__ = ('host', 'address', 'port', 'node_type', 'msg_types', 'last_seen', 'expires', 'failures')
+
+    def __init__(self, host, address, port, node_type, msg_types, ttl):
+        self.host      = host
+        self.address   = address
+        self.port      = port
+        self.node_type = node_type
+        self.msg_types = tuple(msg_types)
+        self.last_seen = time.monotonic()
+        self.expires   = self.last_seen + ttl
+        self.failures  = 0              # consecutive failed connects reported by callers
+
+    def healthy(self):
+        return self.failures == 0 and time.monotonic() < self.expires
+
+
+class Directory:
+    def __init__(self, default_port):
+        self.default_port = default_port
+        self._nodes = {}                # host -> NodeEntry, an announcement replaces the entry
+        self._lock  = threading.Lock()  # writers only
+        self._sock  = None
+        self._announcement = None       # our own announcement, None for listen-only
+
+    # -- lookups, a dictionary read on the fast path
+
+    def resolve(self, host):
+        entry = self._nodes.get(host)
+        if entry is not None and time.monotonic() < entry.expires:
+            return (entry.address, entry.port)
+        # not announced (yet) or marked failed, fall back to a name lookup and cache it
+        try:
+            address = socket.gethostbyname(host)
+        except OSError:
+            if entry is None:
+                raise
+            entry.expires = time.monotonic() + ANNOUNCE_INTERVAL   # keep the last address, look again later
+            return (entry.address, entry.port)
+        with self._lock:
+            if entry is None:
+                self._nodes[host] = entry = NodeEntry(host, address, self.default_port, None, (), DNS_TTL)
+            else:
+                # keep what the node announced and its failure count, only the address is new
+                renewed = NodeEntry(host, address, entry.port, entry.node_type, entry.msg_types, DNS_TTL)
+                renewed.failures = entry.failures
+                self._nodes[host] = entry = renewed
+        return (entry.address, entry.port)
+
+    def mark_failed(self, host):
+        entry = self._nodes.get(host)
+        if entry is not None:
+            entry.failures += 1
+            entry.expires = 0           # look again on the next resolve
+
+    def mark_ok(self, host):
+        entry = self._nodes.get(host)
+        if entry is not None:
+            entry.failures = 0
+
+    def nodes(self):
+        # snapshot of all entries, including expired ones for diagnostics
+        return list(self._nodes.values())
+
+    def hosts_for(self, msg_t):
+        # healthy hosts that announced they handle msg_t
+        return sorted(e.host for e in self._nodes.values() if msg_t in e.msg_types and e.healthy())
+
+    # -- network
+
+    def _open(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        s.bind(('', DISCOVERY_PORT))
+        mreq = struct.pack('4sl', socket.inet_aton(DISCOVERY_GROUP), socket.INADDR_ANY)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self._sock = s
+
+    def _send(self, msg):
+        self._sock.sendto(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL), (DISCOVERY_GROUP, DISCOVERY_PORT))
+
+    def _listen(self):
+        while True:
+            try:
+                (data, (address, src_port)) = self._sock.recvfrom(4096)
+            except OSError as e:
+                log.warning("Discovery receive failed: %s", e)
+                time.sleep(1.0)
+                continue
+            try:
+                msg = pickle.loads(data)
+                kind = msg[0]
+                if kind == "ANNOUNCE":
+                    (kind, host, node_type, port, msg_types) = msg
+                    if not isinstance(host, str) or not isinstance(port, int):
+                        raise TypeError("host %r port %r" % (host, port))
+                    entry = NodeEntry(host, address, port, node_type, msg_types, ENTRY_TTL)
+                    with self._lock:
+                        self._nodes[host] = entry
+                elif kind == "PROBE" and self._announcement is not None:
+                    self._send(self._announcement)
+            except Exception as e:
+                # not ours, or from a node running another version
+                log.warning("Discovery datagram from %s ignored: %s", address, e)
+
+    def _announce(self):
+        while True:
+            try:
+                self._send(self._announcement)
+            except OSError:
+                pass        # network not up yet, try again next interval
+            time.sleep(ANNOUNCE_INTERVAL)
+
+    def start(self, host=None, node_type=None, port=None, msg_types=()):
+        # start listening, and announcing if host is given
+        self._open()
+        threading.Thread(target=self._listen, name="discoveryThread", daemon=True).start()
+        if host is not None:
+            self._announcement = ("ANNOUNCE", host, node_type, port, tuple(msg_types))
+            threading.Thread(target=self._announce, name="announceThread", daemon=True).start()
+        try:
+            self._send(("PROBE", ))     # ask everyone to announce now
+        except OSError:
+            pass
+
+
+# the process-wide directory
+directory = None
+
+def start(host, node_type, port, msg_types):
+    # announce this node and listen for others
+    global directory
+    directory = Directory(port)
+    directory.start(host, node_type, port, msg_types)
+    return directory
+
+def start_listener(default_port):
+    # listen only, for clients
+    global directory
+    directory = Directory(default_port)
+    directory.start()
+    return directory
+
+def resolve(host, default_port=None):
+    # (address, port) of host, by name lookup if discovery was not started
+    if directory is None:
+        return (host, default_port)
+    return directory.resolve(host)
+
+def mark_failed(host):
+    if directory is not None:
+        directory.mark_failed(host)
+
+def mark_ok(host):
+    if directory is not None:
+        directory.mark_ok(host)
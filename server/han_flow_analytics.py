@@ -0,0 +1,255 @@
+"""
+
+Leak and anomaly detection for the flowmeter.
+
+FlowAnalytics is fed every flow sample with the zones that are on, and
+returns the alerts that sample raised. Each sample costs O(1) time and
+memory, so it runs inside the sampling loop.
+
+    leak        water flowing for NO_ZONE_SECONDS with no zone on, or a slow
+                leak: SLOW_LEAK_GALLONS through the meter within SLOW_LEAK_SECONDS
+                with no zone on. Pulses minutes apart are below MIN_GPM and
+                flowThread reports them as 0 gpm, so these are counted from the
+                totalizer.
+    overlap     more than one zone on at once
+    zone_high   a zone's flow is well above its baseline, e.g. a broken head
+    zone_low    a zone's flow is well below its baseline, e.g. a clogged zone
+
+A zone's baseline is the mean and variance (Welford's online algorithm)
+of the average flow of its past runs. Only complete, unflagged runs
+without an overlap are learned, so a broken head doesn't become the new
+normal. A zone is checked once it has MIN_RUNS runs behind it.
+
+Alerts are dicts, e.g.
+
+    { 'alert' : 'zone_high', 'time' : t, 'zone' : 'zone_3', 'gpm' : 9.8, 'baseline' : 6.1 }
+
+Run this module with a flow log (flow_log.txt) to replay it through the
+detector, or without arguments to replay a synthetic trace.
+
+"""
+
+import math
+from collections import deque
+
+MIN_GPM         = 0.35      # flow below this is no flow, same as flowThread.MIN_FLOW_RATE
+NO_ZONE_SECONDS = 60        # flow with no zone on for this long is a leak, allows for pipes draining
+SLOW_LEAK_GALLONS = 0.3     # this much water with no zone on, after the pipes drain, ...
+SLOW_LEAK_SECONDS = 3600    # ... within this long is a slow leak, e.g. a dripping valve
+TRICKLE_BUCKET  = 60        # seconds of totalizer increases summed together, bounds the slow leak window's memory
+SETTLE_SECONDS  = 60        # ignore the start of a run while the pump and lines come up to pressure
+CHECK_SECONDS   = 120       # settled flow averaged over this long before comparing with the baseline
+MIN_RUNS        = 3         # runs of a zone to learn before it is checked
+DEVIATION_SIGMA = 3.0       # a run deviates beyond this many standard deviations ...
+DEVIATION_FLOOR = 0.15      # ... and beyond this fraction of the baseline
+
+
+class Baseline:
+    # running mean and variance, Welford's algorithm
+    __slots__ = ('n', 'mean', 'm2')
+
+    def __init__(self):
+        self.n    = 0
+        self.mean = 0.0
+        self.m2   = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def std(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+
+class _Run:
+    # the zone currently on
+    __slots__ = ('zone', 'start', 'settled_gallons', 'last', 'checked', 'flagged', 'overlap')
+
+    def __init__(self, zone, start):
+        self.zone            = zone
+        self.start           = start
+        self.settled_gallons = None     # (t, totalizer) when the run settled
+        self.last            = None     # (t, totalizer) of the run's latest sample
+        self.checked         = False
+        self.flagged         = False
+        self.overlap         = False
+
+
+class FlowAnalytics:
+    def __init__(self):
+        self.baselines     = {}         # zone -> Baseline of run average gpm
+        self._run          = None
+        self._no_zone_flow = None       # time flow with no zone on was first seen
+        self._no_zone      = None       # time the last zone went off
+        self._trickle      = deque()    # [t, tenths] totalizer increases with no zone on, one per TRICKLE_BUCKET
+        self._trickle_total = 0         # tenths of a gallon in _trickle
+        self._last_gallons = None
+        self._leaking      = False
+        self._overlapping  = False
+
+    def state(self):
+        # learned baselines, picklable, for a checkpoint
+        return { zone : (b.n, b.mean, b.m2) for (zone, b) in self.baselines.items() }
+
+    def restore(self, state):
+        for (zone, (n, mean, m2)) in state.items():
+            b = self.baselines[zone] = Baseline()
+            (b.n, b.mean, b.m2) = (n, mean, m2)
+
+    def feed(self, t, gpm, gallons, zones):
+        # t in seconds, gallons the totalizer, zones the names of the zones on
+        # returns a list of alerts, usually empty
+        alerts = []
+
+        # more than one zone on
+        if len(zones) > 1:
+            if not self._overlapping:
+                alerts.append({ 'alert' : 'overlap', 'time' : t, 'zones' : list(zones), 'gpm' : gpm })
+                self._overlapping = True
+            if self._run is not None:
+                self._run.overlap = True
+        else:
+            self._overlapping = False
+
+        # flow with no zone on, at a measurable rate or a trickle of pulses
+        if zones:
+            self._no_zone_flow = None
+            self._no_zone = None
+            self._trickle.clear()
+            self._trickle_total = 0
+            self._leaking = False
+        else:
+            if self._no_zone is None:
+                self._no_zone = t
+            if gpm < MIN_GPM:
+                self._no_zone_flow = None
+            elif self._no_zone_flow is None:
+                self._no_zone_flow = t
+            if (self._last_gallons is not None and gallons > self._last_gallons
+                    and t - self._no_zone >= NO_ZONE_SECONDS):
+                tenths = round(10 * (gallons - self._last_gallons))
+                if self._trickle and t - self._trickle[-1][0] < TRICKLE_BUCKET:
+                    self._trickle[-1][1] += tenths
+                else:
+                    self._trickle.append([t, tenths])
+                self._trickle_total += tenths
+            while self._trickle and t - self._trickle[0][0] > SLOW_LEAK_SECONDS:
+                self._trickle_total -= self._trickle.popleft()[1]
+            trickle = self._trickle_total / 10
+            if self._leaking:
+                self._leaking = self._no_zone_flow is not None or bool(self._trickle)
+            elif self._no_zone_flow is not None and t - self._no_zone_flow >= NO_ZONE_SECONDS:
+                alerts.append({ 'alert' : 'leak', 'time' : t, 'gpm' : gpm, 'since' : self._no_zone_flow })
+                self._leaking = True
+            elif trickle >= SLOW_LEAK_GALLONS - 1e-6:
+                alerts.append({ 'alert' : 'leak', 'time' : t, 'gpm' : gpm, 'since' : self._trickle[0][0],
+                                'gallons' : round(trickle, 1) })
+                self._leaking = True
+        self._last_gallons = gallons
+
+        # zone runs, a run ends when its zone goes off or another zone takes over
+        zone = zones[0] if zones else None
+        run = self._run
+        if run is not None and run.zone != zone:
+            self._end_run(run)
+            run = self._run = None
+        if run is None and zone is not None:
+            run = self._run = _Run(zone, t)
+        if run is not None:
+            run.last = (t, gallons)
+            self._check_run(run, t, gallons, alerts)
+
+        return alerts
+
+    def _check_run(self, run, t, gallons, alerts):
+        elapsed = t - run.start
+        if elapsed < SETTLE_SECONDS:
+            return
+        if run.settled_gallons is None:
+            run.settled_gallons = (t, gallons)
+            return
+        if run.checked or elapsed < SETTLE_SECONDS + CHECK_SECONDS:
+            return
+        run.checked = True
+        baseline = self.baselines.get(run.zone)
+        if baseline is None or baseline.n < MIN_RUNS or run.overlap:
+            return
+        gpm = self._average(run, t, gallons)
+        tolerance = max(DEVIATION_SIGMA * baseline.std(), DEVIATION_FLOOR * baseline.mean)
+        if abs(gpm - baseline.mean) > tolerance:
+            run.flagged = True
+            alerts.append({ 'alert' : 'zone_high' if gpm > baseline.mean else 'zone_low', 'time' : t,
+                            'zone' : run.zone, 'gpm' : round(gpm, 2), 'baseline' : round(baseline.mean, 2) })
+
+    def _end_run(self, run):
+        # learn the run if it was long enough to be checked and nothing was wrong with it
+        if run.flagged or run.overlap or run.settled_gallons is None:
+            return
+        (t, gallons) = run.last
+        if t - run.start < SETTLE_SECONDS + CHECK_SECONDS:
+            return
+        self.baselines.setdefault(run.zone, Baseline()).add(self._average(run, t, gallons))
+
+    @staticmethod
+    def _average(run, t, gallons):
+        (t_settled, g_settled) = run.settled_gallons
+        return 60.0 * (gallons - g_settled) / (t - t_settled)
+
+
+def replay(trace, analytics=None):
+    # feed a trace of (t, gpm, gallons, zones) samples, returns all alerts raised
+    analytics = FlowAnalytics() if analytics is None else analytics
+    alerts = []
+    for (t, gpm, gallons, zones) in trace:
+        alerts.extend(analytics.feed(t, gpm, gallons, zones))
+    return alerts
+
+def flow_log_trace(path):
+    # trace from flowThread's per-minute log, records are only written while water flows
+    import han_history
+    for (t, gpm, gallons, zone) in han_history.iter_log(path, 0, float('inf'), han_history.parse_flow):
+        yield (t, gpm, gallons, () if zone == "Off" else (zone, ))
+
+def synthetic_trace(days=5, step=10.0):
+    # a zone_1 run and a zone_2 run every day, a controller fault turning on two zones on
+    # day 2, a stuck valve on day 3, a broken head on day 4 and a dripping valve on day 5
+    t = 0.0
+    gallons = 0.0
+    for day in range(days):
+        t = day * 86400.0
+        for (zone, gpm, minutes) in (("zone_1", 6.0, 10), ("zone_2", 4.0, 10)):
+            if day == 3 and zone == "zone_2":
+                gpm = 9.5                           # broken head
+            for i in range(int(minutes * 60 / step)):
+                gallons += gpm * step / 60
+                yield (t, gpm, gallons, (zone, ))
+                t += step
+        yield (t, 0.0, gallons, ())
+        if day == 1:                                # two zones on at once
+            for i in range(int(60 / step)):
+                gallons += 8.0 * step / 60
+                yield (t, 8.0, gallons, ("zone_5", "zone_6"))
+                t += step
+            yield (t, 0.0, gallons, ())
+        if day == 2:                                # valve stuck open after the schedule
+            for i in range(int(300 / step)):
+                gallons += 1.5 * step / 60
+                yield (t, 1.5, gallons, ())
+                t += step
+        if day == 4:                                # a pulse every 2 minutes, reported as 0 gpm
+            for i in range(int(1800 / step)):
+                if i % int(120 / step) == 0:
+                    gallons += 0.1
+                yield (t, 0.0, gallons, ())
+                t += step
+        yield (t, 0.0, gallons, ())
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    trace = flow_log_trace(sys.argv[1]) if len(sys.argv) > 1 else synthetic_trace()
+    for alert in replay(trace):
+        print(time.strftime("%m/%d/%Y %H:%M", time.localtime(alert['time'])), alert)
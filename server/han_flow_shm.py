@@ -0,0 +1,168 @@
+"""
+
+Shared memory flow record for running the flow sampler in its own process.
+
+The flow sampler publishes (gpm, gallons, zone) into a small record in
+multiprocessing.shared_memory. The record is protected by a sequence
+counter (seqlock): the single writer makes the counter odd, writes the
+payload, then makes it even again. Readers retry if the counter was odd
+or changed while they were copying the payload. Readers never block the
+writer and no IPC round trip is needed for a FLOW_QUERY.
+
+A writer that dies mid-publish leaves the counter odd. A reader gives up
+after READ_RETRIES and returns the last record it read, so a FLOW_QUERY
+can't spin forever. A restarted writer carries on from the counter in the
+record, rounded up to even, so the counter never goes back to a value a
+reader has already seen.
+
+Zones are stored as an index into the zone name tuple given when the
+record is created, so the record is fixed size.
+
+Run this module directly to compare sampling jitter of a thread and a
+separate process while the parent process is under synthetic GIL load.
+
+"""
+
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+_SEQ     = struct.Struct('<Q')          # sequence counter, even = stable
+_PAYLOAD = struct.Struct('<ddi')        # gpm, gallons, zone index
+_SIZE    = _SEQ.size + _PAYLOAD.size
+
+READ_RETRIES = 10000                    # a publish takes microseconds, a writer this slow is dead
+
+
+class FlowRecord:
+    def __init__(self, zones, name=None):
+        # zones is a tuple of zone names, index 0 is the 'no zone' value
+        # name=None creates a new record, otherwise attach to an existing one
+        self.zones = tuple(zones)
+        self._zone_index = { z : i for (i, z) in enumerate(self.zones) }
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=_SIZE)
+            self.shm.buf[:_SIZE] = bytes(_SIZE)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        (seq, ) = _SEQ.unpack_from(self.shm.buf, 0)
+        self._seq = seq + (seq & 1)         # even, and never below what readers have seen
+        self._last = (0.0, 0.0, self.zones[0])
+        self.retries = 0                    # reader retries, for diagnostics
+        self.stale = 0                      # reads that gave up and returned the last record
+
+    def publish(self, gpm, gallons, zone):
+        # single writer only
+        buf = self.shm.buf
+        self._seq += 1
+        _SEQ.pack_into(buf, 0, self._seq)   # odd, write in progress
+        _PAYLOAD.pack_into(buf, _SEQ.size, gpm, gallons, self._zone_index.get(zone, 0))
+        self._seq += 1
+        _SEQ.pack_into(buf, 0, self._seq)   # even, record stable
+
+    def read(self):
+        buf = self.shm.buf
+        for i in range(READ_RETRIES):
+            (seq1, ) = _SEQ.unpack_from(buf, 0)
+            if not seq1 & 1:
+                (gpm, gallons, zone) = _PAYLOAD.unpack_from(buf, _SEQ.size)
+                (seq2, ) = _SEQ.unpack_from(buf, 0)
+                if seq1 == seq2:
+                    self._last = (gpm, gallons, self.zones[zone])
+                    return self._last
+            self.retries += 1
+        self.stale += 1                     # writer died mid-publish
+        return self._last
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def set_realtime(priority=0, cpus=None):
+    # optionally give the calling process SCHED_FIFO priority and pin it to cpus
+    # returns a list of error strings, empty if everything was applied
+    errors = []
+    if priority:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (AttributeError, OSError) as e:
+            errors.append("SCHED_FIFO priority %d not set: %s" % (priority, e))
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (AttributeError, OSError) as e:
+            errors.append("CPU affinity %s not set: %s" % (cpus, e))
+    return errors
+
+
+#
+# jitter comparison, thread vs process, under synthetic GIL load
+#
+
+def _sampler(interval, n, out):
+    # sleep-paced loop like flowThread, records how late each wakeup was
+    due = time.monotonic()
+    for i in range(n):
+        due += interval
+        time.sleep(max(0.0, due - time.monotonic()))
+        out[i] = time.monotonic() - due
+
+def _process_sampler(interval, n, shm_name):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    out = shm.buf.cast('d')
+    _sampler(interval, n, out)
+    out.release()
+    shm.close()
+
+def _gil_load(stop):
+    # mixture of long C calls holding the GIL and pure python work
+    import pickle
+    blob = pickle.dumps([list(range(1000)) for i in range(200)])
+    while not stop.is_set():
+        pickle.loads(blob)
+        sum(i * i for i in range(20000))
+
+def _jitter_report(name, late):
+    late = sorted(late)
+    n = len(late)
+    print("%-8s p50 %6.2f ms  p99 %6.2f ms  max %6.2f ms  > half interval: %d" %
+          (name, 1000 * late[n // 2], 1000 * late[int(n * 0.99)], 1000 * late[-1],
+           sum(1 for x in late if x > 0.025)))
+
+def _benchmark(interval=0.050, n=200, n_load=3):
+    import threading
+    import multiprocessing
+
+    stop = threading.Event()
+    load = [threading.Thread(target=_gil_load, args=(stop,), daemon=True) for i in range(n_load)]
+    for t in load:
+        t.start()
+
+    print("sampling every %d ms, %d samples, %d GIL load threads" % (1000 * interval, n, n_load))
+
+    late = [0.0] * n
+    t = threading.Thread(target=_sampler, args=(interval, n, late))
+    t.start()
+    t.join()
+    _jitter_report("thread", late)
+
+    shm = shared_memory.SharedMemory(create=True, size=8 * n)
+    p = multiprocessing.Process(target=_process_sampler, args=(interval, n, shm.name))
+    p.start()
+    p.join()
+    out = shm.buf.cast('d')
+    _jitter_report("process", list(out))
+    out.release()
+    shm.close()
+    shm.unlink()
+
+    stop.set()
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,259 @@
+"""
+
+History of the per-minute VI and flow records, for graphs on the mirror.
+
+Nodes answer ("VI_HISTORY", start, end) and ("FLOW_HISTORY", start, end)
+from their rotating log files (start and end in seconds since the epoch,
+end exclusive) with records in time order:
+
+    VI_HISTORY   -> (t, vin, cur), ...
+    FLOW_HISTORY -> (t, gpm, gallons, zone), ...
+
+A week of history is too big to send as one pickle, so the reply is a
+stream of frames, each a 4 byte big-endian length and a pickled list of at
+most CHUNK_RECORDS records, ending with a zero length frame. A busy node
+answers with a single BUSY frame instead (see han_admission). The node
+reads the logs lazily as it sends, and the receiver decodes each frame
+from one preallocated buffer, so memory on both ends stays flat however
+long the range is.
+
+The mirror asks every node for a range at once, merges the sorted replies
+by time with a k-way heap merge, and keeps finished ranges in an LRU cache
+so asking for the same range again costs the nodes nothing. A range that
+reaches into the current minute is still growing and is never cached.
+
+"""
+
+import heapq
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import han_metrics as hm
+import han_discovery
+import han_admission
+
+STAMP_FORMAT  = "%m/%d/%Y %H:%M"     # record time stamp written by viThread and flowThread
+DEFAULT_RANGE = 24 * 60 * 60         # seconds, when a query gives no start
+CACHE_ENTRIES = 64                   # (node, series, range) replies kept by the mirror
+CHUNK_RECORDS = 512                  # records per frame, about 16K pickled
+RECV_BUFFER   = 64 * 1024            # receive buffer, grown only for an oversized frame
+
+FRAME_HEADER  = struct.Struct(">I")
+
+
+#
+# node side, read records from the log files
+#
+
+def log_files(path):
+    # the log and its RotatingFileHandler backups, oldest first
+    files = []
+    n = 1
+    while os.path.exists("%s.%d" % (path, n)):
+        files.insert(0, "%s.%d" % (path, n))
+        n += 1
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+def parse_vi(fields):
+    return (float(fields[0]), float(fields[1]))
+
+def parse_flow(fields):
+    return (float(fields[0]), float(fields[1]), fields[2] if len(fields) > 2 else "Off")
+
+def iter_log(path, start, end, parse):
+    # generates (t, values...) for records in start <= t < end, oldest first
+    # a log line is "<logging prefix> MM/DD/YYYY HH:MM\t<value>\t<value>..."
+    for name in log_files(path):
+        try:
+            if os.path.getmtime(name) < start:
+                continue                    # last written before the range starts
+            with open(name, 'r') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    try:
+                        t = time.mktime(time.strptime(fields[0][-16:], STAMP_FORMAT))
+                        record = (t, ) + parse(fields[1:])
+                    except (ValueError, IndexError):
+                        continue            # not a record, e.g. a startup message
+                    if t >= end:
+                        return              # records are appended in time order
+                    if t >= start:
+                        yield record
+        except OSError:
+            continue                        # rotated away while reading
+
+def time_range(msg, now=None):
+    # (start, end) from a (HISTORY, [start], [end]) message
+    now = time.time() if now is None else now
+    end = msg[2] if len(msg) > 2 and msg[2] is not None else now
+    start = msg[1] if len(msg) > 1 and msg[1] is not None else end - DEFAULT_RANGE
+    return (float(start), float(end))
+
+def send_chunked(sock, records, chunk_records=CHUNK_RECORDS):
+    # send the records iterable as frames, pulling only one frame's worth at a time
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == chunk_records:
+            _send_frame(sock, batch)
+            batch = []
+    if batch:
+        _send_frame(sock, batch)
+    sock.sendall(FRAME_HEADER.pack(0))
+
+def send_busy(sock):
+    # the reply to a shed history request, received as han_admission.Busy
+    _send_frame(sock, han_admission.BUSY)
+
+def _send_frame(sock, batch):
+    data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+#
+# mirror side, receive and merge node replies and cache finished ranges
+#
+
+def _recv_exactly(sock, view, n):
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:n])
+        if k == 0:
+            raise ConnectionError("history reply ended after %d of %d bytes" % (got, n))
+        got += k
+
+def recv_chunked(sock):
+    # generates the records of a chunked reply, decoding frames in place
+    buf  = bytearray(RECV_BUFFER)
+    view = memoryview(buf)
+    while True:
+        _recv_exactly(sock, view, FRAME_HEADER.size)
+        (n, ) = FRAME_HEADER.unpack_from(buf)
+        if n == 0:
+            return
+        if n > len(buf):
+            view.release()
+            buf  = bytearray(n)
+            view = memoryview(buf)
+        _recv_exactly(sock, view, n)
+        batch = pickle.loads(view[:n])
+        if batch == han_admission.BUSY:
+            raise han_admission.Busy("history request shed")
+        yield from batch
+
+def query(host, msg, port, timeout):
+    # send a history message to host and generate the records of its reply
+    s = socket.create_connection(han_discovery.resolve(host, port), timeout=timeout)
+    try:
+        s.sendall(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+        s.shutdown(socket.SHUT_WR)
+        yield from recv_chunked(s)
+    finally:
+        s.close()
+
+def merge(replies):
+    # replies is { node : [(t, values...)] each sorted by t }
+    # returns an iterator of (t, node, values...) in time order
+    def tagged(node, records):
+        for r in records:
+            yield (r[0], node) + tuple(r[1:])
+    return heapq.merge(*[tagged(node, records) for (node, records) in replies.items()], key=lambda r: r[0])
+
+
+class HistoryCache:
+    # LRU of node replies keyed by (node, series, start, end)
+    def __init__(self, entries=CACHE_ENTRIES):
+        self.entries = entries
+        self._cache  = OrderedDict()
+        self._lock   = threading.Lock()
+        self.hits    = hm.counter("han_history_cache_total", result="hit")
+        self.misses  = hm.counter("han_history_cache_total", result="miss")
+
+    @staticmethod
+    def finished(end, now=None):
+        # a range is finished once the minute containing its end has been logged
+        now = time.time() if now is None else now
+        return end <= now - 60
+
+    def get(self, key):
+        with self._lock:
+            records = self._cache.get(key)
+            if records is None:
+                self.misses.inc()
+                return None
+            self._cache.move_to_end(key)
+        self.hits.inc()
+        return records
+
+    def put(self, key, records):
+        if not self.finished(key[3]):
+            return
+        with self._lock:
+            self._cache[key] = records
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.entries:
+                self._cache.popitem(last=False)
+
+
+#
+# memory use of one pickled reply vs. a chunked reply for a large range
+#
+
+def _benchmark(days=7):
+    import tempfile
+    import tracemalloc
+
+    path = os.path.join(tempfile.mkdtemp(), "vi_log.txt")
+    t0 = time.time() - days * 24 * 60 * 60
+    with open(path, 'w') as f:
+        for i in range(days * 24 * 60):
+            stamp = time.strftime(STAMP_FORMAT, time.localtime(t0 + 60 * i))
+            f.write("01/01/2024 00:00:00  fencepost-back-1 INFO %s\t%.1f\t%d\n" % (stamp, 12.0 + i % 10 / 10, 200 + i % 50))
+    (start, end) = (t0 - 60, time.time())
+
+    def one_pickle(node):
+        node.sendall(pickle.dumps(list(iter_log(path, start, end, parse_vi)), pickle.HIGHEST_PROTOCOL))
+        node.close()
+
+    def one_pickle_receiver(mirror):
+        buf = b''
+        while True:
+            data = mirror.recv(4096)
+            if not data:
+                break
+            buf += data
+        return sum(1 for r in pickle.loads(buf))
+
+    def chunked(node):
+        send_chunked(node, iter_log(path, start, end, parse_vi))
+        node.close()
+
+    def chunked_receiver(mirror):
+        return sum(1 for r in recv_chunked(mirror))
+
+    print("%d days of minute records, %d KB of log" % (days, os.path.getsize(path) // 1024))
+    for (name, sender, receiver) in (("one pickle", one_pickle, one_pickle_receiver),
+                                     ("chunked", chunked, chunked_receiver)):
+        (node, mirror) = socket.socketpair()
+        tracemalloc.start()
+        t_start = time.perf_counter()
+        t = threading.Thread(target=sender, args=(node, ))
+        t.start()
+        n = receiver(mirror)
+        t.join()
+        elapsed = time.perf_counter() - t_start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        mirror.close()
+        print("%-10s %6d records %7.0f ms  peak %6d KB" % (name, n, 1000 * elapsed, peak // 1024))
+
+
+if __name__ == "__main__":
+    _benchmark()
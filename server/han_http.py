@@ -0,0 +1,261 @@
+"""
+
+Threaded HTTP/1.1 server for the magicmirror Javascript API.
+
+Each connection is handled on its own thread, so one slow upstream
+request doesn't hold up the others. Responses always carry Content-Type
+and Content-Length so browsers can keep connections alive, and large
+bodies are gzip compressed when the client accepts it.
+
+Requests are routed by path. A route is a function taking the parsed
+query string ({name : [values]}) and returning (status, content type,
+body), where body is bytes, str, or anything json.dumps() accepts.
+
+Server-sent event streams are routed to an EventBroadcaster. One producer
+publishes, every connected browser gets a copy through its own bounded
+queue, and a browser that falls QUEUE_DEPTH events behind is dropped so
+it can't hold up the producer or the other browsers.
+
+Run this module directly for a load test against a local fake upstream.
+
+"""
+
+import gzip
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+GZIP_MIN_BYTES = 1024       # don't compress bodies smaller than this
+KEEPALIVE_IDLE = 30         # seconds an idle persistent connection is kept open
+SSE_HEARTBEAT  = 15         # seconds between keepalive comments on an idle event stream
+QUEUE_DEPTH    = 64         # events a slow event stream client may fall behind
+
+
+class _Subscriber:
+    __slots__ = ('q', 'dropped')
+
+    def __init__(self):
+        self.q = queue.Queue(QUEUE_DEPTH)
+        self.dropped = False
+
+
+class EventBroadcaster:
+    # fans events from any producer thread out to every event stream client
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.dropped = 0            # slow clients disconnected
+
+    def publish(self, event, data):
+        # never blocks, data is anything json.dumps() accepts
+        frame = ("event: %s\ndata: %s\n\n" % (event, json.dumps(data))).encode("utf8")
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            try:
+                sub.q.put_nowait(frame)
+            except queue.Full:
+                sub.dropped = True
+                self.unsubscribe(sub)
+                self.dropped += 1
+
+    def subscribe(self):
+        sub = _Subscriber()
+        with self._lock:
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def clients(self):
+        return len(self._subscribers)
+
+
+class HanHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RouteRequestHandler(BaseHTTPRequestHandler):
+    # CORS-aware, routes GET requests by path
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_IDLE
+    routes = {}                     # path -> route function, set by subclasses
+    streams = {}                    # path -> EventBroadcaster, set by subclasses
+
+    def log_message(self, format, *args):
+        pass                        # don't write a line to stderr for every request
+
+    def _send_cors_headers(self):
+        """ Sets headers required for CORS """
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET,POST,OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "x-api-key,Content-Type")
+
+    def send_body(self, status, content_type, body):
+        """ Sends a complete response, compressed if worthwhile """
+        if isinstance(body, str):
+            body = body.encode("utf8")
+        elif not isinstance(body, (bytes, bytearray)):
+            body = json.dumps(body).encode("utf8")
+            content_type = content_type or "application/json"
+
+        gzipped = len(body) >= GZIP_MIN_BYTES and "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            body = gzip.compress(body, compresslevel=5)
+
+        self.send_response(status)
+        self._send_cors_headers()
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_dict_response(self, d):
+        """ Sends a dictionary (JSON) back to the client """
+        self.send_body(200, "application/json", d)
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self._send_cors_headers()
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_event_stream(self, broadcaster):
+        """ Streams server-sent events until the client goes away or falls behind """
+        self.send_response(200)
+        self._send_cors_headers()
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.close_connection = True    # no Content-Length, the stream ends with the connection
+
+        sub = broadcaster.subscribe()
+        try:
+            self.wfile.write(b"retry: 3000\n\n")
+            self.wfile.flush()
+            while not sub.dropped:
+                try:
+                    frame = sub.q.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    frame = b": keepalive\n\n"
+                self.wfile.write(frame)
+                self.wfile.flush()
+        except OSError:
+            pass                        # browser closed the stream
+        finally:
+            broadcaster.unsubscribe(sub)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        stream = self.streams.get(url.path.rstrip('/'))
+        if stream is not None:
+            self.send_event_stream(stream)
+            return
+        route = self.routes.get(url.path.rstrip('/') or '/')
+        if route is None:
+            self.send_body(404, "application/json", { 'error' : "no such path: " + url.path })
+            return
+        try:
+            (status, content_type, body) = route(parse_qs(url.query))
+        except Exception as e:
+            (status, content_type, body) = (502, "application/json", { 'error' : str(e) })
+        self.send_body(status, content_type, body)
+
+
+def serve(address, port, handler):
+    # create the server, caller runs serve_forever()
+    return HanHTTPServer((address, port), handler)
+
+
+#
+# load test, threaded keep-alive server vs. the old single-threaded server
+#
+
+def _fake_upstream(delay):
+    # a slow JSON source, like the Davis unit
+    import time
+    report = json.dumps({ 'data' : { 'conditions' : [ { 'temp' : 60.0 + i, 'hum' : 40.0 } for i in range(200) ] } }).encode()
+
+    class Upstream(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, format, *args):
+            pass
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(report)))
+            self.end_headers()
+            self.wfile.write(report)
+
+    server = HanHTTPServer(('127.0.0.1', 0), Upstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+def _load(port, n_clients, n_requests):
+    # returns (elapsed, sorted latencies)
+    import http.client
+    import time
+    latencies = []
+    lock = threading.Lock()
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        mine = []
+        for i in range(n_requests):
+            t0 = time.perf_counter()
+            conn.request("GET", "/weather", headers={ "Accept-Encoding" : "gzip" })
+            r = conn.getresponse()
+            r.read()
+            if r.getheader("Connection", "").lower() == "close" or r.version == 10:
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            mine.append(time.perf_counter() - t0)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=client) for i in range(n_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (time.perf_counter() - t0, sorted(latencies))
+
+def _benchmark(n_clients=8, n_requests=25, upstream_delay=0.020):
+    import urllib.request
+    upstream = "http://127.0.0.1:%d/" % _fake_upstream(upstream_delay)
+
+    def weather(query):
+        with urllib.request.urlopen(upstream, timeout=5) as r:
+            return (200, "application/json", r.read())
+
+    class Handler(RouteRequestHandler):
+        routes = { '/weather' : weather }
+
+    class OldHandler(Handler):
+        protocol_version = "HTTP/1.0"
+
+    print("%d clients x %d requests, upstream delay %d ms" % (n_clients, n_requests, 1000 * upstream_delay))
+    for (name, server_class, handler) in (("single-threaded HTTP/1.0", HTTPServer, OldHandler),
+                                          ("threaded HTTP/1.1", HanHTTPServer, Handler)):
+        server = server_class(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        (elapsed, late) = _load(server.server_address[1], n_clients, n_requests)
+        server.shutdown()
+        n = len(late)
+        print("%-26s %6.1f req/s  p50 %6.1f ms  p99 %6.1f ms" %
+              (name, n / elapsed, 1000 * late[n // 2], 1000 * late[int(n * 0.99)]))
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,361 @@
+"""
+
+Indexed search of the HAN rotating text logs.
+
+A log record is a line '%(asctime)s host LEVEL message', e.g.
+
+    03/14/2024 06:30:01  flowmeter WARNING Flow alert: {...}
+
+plus any following lines without a time stamp, e.g. a traceback. The data
+logs (davis_log.txt) are '%(asctime)s message' and have no host or level.
+
+Each log file gets a sidecar index. The index splits the log into blocks
+of about BLOCK_SIZE bytes, each starting on a record, and stores:
+
+    offsets     the byte offset of each block
+    times       the time of each block's first record, never decreasing
+    hosts       host -> the blocks with a record from that host
+    levels      level -> the blocks with a record at that level
+
+A query bisects times for the blocks in its range and intersects them
+with the host and level postings. It then reads only those blocks from the
+memory-mapped log.
+
+Indexes live in <log directory>/.logindex/, named by the log's inode.
+RotatingFileHandler renames log.txt to log.txt.1, which keeps the inode,
+so a rotated log keeps its index. Indexing is incremental: each query
+first indexes what was appended since the last one. An index is rebuilt
+when its log was replaced, i.e. its first bytes changed or it got shorter.
+Indexes of logs that rotated away are removed.
+
+    python han_logindex.py [--start T] [--end T] [--host H] [--level L] [--grep TEXT] LOG|DIR ...
+
+T is "MM/DD/YYYY HH:MM[:SS]" or seconds since the epoch, end exclusive.
+--level L matches L and more severe levels. LOG is a log file with its
+rotated .1 .. .3 siblings. DIR means every *_log.txt in it. Every log
+given, e.g. master_log.txt copied from each node, is merged into one
+stream in time order.
+
+    python han_logindex.py benchmark
+
+times a one hour query over a week of logs, by full scan and by index.
+
+"""
+
+import bisect
+import heapq
+import mmap
+import os
+import pickle
+import sys
+import time
+from array import array
+
+import han_history
+
+BLOCK_SIZE    = 4096                # bytes of log per index block
+INDEX_DIR     = ".logindex"         # in the log's directory
+INDEX_VERSION = 1
+HEAD_BYTES    = 64                  # first bytes of a log, to tell a replaced log from a grown one
+LEVELS        = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+STAMP_LEN     = len("MM/DD/YYYY HH:MM:SS")
+
+_minutes = {}                       # "MM/DD/YYYY HH:MM" -> seconds since the epoch
+
+
+def stamp(line):
+    # time of a record's first line, None for a continuation line
+    if len(line) < STAMP_LEN or line[2:3] != b'/' or line[13:14] != b':' or line[16:17] != b':':
+        return None
+    minute = line[:16]
+    t = _minutes.get(minute)
+    if t is None:
+        try:
+            t = time.mktime(time.strptime(minute.decode('ascii'), "%m/%d/%Y %H:%M"))
+        except (ValueError, UnicodeDecodeError):
+            return None
+        if len(_minutes) > 4096:
+            _minutes.clear()
+        _minutes[minute] = t
+    try:
+        return t + int(line[17:19])
+    except ValueError:
+        return None
+
+def host_level(line):
+    # (host, level) of a record's first line, (None, None) for a data log record
+    fields = line[STAMP_LEN:].split(None, 2)
+    if len(fields) >= 2 and fields[1].decode('ascii', 'replace') in LEVELS:
+        return (fields[0].decode('ascii', 'replace'), fields[1].decode('ascii'))
+    return (None, None)
+
+def parse_time(text):
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in ("%m/%d/%Y %H:%M:%S", "%m/%d/%Y %H:%M", "%m/%d/%Y"):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            continue
+    raise ValueError("time is MM/DD/YYYY HH:MM[:SS] or seconds since the epoch: %s" % text)
+
+
+class LogIndex:
+    def __init__(self, inode):
+        self.version = INDEX_VERSION
+        self.inode   = inode
+        self.head    = b''
+        self.size    = 0                # bytes indexed, always ends on a line
+        self.last_t  = 0                # latest record time seen
+        self.offsets = array('I')
+        self.times   = array('I')
+        self.hosts   = {}               # host -> array of block numbers
+        self.levels  = {}               # level -> array of block numbers
+
+    def matches(self, mm, size):
+        # the log is this index's log, possibly grown
+        return self.version == INDEX_VERSION and size >= self.size and mm[:len(self.head)] == self.head
+
+    def update(self, mm, size):
+        # index the whole lines in mm[self.size:size], returns True if anything was added
+        pos = self.size
+        block = len(self.offsets) - 1
+        while pos < size:
+            nl = mm.find(b'\n', pos, size)
+            if nl < 0:
+                break                   # being written
+            line = mm[pos:nl]
+            t = stamp(line)
+            if block < 0 or (t is not None and pos - self.offsets[block] >= BLOCK_SIZE):
+                block += 1              # blocks start on a record, so a block can be read alone
+                self.offsets.append(pos)
+                self.times.append(int(max(t or 0, self.last_t)))
+            if t is not None:
+                self.last_t = max(self.last_t, int(t))
+                (host, level) = host_level(line)
+                if host is not None:
+                    _post(self.hosts, host, block)
+                    _post(self.levels, level, block)
+            pos = nl + 1
+        if pos == self.size:
+            return False
+        self.size = pos
+        if len(self.head) < HEAD_BYTES:
+            self.head = mm[:min(HEAD_BYTES, pos)]
+        return True
+
+    def blocks(self, start, end, hosts=None, levels=None):
+        # the blocks that can hold records in start <= t < end from hosts at levels, in order
+        first = max(0, bisect.bisect_right(self.times, start) - 1)
+        last = bisect.bisect_left(self.times, end)
+        candidates = range(first, last)
+        for (names, postings) in ((hosts, self.hosts), (levels, self.levels)):
+            if names is not None:
+                posted = set()
+                for name in names:
+                    posted.update(postings.get(name, ()))
+                candidates = [b for b in candidates if b in posted]
+        return candidates
+
+    def block_range(self, block):
+        end = self.offsets[block + 1] if block + 1 < len(self.offsets) else self.size
+        return (self.offsets[block], end)
+
+def _post(postings, name, block):
+    blocks = postings.get(name)
+    if blocks is None:
+        blocks = postings[name] = array('I')
+    if not blocks or blocks[-1] != block:
+        blocks.append(block)
+
+
+#
+# sidecar files
+#
+
+def index_path(path, inode):
+    return os.path.join(os.path.dirname(os.path.abspath(path)), INDEX_DIR, "%d.idx" % inode)
+
+def _load(path, inode):
+    try:
+        with open(index_path(path, inode), 'rb') as f:
+            fields = pickle.load(f)
+        if isinstance(fields, dict) and fields.get('inode') == inode:
+            index = LogIndex(inode)
+            index.__dict__.update(fields)
+            return index
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        pass
+    return None
+
+def _save(path, index):
+    # atomically, a query running at the same time reads the old or the new index
+    # a log directory that can't be written, e.g. logs copied off a node read-only, is indexed in memory
+    name = index_path(path, index.inode)
+    try:
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        tmp = "%s.%d.tmp" % (name, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(vars(index), f, pickle.HIGHEST_PROTOCOL)     # a dict, loadable by the command line too
+        os.replace(tmp, name)
+    except OSError:
+        pass
+
+def prune(directory):
+    # remove the indexes of logs that no longer exist
+    index_dir = os.path.join(directory, INDEX_DIR)
+    try:
+        inodes = { os.stat(os.path.join(directory, name)).st_ino for name in os.listdir(directory) }
+        for name in os.listdir(index_dir):
+            if name.endswith(".idx") and int(name[:-4]) not in inodes:
+                os.remove(os.path.join(index_dir, name))
+    except (OSError, ValueError):
+        pass
+
+
+#
+# queries
+#
+
+def search_file(path, start=0, end=float('inf'), hosts=None, levels=None, text=None):
+    # generates (t, host, level, record) for the matching records of one log file, record
+    # is the record's text with its continuation lines
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return                          # rotated away
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            inode = os.fstat(f.fileno()).st_ino
+            index = _load(path, inode)
+            if index is None or not index.matches(mm, size):
+                index = LogIndex(inode)
+            if index.update(mm, size):
+                _save(path, index)
+            needle = text.encode() if text is not None else None
+            for block in index.blocks(start, end, hosts, levels):
+                (b_start, b_end) = index.block_range(block)
+                for (t, host, level, record) in _records(mm, b_start, b_end):
+                    if t >= end:
+                        return          # records are appended in time order
+                    if (t >= start and (hosts is None or host in hosts) and (levels is None or level in levels)
+                            and (needle is None or needle in record)):
+                        yield (t, host, level, record.decode('utf-8', 'replace'))
+
+def _records(mm, pos, end):
+    # (t, host, level, bytes) of the records in mm[pos:end], which starts on a record
+    record = None
+    while pos < end:
+        nl = mm.find(b'\n', pos, end)
+        nl = end if nl < 0 else nl
+        line = mm[pos:nl]
+        t = stamp(line)
+        if t is not None:
+            if record is not None:
+                yield record
+            record = (t, ) + host_level(line) + (line, )
+        elif record is not None:
+            record = record[:3] + (record[3] + b'\n' + line, )
+        pos = nl + 1
+    if record is not None:
+        yield record
+
+def search(log, start=0, end=float('inf'), hosts=None, levels=None, text=None):
+    # matching records of a log and its rotated siblings, oldest first
+    for path in han_history.log_files(log):
+        yield from search_file(path, start, end, hosts, levels, text)
+    prune(os.path.dirname(os.path.abspath(log)))
+
+def merge(streams):
+    # one stream in time order from several, e.g. the same log from each node
+    return heapq.merge(*streams, key=lambda r: r[0])
+
+def expand(paths):
+    # log paths from command line arguments, a directory is every *_log.txt in it
+    logs = []
+    for path in paths:
+        if os.path.isdir(path):
+            logs.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith("_log.txt")))
+        else:
+            logs.append(path)
+    return logs
+
+
+#
+# one hour of warnings from a week of logs, by full scan and by index
+#
+
+def _scan(path, start, end, levels):
+    # what a query costs without an index, for the benchmark
+    with open(path, 'rb') as f:
+        data = f.read()
+    return [r for r in _records(data, 0, len(data)) if start <= r[0] < end and r[2] in levels]
+
+def _benchmark(days=7, interval=2):
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "master_log.txt")
+    t0 = time.time() - days * 24 * 60 * 60
+    with open(path, 'w') as f:
+        for i in range(days * 24 * 60 * 60 // interval):
+            level = "WARNING" if i % 100 == 0 else "INFO"
+            f.write("%s  flowmeter %s record %d\t12.3\t245\n" % (
+                    time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(t0 + i * interval)), level, i))
+    (start, end) = (t0 + 3 * 24 * 60 * 60, t0 + 3 * 24 * 60 * 60 + 60 * 60)
+    levels = ('WARNING', 'ERROR', 'CRITICAL')
+    print("%d days of log, %d MB, one hour of warnings" % (days, os.path.getsize(path) // (1024 * 1024)))
+
+    t = time.perf_counter()
+    n = len(_scan(path, start, end, levels))
+    print("full scan     %5d records %8.1f ms" % (n, 1000 * (time.perf_counter() - t)))
+    for name in ("build index", "indexed"):
+        t = time.perf_counter()
+        n = sum(1 for r in search_file(path, start, end, levels=levels))
+        print("%-13s %5d records %8.1f ms" % (name, n, 1000 * (time.perf_counter() - t)))
+    print("index %d KB" % (os.path.getsize(index_path(path, os.stat(path).st_ino)) // 1024))
+
+
+def main(args):
+    if args[:1] == ["benchmark"]:
+        _benchmark()
+        return 0
+    options = { '--start' : None, '--end' : None, '--host' : None, '--level' : None, '--grep' : None }
+    paths = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in options and args:
+            options[arg] = args.pop(0)
+        else:
+            paths.append(arg)
+    if not paths:
+        print(__doc__)
+        return 2
+    try:
+        start = parse_time(options['--start']) if options['--start'] else 0
+        end = parse_time(options['--end']) if options['--end'] else float('inf')
+    except ValueError as e:
+        print(e)
+        return 2
+    hosts = set(options['--host'].split(',')) if options['--host'] else None
+    levels = None
+    if options['--level']:
+        if options['--level'].upper() not in LEVELS:
+            print("level is one of", ", ".join(LEVELS))
+            return 2
+        levels = set(LEVELS[LEVELS.index(options['--level'].upper()):])
+    streams = [search(log, start, end, hosts, levels, options['--grep']) for log in expand(paths)]
+    try:
+        for (t, host, level, record) in merge(streams):
+            print(record)
+    except BrokenPipeError:
+        pass                            # e.g. piped to head
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,60 @@
+"""
+
+Latest-wins command mailbox.
+
+Commands are posted with a target key. A command replaces any pending
+command for the same target, so a burst of commands for one target
+collapses to the last one, and the number of pending commands is bounded
+by the number of targets. Posting wakes the consumer immediately.
+
+A target of ALL supersedes every pending command, e.g. a DISPLAY that
+restyles the whole string makes pending per-post commands irrelevant.
+
+"""
+
+import threading
+import time
+
+import han_metrics as hm
+
+ALL = "ALL"
+
+
+class CommandMailbox:
+    def __init__(self, name):
+        self._cond    = threading.Condition()
+        self._pending = {}          # target -> (msg, time posted), in posting order
+        self.depth     = hm.gauge("han_mailbox_depth", mailbox=name)
+        self.posted    = hm.counter("han_mailbox_posted_total", mailbox=name)
+        self.coalesced = hm.counter("han_mailbox_coalesced_total", mailbox=name)
+        self.latency   = hm.histogram("han_mailbox_latency_seconds", mailbox=name)
+
+    def put(self, target, msg):
+        with self._cond:
+            if target == ALL:
+                self.coalesced.inc(len(self._pending))
+                self._pending.clear()
+            elif target in self._pending:
+                self.coalesced.inc()
+                del self._pending[target]   # re-insert so order is order of latest post
+            self._pending[target] = (msg, time.perf_counter())
+            self.posted.inc()
+            self.depth.set(len(self._pending))
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        # wait up to timeout for commands, return the pending commands
+        # (oldest first) and empty the mailbox. Returns [] on timeout.
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+            pending = list(self._pending.values())
+            self._pending.clear()
+            self.depth.set(0)
+        now = time.perf_counter()
+        for (msg, posted) in pending:
+            self.latency.observe(now - posted)
+        return [msg for (msg, posted) in pending]
+
+    def qsize(self):
+        return len(self._pending)
@@ -0,0 +1,193 @@
+"""
+
+Low overhead instrumentation for HAN nodes.
+
+Histograms, counters and gauges are kept in preallocated fixed-bucket
+arrays. Recording a sample on a hot path is a bisect and a couple of
+integer/float updates; nothing is allocated after the metric is created.
+
+A metric can be written by several threads at once, e.g. the request
+histograms by the server's worker pools or a TimedLock's wait histogram by
+every thread that takes the lock, so each metric has a lock of its own
+around its update and its snapshot. The lock is held for a few integer
+updates, so it is almost never contended.
+
+A snapshot of every metric on a node is returned by the METRICS message.
+to_prometheus() renders snapshots from one or more nodes in the Prometheus
+text exposition format so the magicmirror can expose the whole fleet.
+
+"""
+
+import bisect
+import threading
+import time
+
+# bucket upper bounds (seconds) for loop and request durations, 100 us .. 10 s
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.010, 0.025,
+                    0.050, 0.100, 0.250, 0.500, 1.0, 2.5, 5.0, 10.0)
+
+# bucket upper bounds (seconds) for lock waits, 1 us .. 100 ms
+LOCK_BUCKETS     = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005,
+                    0.001, 0.005, 0.010, 0.050, 0.100)
+
+
+class Histogram:
+    def __init__(self, name, labels, bounds):
+        self.name   = name
+        self.labels = labels
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)     # last bucket is +Inf
+        self.count  = 0
+        self.sum    = 0.0
+        self.max    = 0.0
+        self._lock  = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum   += value
+            if value > self.max:
+                self.max = value
+
+    def snapshot(self):
+        with self._lock:
+            return { 'name' : self.name, 'labels' : self.labels, 'type' : 'histogram',
+                     'bounds' : self.bounds, 'counts' : tuple(self.counts),
+                     'count' : self.count, 'sum' : self.sum, 'max' : self.max }
+
+
+class Counter:
+    def __init__(self, name, labels):
+        self.name   = name
+        self.labels = labels
+        self.value  = 0
+        self._lock  = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def snapshot(self):
+        return { 'name' : self.name, 'labels' : self.labels, 'type' : 'counter', 'value' : self.value }
+
+
+class Gauge:
+    def __init__(self, name, labels):
+        self.name   = name
+        self.labels = labels
+        self.value  = 0
+        self.max    = 0             # high water mark since startup
+        self._lock  = threading.Lock()
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+            if value > self.max:
+                self.max = value
+
+    def snapshot(self):
+        with self._lock:
+            return { 'name' : self.name, 'labels' : self.labels, 'type' : 'gauge', 'value' : self.value, 'max' : self.max }
+
+
+class TimedLock:
+    # drop-in replacement for threading.Lock that records how long
+    # each acquire waited in a histogram
+    def __init__(self, name):
+        self._lock = threading.Lock()
+        self.wait  = histogram("han_lock_wait_seconds", LOCK_BUCKETS, lock=name)
+
+    def acquire(self, blocking=True, timeout=-1):
+        t0 = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        self.wait.observe(time.perf_counter() - t0)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+
+# all metrics on this node, keyed by (name, sorted label items)
+_metrics       = {}
+_metrics_lock  = threading.Lock()    # only taken when a metric is created
+_start_time    = time.time()
+
+
+def _get_or_create(cls, name, labels, *args):
+    key = (name, tuple(sorted(labels.items())))
+    metric = _metrics.get(key)
+    if metric is None:
+        with _metrics_lock:
+            metric = _metrics.get(key)
+            if metric is None:
+                metric = cls(name, labels, *args)
+                _metrics[key] = metric
+    return metric
+
+def histogram(name, bounds=DURATION_BUCKETS, **labels):
+    return _get_or_create(Histogram, name, labels, bounds)
+
+def counter(name, **labels):
+    return _get_or_create(Counter, name, labels)
+
+def gauge(name, **labels):
+    return _get_or_create(Gauge, name, labels)
+
+
+def snapshot(host):
+    # return a picklable snapshot of every metric on this node
+    return { 'host'    : host,
+             'time'    : time.time(),
+             'uptime'  : time.time() - _start_time,
+             'metrics' : [m.snapshot() for m in list(_metrics.values())] }
+
+
+def _label_str(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for (k, v) in labels) + "}"
+
+def to_prometheus(snapshots, down_hosts=()):
+    # render a list of node snapshots in Prometheus text format
+    # every sample is labelled with the host it came from
+    # hosts that could not be reached are reported as han_up 0
+    families = {}   # name -> (type, [lines])
+    up = families.setdefault('han_up', ('gauge', []))[1]
+    for host in down_hosts:
+        up.append("han_up%s 0" % _label_str([('host', host)]))
+    for snap in snapshots:
+        up.append("han_up%s 1" % _label_str([('host', snap['host'])]))
+        host = snap['host']
+        for m in snap['metrics']:
+            labels = [('host', host)] + sorted(m['labels'].items())
+            (mtype, lines) = families.setdefault(m['name'], (m['type'], []))
+            if m['type'] == 'histogram':
+                cumulative = 0
+                for (bound, n) in zip(m['bounds'] + ('+Inf',), m['counts']):
+                    cumulative += n
+                    lines.append("%s_bucket%s %d" % (m['name'], _label_str(labels + [('le', bound)]), cumulative))
+                lines.append("%s_sum%s %f" % (m['name'], _label_str(labels), m['sum']))
+                lines.append("%s_count%s %d" % (m['name'], _label_str(labels), m['count']))
+            else:
+                lines.append("%s%s %s" % (m['name'], _label_str(labels), m['value']))
+        families.setdefault('han_uptime_seconds', ('gauge', []))[1].append(
+            "han_uptime_seconds%s %f" % (_label_str([('host', host)]), snap['uptime']))
+
+    out = []
+    for name in sorted(families):
+        (mtype, lines) = families[name]
+        out.append("# TYPE %s %s" % (name, mtype))
+        out.extend(lines)
+    return "\n".join(out) + "\n"
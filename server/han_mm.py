@@ -9,22 +9,34 @@ Adds magicmirror-specific threads to han.py
 Provides a communication channel to the browser-based mirror Javascript
 via a CORS-aware HTTP server.
 
-1. Logs temp and humidity from Davis Hidden Valley weather station
+1. Polls the Davis Hidden Valley weather station, Ecobee and HAN nodes
 2. Tracks health of all HAN devices
 3. Serves HTTP requests from magicmirror Javascript app
 
 """
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from json import dumps
-
 import threading
 import logging
 import requests
 import time
 
+import han_metrics as hm
+import han_discovery
+import han_http
+import han_bus
+import han_poller
+import han_history
+import han_admission
+from concurrent.futures import ThreadPoolExecutor
+
 
 JAVASCRIPT_HTTP_PORT = 6446
+HTTP_BIND_ADDRESS    = ''         # all interfaces
+
+# must match han.py
+SYSTEM_HOSTS = ("magicmirror", "flowmeter", "lidar", "fencepost-back-1", "fencepost-back-2", "fencepost-front-1")
+HOME_AUTOMATION_PORT = 6445
+METRICS_TIMEOUT = 2.0     # seconds to wait for each node's METRICS reply
 
 # absolute paths to log files
 LOG_PATH_BASE   = "/home/pi/home_automation/server/logs/"
@@ -34,43 +46,11 @@ ECOBEE_LOG      = LOG_PATH_BASE + "ecobee_log.txt"
 NODE_STATUS_LOG = LOG_PATH_BASE + "node_status_log.txt"
 
 
-# CORS-aware HTTP request handler
-# from https://royportas.com/posts/2019-03-02-cors-python/
-class RequestHandler(BaseHTTPRequestHandler):
-
-  def _send_cors_headers(self):
-      """ Sets headers required for CORS """
-      self.send_header("Access-Control-Allow-Origin", "*")
-      self.send_header("Access-Control-Allow-Methods", "GET,POST,OPTIONS")
-      self.send_header("Access-Control-Allow-Headers", "x-api-key,Content-Type")
-
-  def send_dict_response(self, d):
-      """ Sends a dictionary (JSON) back to the client """
-      self.wfile.write(bytes(dumps(d), "utf8"))
-
-  def do_OPTIONS(self):
-      self.send_response(200)
-      self._send_cors_headers()
-      self.end_headers()
-
-  def do_GET(self):
-      self.send_response(200)
-      self._send_cors_headers()
-      self.end_headers()
-
-      # replace this eventually with a proxy server
-      # i.e. http://magicmirror:6446?target="192.168.1.230/v1/current_conditions"
-      # return latest davis weather sample
-      DAVIS_URL = "http://192.168.1.230/v1/current_conditions"
-      weather = requests.get(DAVIS_URL).json()
-      self.send_dict_response(weather)
+# CORS-aware HTTP request handler, see han_http
+# originally from https://royportas.com/posts/2019-03-02-cors-python/
+class RequestHandler(han_http.RouteRequestHandler):
 
   def do_POST(self):
-      self.send_response(200)
-      self._send_cors_headers()
-      self.send_header("Content-Type", "application/json")
-      self.end_headers()
-
       dataLength = int(self.headers["Content-Length"])
       data = self.rfile.read(dataLength)
 
@@ -81,6 +61,114 @@ class RequestHandler(BaseHTTPRequestHandler):
       self.send_dict_response(response)
 
 
+# the Davis unit is slow and single threaded, concurrent requests share
+# one fetch and its result is reused for WEATHER_TTL seconds
+DAVIS_URL       = "http://192.168.1.230/v1/current_conditions"
+DAVIS_TIMEOUT   = 5.0
+WEATHER_TTL     = 10.0
+weather_lock    = threading.Lock()
+weather_cache   = (0, None)         # (time.monotonic() fetched, davis JSON)
+http_session    = requests.Session()
+
+def weatherRoute(query):
+    global weather_cache
+    with weather_lock:
+        (fetched, weather) = weather_cache
+        if weather is None or time.monotonic() - fetched > WEATHER_TTL:
+            weather = http_session.get(DAVIS_URL, timeout=DAVIS_TIMEOUT).json()
+            weather_cache = (time.monotonic(), weather)
+    return (200, "application/json", weather)
+
+def fleetRoute(query):
+    # every node known from discovery or heartbeats, with its last heartbeat
+    now = time.time()
+    fleet = {}
+    if han_discovery.directory is not None:
+        for entry in han_discovery.directory.nodes():
+            fleet[entry.host] = { 'node_type' : entry.node_type, 'address' : entry.address,
+                                  'healthy' : entry.healthy(), 'msg_types' : entry.msg_types }
+    for (host, t) in list(node_heartbeats.items()):
+        fleet.setdefault(host, {})['heartbeat_age'] = now - t
+    return (200, "application/json", fleet)
+
+# graphable series, the message that fetches them and the nodes that keep them
+# nodes that announced the message are used when discovery knows of any
+HISTORY_SERIES  = { 'vi'   : ("VI_HISTORY", ("flowmeter", "fencepost-back-1", "fencepost-back-2", "fencepost-front-1")),
+                    'flow' : ("FLOW_HISTORY", ("flowmeter", )) }
+HISTORY_TIMEOUT = 5.0     # seconds to wait for each node's history reply
+history_cache   = han_history.HistoryCache()
+history_pool    = ThreadPoolExecutor(max_workers=len(SYSTEM_HOSTS))
+metrics_pool    = ThreadPoolExecutor(max_workers=len(SYSTEM_HOSTS))
+
+def queryHistory(series, start, end, nodes=None):
+    # fetch a time range of series from every node in parallel
+    # returns ({ node : [(t, values...)] }, [nodes that did not respond])
+    (msg_t, default_nodes) = HISTORY_SERIES[series]
+    if nodes is None:
+        nodes = (han_discovery.directory.hosts_for(msg_t) if han_discovery.directory is not None else ()) or default_nodes
+    replies = {}
+    futures = {}
+    for node in nodes:
+        key = (node, series, start, end)
+        records = history_cache.get(key)
+        if records is not None:
+            replies[node] = records
+        else:
+            # the reply generator runs, and the records are received, on the pool thread
+            reply = han_history.query(node, (msg_t, start, end), HOME_AUTOMATION_PORT, HISTORY_TIMEOUT)
+            futures[node] = history_pool.submit(list, reply)
+    down = []
+    for (node, f) in futures.items():
+        try:
+            replies[node] = f.result()
+            history_cache.put((node, series, start, end), replies[node])
+        except han_admission.Busy:
+            mirror_log.info("%s query to %s shed, node busy", HISTORY_SERIES[series][0], node)
+            down.append(node)
+        except Exception:
+            han_discovery.mark_failed(node)
+            mirror_log.warning("%s query to %s failed", HISTORY_SERIES[series][0], node)
+            down.append(node)
+    return (replies, down)
+
+def historyRoute(query):
+    # /history?series=vi|flow&start=<epoch s>&end=<epoch s>&nodes=host,host
+    # start and end are rounded down to the minute, the resolution of the records
+    series = query.get('series', ['vi'])[0]
+    if series not in HISTORY_SERIES:
+        return (400, "application/json", { 'error' : "unknown series: " + series })
+    try:
+        end = float(query['end'][0]) if 'end' in query else time.time()
+        start = float(query['start'][0]) if 'start' in query else end - han_history.DEFAULT_RANGE
+    except ValueError:
+        return (400, "application/json", { 'error' : "start and end are seconds since the epoch" })
+    (start, end) = (start - start % 60, end - end % 60)
+    nodes = query['nodes'][0].split(',') if 'nodes' in query else None
+    (replies, down) = queryHistory(series, start, end, nodes)
+    return (200, "application/json", { 'series' : series, 'start' : start, 'end' : end, 'down' : down,
+                                       'records' : list(han_history.merge(replies)) })
+
+def metricsRoute(query):
+    # METRICS snapshot of every HAN node in Prometheus text format
+    return (200, "text/plain; version=0.0.4", hm.to_prometheus(*queryFleetMetrics()))
+
+# live updates for the mirror app, one producer per source, any number of browsers
+events = han_http.EventBroadcaster()
+
+def flowEventHandler(topic, host, payload):
+    # event bus callback for flow/zone, flow/update and flow/alert from the flowmeter
+    if topic == "flow/alert":
+        mirror_log.warning("%s flow alert: %s", host, payload)
+    events.publish(topic.replace('/', '_'), dict(payload, host=host))
+
+RequestHandler.streams = { '/events' : events }
+RequestHandler.routes = { '/'        : weatherRoute,     # the mirror app's original request
+                          '/weather' : weatherRoute,
+                          '/fleet'   : fleetRoute,
+                          '/history' : historyRoute,
+                          '/metrics' : metricsRoute }
+
+
 class httpServerThread(threading.Thread):
     def __init__(self, host_ip):
         threading.Thread.__init__(self)
@@ -89,62 +177,91 @@ class httpServerThread(threading.Thread):
 
     def run(self):
         mirror_log.info("Starting CORS-aware http server on port %s", JAVASCRIPT_HTTP_PORT)
-        httpd = HTTPServer((self.host_ip, JAVASCRIPT_HTTP_PORT), RequestHandler)
+        httpd = han_http.serve(self.host_ip, JAVASCRIPT_HTTP_PORT, RequestHandler)
         httpd.serve_forever()
 
 
-class davisThread(threading.Thread):
-    SAMPLE_INTERVAL = 10  # get weather every 10 mins, interval must divide fully into 60 (i.e. 10, 15, 20, not 11)
-    DAVIS_URL = "http://192.168.1.230/v1/current_conditions"
-
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self.daemon = True
-
-    def run(self):
-        mirror_log.info("davisThread running")
-
-        while True:
-            # fetch and log select weather parameters from Davis Weatherlink
-            report = { }
-            weather = requests.get(self.DAVIS_URL).json()
-            report['o_temp'] = weather['data']['conditions'][0]['temp']
-            report['o_hum']  = weather['data']['conditions'][0]['hum']
-            report['wind_speed_1_min']  = weather['data']['conditions'][0]['wind_speed_avg_last_1_min']
-            report['wind_dir_1_min']  = weather['data']['conditions'][0]['wind_dir_scalar_avg_last_1_min']
-            report['wind_gust_10_min']  = weather['data']['conditions'][0]['wind_speed_hi_last_10_min']
-            report['i_temp'] = weather['data']['conditions'][1]['temp_in']
-            report['i_hum']  = weather['data']['conditions'][1]['hum_in']
-
-            davis_log.info(report)
-
-            # repeat ON every SAMPLE_INTERVAL mins
-            time.sleep(60 * (self.SAMPLE_INTERVAL - (time.localtime().tm_min % self.SAMPLE_INTERVAL)))
-
-
-class ecobeeThread(threading.Thread):
-    SAMPLE_INTERVAL = 10  # get data every 10 mins, interval must divide fully into 60 (i.e. 15, 20, not 11)
-    ECOBEE_URL = "http://ecobee.com"
-
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self.daemon = True
-
-    def run(self):
-        mirror_log.info("ecobeeThread running")
-
-        while True:
-            # fetch JSON report from Ecobee
-            # data = json.loads(os.system("curl" + ECOBEE_URL))
-            # ecobee_log.info(data)
-
-            # repeat ON every SAMPLE_INTERVAL mins
-            time.sleep(60 * (self.SAMPLE_INTERVAL - (time.localtime().tm_min % self.SAMPLE_INTERVAL)))
-
+#
+# data sources polled by han_poller, adding a source is adding an entry to SOURCES
+#
+
+POLL_WORKERS = 4
+
+def parseDavis(weather):
+    # select weather parameters from a Davis Weatherlink current_conditions reply
+    try:
+        conditions = weather['data']['conditions']
+        outdoor = next(c for c in conditions if 'temp' in c)
+        indoor  = next(c for c in conditions if 'temp_in' in c)
+    except (KeyError, TypeError, StopIteration):
+        raise ValueError("unexpected Davis reply")
+    return { 'o_temp'           : outdoor.get('temp'),
+             'o_hum'            : outdoor.get('hum'),
+             'wind_speed_1_min' : outdoor.get('wind_speed_avg_last_1_min'),
+             'wind_dir_1_min'   : outdoor.get('wind_dir_scalar_avg_last_1_min'),
+             'wind_gust_10_min' : outdoor.get('wind_speed_hi_last_10_min'),
+             'i_temp'           : indoor.get('temp_in'),
+             'i_hum'            : indoor.get('hum_in') }
+
+def parseVI(reply):
+    (vin, cur) = reply
+    return { 'vin' : vin, 'cur' : cur }
+
+def parseFlow(reply):
+    (gpm, gallons, zone) = reply
+    return { 'gpm' : gpm, 'gallons' : gallons, 'zone' : zone }
+
+def logDavis(record):
+    davis_log.info(record['fields'])
+    events.publish("davis", record['fields'])
+
+def logEcobee(record):
+    ecobee_log.info(record['fields'])
+
+latest_records = {}      # source name -> last normalized record
+
+def storeRecord(record):
+    latest_records[record['source']] = record
+    events.publish("poll", record)
+
+SOURCES = [ han_poller.Source("davis", 600, han_poller.http_json(DAVIS_URL), parseDavis,
+                              sinks=(storeRecord, logDavis), timeout=DAVIS_TIMEOUT, align=True),
+            # no Ecobee API access yet, enable once ECOBEE_URL returns thermostat JSON
+            han_poller.Source("ecobee", 600, han_poller.http_json("http://ecobee.com"), dict,
+                              sinks=(storeRecord, logEcobee), align=True, enabled=False),
+            han_poller.Source("flowmeter", 60, han_poller.han_query("flowmeter", ("FLOW_QUERY", ), HOME_AUTOMATION_PORT),
+                              parseFlow, sinks=(storeRecord, ), timeout=2.0, retries=1) ]
+for host in ("flowmeter", "fencepost-back-1", "fencepost-back-2", "fencepost-front-1"):
+    SOURCES.append(han_poller.Source(host + "_vi", 600, han_poller.han_query(host, ("VI_QUERY", ), HOME_AUTOMATION_PORT),
+                                     parseVI, sinks=(storeRecord, ), timeout=2.0, retries=1, align=True))
+
+
+def queryFleetMetrics():
+    # fetch a METRICS snapshot from every node in parallel, so a scrape takes at most
+    # METRICS_TIMEOUT however many nodes are down
+    # returns ([snapshots], [hosts that did not respond])
+    futures = { host : metrics_pool.submit(han_poller.han_query(host, ("METRICS", ), HOME_AUTOMATION_PORT),
+                                           None, METRICS_TIMEOUT)
+                for host in SYSTEM_HOSTS }
+    snapshots = []
+    down = []
+    for (host, f) in futures.items():
+        try:
+            snapshots.append(f.result())
+        except Exception:
+            han_discovery.mark_failed(host)
+            mirror_log.warning("METRICS query to %s failed", host)
+            down.append(host)
+    return (snapshots, down)
+
+
+node_heartbeats = {}     # host -> time.time() of last HEALTH_NOTICE
 
 def nodeStatusHandler(msg):
     # msg format: { 'device' : host_name }
+    node_heartbeats[msg['host']] = time.time()
     node_status_log.info(msg['host'])
+    events.publish("heartbeat", msg)
 
 
 
@@ -185,12 +302,10 @@ mirror_log.info("")
 mirror_log.info("MAGICMIRROR STARTING...")
 
 # start threads
-davis_t = davisThread()
-davis_t.start()
+han_bus.bus.subscribe("flow/", flowEventHandler)
 
-ecobee_t = ecobeeThread()
-ecobee_t.start()
+poller = han_poller.Poller(SOURCES, session=http_session, workers=POLL_WORKERS, log=mirror_log)
+poller.start()
 
-host_ip = "192.168.1.200"
-http_server_t = httpServerThread(host_ip)
+http_server_t = httpServerThread(HTTP_BIND_ADDRESS)
 http_server_t.start()
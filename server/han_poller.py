@@ -0,0 +1,154 @@
+"""
+
+Concurrent multi-source poller for the magicmirror.
+
+One scheduler thread keeps every source's next due time in a heap and
+hands due sources to a small worker pool, so sources run concurrently
+and a source that hangs only ever ties up one worker until its timeout.
+A source whose previous poll is still running is skipped rather than
+queued behind itself.
+
+A source is configuration:
+
+    Source(name, interval, fetch, parse, sinks, timeout, retries, align)
+
+fetch(session, timeout) returns the raw reply, parse(raw) turns it into a
+flat dict of fields (raise ValueError if the reply doesn't look right),
+and every sink is called with the normalized record
+
+    { 'source' : name, 'time' : time.time(), 'fields' : {...} }
+
+HTTP sources share one pooled requests.Session. Failed attempts are
+retried with exponential backoff and random jitter.
+
+"""
+
+import heapq
+import pickle
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import han_metrics as hm
+import han_discovery
+import han_admission
+
+BACKOFF_BASE = 1.0          # seconds before the first retry, doubled for each further retry
+BACKOFF_MAX  = 30.0
+
+
+class Source:
+    def __init__(self, name, interval, fetch, parse, sinks=(), timeout=5.0, retries=2, align=False, enabled=True):
+        # interval in seconds, align=True runs on wall clock multiples of interval
+        # (e.g. on the 10 minute mark) instead of interval after the last run
+        self.name     = name
+        self.interval = interval
+        self.fetch    = fetch
+        self.parse    = parse
+        self.sinks    = list(sinks)
+        self.timeout  = timeout
+        self.retries  = retries
+        self.align    = align
+        self.enabled  = enabled
+        self.running  = False
+        self.polls    = hm.counter("han_poll_total", source=name)
+        self.failures = hm.counter("han_poll_failures_total", source=name)
+        self.skipped  = hm.counter("han_poll_skipped_total", source=name)
+        self.duration = hm.histogram("han_poll_seconds", source=name)
+
+    def next_due(self, now):
+        if self.align:
+            return (now // self.interval + 1) * self.interval
+        return now + self.interval
+
+
+class Poller:
+    def __init__(self, sources, session=None, workers=4, log=None):
+        self.sources = [s for s in sources if s.enabled]
+        self.session = session
+        self.log     = log
+        self._pool   = ThreadPoolExecutor(max_workers=workers)
+        self._heap   = []
+
+    def _poll(self, source):
+        t0 = time.perf_counter()
+        try:
+            for attempt in range(source.retries + 1):
+                try:
+                    fields = source.parse(source.fetch(self.session, source.timeout))
+                    break
+                except Exception:
+                    if attempt == source.retries:
+                        raise
+                    backoff = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+                    time.sleep(backoff * random.uniform(0.5, 1.5))
+            record = { 'source' : source.name, 'time' : time.time(), 'fields' : fields }
+            for sink in source.sinks:
+                sink(record)
+            source.polls.inc()
+        except Exception as e:
+            source.failures.inc()
+            if self.log is not None:
+                self.log.warning("poll of %s failed: %s", source.name, e)
+        finally:
+            source.duration.observe(time.perf_counter() - t0)
+            source.running = False
+
+    def run(self):
+        now = time.time()
+        for s in self.sources:
+            heapq.heappush(self._heap, (now, id(s), s))  # poll everything once at startup
+        while True:
+            (due, key, source) = self._heap[0]
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+                continue
+            heapq.heappop(self._heap)
+            if source.running:
+                source.skipped.inc()        # previous poll still in its timeout/retries
+            else:
+                source.running = True
+                self._pool.submit(self._poll, source)
+            heapq.heappush(self._heap, (source.next_due(time.time()), key, source))
+
+    def start(self):
+        t = threading.Thread(target=self.run, name="pollerThread", daemon=True)
+        t.start()
+        return t
+
+
+#
+# fetchers for common source types
+#
+
+def http_json(url):
+    # fetch JSON from url with the shared session
+    def fetch(session, timeout):
+        r = session.get(url, timeout=timeout)
+        r.raise_for_status()
+        return r.json()
+    return fetch
+
+def han_query(host, msg, port):
+    # send a HAN message to a node and return its reply
+    def fetch(session, timeout):
+        s = socket.create_connection(han_discovery.resolve(host, port), timeout=timeout)
+        try:
+            s.sendall(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+            s.shutdown(socket.SHUT_WR)
+            buf = b''
+            while True:
+                data = s.recv(4096)
+                if not data:
+                    break
+                buf += data
+        finally:
+            s.close()
+        reply = pickle.loads(buf)
+        if reply == han_admission.BUSY:     # shed by the node, retried with backoff
+            raise han_admission.Busy(host)
+        return reply
+    return fetch
@@ -0,0 +1,81 @@
+"""
+
+Versioned state shared between a node's threads.
+
+Each key is defined once with a type and an initial value, e.g.
+
+    state.define("vi", tuple, (0, 0))
+
+and carries a version that goes up by one every time its value changes.
+Writing a value equal to the current one is not a change, so a sampling
+loop can write every pass and the version only counts real changes.
+
+Values are kept in one dict of key -> (value, version) that is never
+modified, a write copies it and swaps in the copy (copy-on-write). A
+reader takes the current dict with a single reference and so never waits
+for a writer, and a snapshot() of several keys is always consistent, e.g.
+a FLOW_QUERY never pairs one sample's flow with another sample's zone.
+Writers take a lock only to serialize with each other, a TimedLock, so
+how long writers wait for each other is in han_lock_wait_seconds with
+lock="state".
+
+    (value, version) = state.get("flow")
+
+"""
+
+import han_metrics as hm
+
+
+class StateRegistry:
+    def __init__(self):
+        self._types  = {}
+        self._gauges = {}                       # key -> version gauge
+        self._values = {}                       # key -> (value, version), replaced, never modified
+        self._lock   = hm.TimedLock("state")    # serializes writers
+
+    def define(self, key, value_type, initial):
+        with self._lock:
+            if key in self._types:
+                raise KeyError("state %s already defined" % key)
+            if not isinstance(initial, value_type):
+                raise TypeError("state %s is %s, not %s" % (key, value_type.__name__, type(initial).__name__))
+            self._types[key] = value_type
+            values = dict(self._values)
+            values[key] = (initial, 0)
+            self._values = values
+            self._gauges[key] = hm.gauge("han_state_version", key=key)
+
+    def get(self, key):
+        # (value, version)
+        return self._values[key]
+
+    def value(self, key):
+        return self._values[key][0]
+
+    def snapshot(self, *keys):
+        # { key : (value, version) } of keys (all keys if none) as of one moment, a copy
+        values = self._values
+        return { key : values[key] for key in keys } if keys else dict(values)
+
+    def set(self, key, value):
+        # returns the key's version after the write
+        return self.update({ key : value })[key]
+
+    def update(self, changes):
+        # write several keys at once, readers see all of the changes or none
+        # returns { key : version after the write }
+        for (key, value) in changes.items():
+            if not isinstance(value, self._types[key]):
+                raise TypeError("state %s is %s, not %s" % (key, self._types[key].__name__, type(value).__name__))
+        with self._lock:
+            current = self._values
+            changed = { key : (value, current[key][1] + 1) for (key, value) in changes.items()
+                        if value != current[key][0] }
+            if changed:
+                values = dict(current)
+                values.update(changed)
+                self._values = values
+            versions = { key : self._values[key][1] for key in changes }
+        for (key, (value, version)) in changed.items():
+            self._gauges[key].set(version)
+        return versions
@@ -0,0 +1,662 @@
+"""
+
+Record and replay a node's inputs.
+
+With han.TRACE_PATH set, a node records what its hardware and network
+give it into a compact binary trace:
+
+    pin changes     flow sensor and zone inputs, every change, read every
+                    EDGE_POLL_INTERVAL by a recorder thread of its own, so
+                    the trace has the pulses the node's sampler misses
+    SPI results     every viThread ADC conversion
+    messages        every message serverThread receives, as received
+
+The recording wraps the digitalio and adafruit_bus_device modules that
+han.load_plugin() imports, so the thread code is the same code that runs
+without a trace.
+
+A replay imports han without starting the node, puts simulated hardware
+in place of the drivers, and runs the real thread code against the trace:
+
+    python han_trace.py flow TRACE [--speed 1|100|max]
+    python han_trace.py vi TRACE [--speed ...]
+    python han_trace.py messages TRACE [--speed ...]
+    python han_trace.py info TRACE
+    python han_trace.py synth-flow TRACE [--gpm 30] [--minutes 5]
+
+flow and vi run on a simulated clock that advances when the thread
+sleeps, so a replay gives the same result at any speed, and max runs as
+fast as the code allows. messages are sent to a real serverThread on a
+local port at the recorded times, scaled by speed, and the lighting
+thread renders to a simulated LED string. Each replay checks its outputs
+against the trace (e.g. the totalizer against the recorded flow pulses),
+reports the thread's loop times, and exits non-zero if a check failed.
+
+Trace format: a header (MAGIC, version, wall clock start time), then
+records of (seconds since start, kind, payload length) and the payload.
+
+"""
+
+import logging
+import os
+import pickle
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+
+MAGIC          = b"HANTRACE"
+VERSION        = 1
+FLUSH_INTERVAL = 1.0        # seconds, recorded data is written to the file at least this often
+EDGE_POLL_INTERVAL = 0.001  # seconds between reads of the input pins, well under the shortest flow pulse
+TAIL_SECONDS   = 120        # a replay runs on this long after the last record, so minute records are written
+
+HEADER      = struct.Struct("<8sHd")        # magic, version, time.time() at start
+RECORD      = struct.Struct("<dBH")         # seconds since start, kind, payload length
+PIN_RECORD  = struct.Struct("<BB")          # pin id, value
+SPI_RECORD  = struct.Struct("<BI")          # command byte, result
+
+META, NAME, PIN, SPI, MSG = range(5)        # record kinds
+KIND_NAMES = ("meta", "name", "pin", "spi", "msg")
+
+
+class TraceEnd(Exception):
+    # raised into the thread under replay when the trace runs out
+    pass
+
+
+#
+# recording
+#
+
+class TraceWriter:
+    def __init__(self, path, host, node_type, start_time=None):
+        self._f       = open(path, 'wb')
+        self._lock    = threading.Lock()
+        self._pins    = {}                  # pin name -> id
+        self._pid     = os.getpid()         # a forked sampler process must not write to the same file
+        self._t0      = time.monotonic()
+        self._flushed = self._t0
+        self.dropped  = 0                   # messages too long for a record
+        self._watched = []                  # _RecordingPins read by the recorder thread
+        self._watcher = None
+        self._closed  = False
+        self._f.write(HEADER.pack(MAGIC, VERSION, time.time() if start_time is None else start_time))
+        self._write(META, ("%s\t%s" % (host, node_type)).encode("utf8"))
+
+    def _write(self, kind, payload, t=None):
+        # t is seconds since the start, now if None
+        if os.getpid() != self._pid:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._f.write(RECORD.pack(now - self._t0 if t is None else t, kind, len(payload)))
+            self._f.write(payload)
+            if now - self._flushed > FLUSH_INTERVAL:
+                self._f.flush()
+                self._flushed = now
+
+    def pin(self, name, value, t=None):
+        pin_id = self._pins.get(name)
+        if pin_id is None:
+            pin_id = self._pins[name] = len(self._pins)
+            self._write(NAME, bytes((pin_id, )) + name.encode("utf8"), t)
+        self._write(PIN, PIN_RECORD.pack(pin_id, bool(value)), t)
+
+    def watch(self, pin):
+        # record pin's input changes from the recorder thread, independent of when the node reads it
+        with self._lock:
+            self._watched.append(pin)
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._record_pins, name="pinRecorder", daemon=True)
+            self._watcher.start()
+
+    def _record_pins(self):
+        last = {}
+        while not self._closed:
+            for pin in list(self._watched):
+                if pin._deinit:
+                    self._watched.remove(pin)   # released, e.g. ZONE_MAP reloaded
+                    continue
+                if pin._io.direction != pin._input:
+                    continue                    # outputs are not recorded
+                value = pin._io.value
+                if value != last.get(pin):
+                    self.pin(pin._name, value)
+                    last[pin] = value
+            time.sleep(EDGE_POLL_INTERVAL)
+
+    def spi(self, command, result):
+        self._write(SPI, SPI_RECORD.pack(command, result))
+
+    def message(self, buf):
+        if len(buf) > 0xFFFF:
+            self.dropped += 1
+            return
+        self._write(MSG, bytes(buf))
+
+    def recording(self, name, module):
+        # module, or a stand-in that records what it returns, for han.load_plugin()
+        if name == 'digitalio':
+            return _RecordingDigitalio(module, self)
+        if name == 'adafruit_bus_device':
+            return _RecordingBusDevice(module, self)
+        return module
+
+    def close(self):
+        self._closed = True
+        if self._watcher is not None:
+            self._watcher.join()
+        with self._lock:
+            self._f.close()
+
+
+class _RecordingDigitalio:
+    def __init__(self, module, trace):
+        self._module = module
+        self._trace  = trace
+
+    def DigitalInOut(self, pin):
+        io = _RecordingPin(self._module.DigitalInOut(pin), str(pin), self._module.Direction.INPUT)
+        self._trace.watch(io)
+        return io
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+class _RecordingPin:
+    # a pin the recorder thread reads, the node reads and writes it as usual
+    def __init__(self, io, name, input_direction):
+        self.__dict__.update(_io=io, _name=name, _input=input_direction, _deinit=False)
+
+    @property
+    def value(self):
+        return self._io.value
+
+    @value.setter
+    def value(self, value):
+        self._io.value = value
+
+    def deinit(self):
+        self.__dict__['_deinit'] = True
+        self._io.deinit()
+
+    def __getattr__(self, name):
+        return getattr(self._io, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._io, name, value)
+
+
+class _RecordingBusDevice:
+    def __init__(self, package, trace):
+        def SPIDevice(*args, **kwargs):
+            return _RecordingSPIDevice(package.spi_device.SPIDevice(*args, **kwargs), trace)
+        self.spi_device = types.SimpleNamespace(SPIDevice=SPIDevice)
+
+
+class _RecordingSPIDevice:
+    def __init__(self, device, trace):
+        self._device = device
+        self._trace  = trace
+
+    def __enter__(self):
+        return _RecordingSPI(self._device.__enter__(), self._trace)
+
+    def __exit__(self, *args):
+        return self._device.__exit__(*args)
+
+
+class _RecordingSPI:
+    def __init__(self, spi, trace):
+        self._spi   = spi
+        self._trace = trace
+
+    def write_readinto(self, out_buffer, in_buffer):
+        self._spi.write_readinto(out_buffer, in_buffer)
+        self._trace.spi(out_buffer[0], int.from_bytes(in_buffer, byteorder='big'))
+
+    def __getattr__(self, name):
+        return getattr(self._spi, name)
+
+
+#
+# reading
+#
+
+class TraceReader:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        (magic, version, self.start_time) = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d trace" % (path, VERSION))
+        self.host = self.node_type = None
+        self.records = []                   # [(t, kind, value)]
+        names = {}
+        offset = HEADER.size
+        while offset + RECORD.size <= len(data):
+            (t, kind, n) = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            payload = data[offset:offset + n]
+            offset += n
+            if len(payload) < n:
+                break                       # recording stopped mid record
+            if kind == META:
+                (self.host, self.node_type) = payload.decode("utf8").split("\t")
+            elif kind == NAME:
+                names[payload[0]] = payload[1:].decode("utf8")
+            elif kind == PIN:
+                (pin_id, value) = PIN_RECORD.unpack(payload)
+                self.records.append((t, PIN, (names[pin_id], bool(value))))
+            elif kind == SPI:
+                self.records.append((t, SPI, SPI_RECORD.unpack(payload)))
+            elif kind == MSG:
+                self.records.append((t, MSG, payload))
+
+    def of_kind(self, kind):
+        return [(t, value) for (t, k, value) in self.records if k == kind]
+
+    def duration(self):
+        return self.records[-1][0] if self.records else 0.0
+
+
+#
+# simulated hardware
+#
+
+class SimClock:
+    # stands in for the time module in han, time advances when the thread sleeps
+    # speed is the replay speed, None = as fast as possible
+    def __init__(self, start_time, end, speed=None, on_advance=None):
+        self.start_time = start_time
+        self.end        = end
+        self.speed      = speed
+        self.on_advance = on_advance        # on_advance(now) applies the trace up to now
+        self.now        = 0.0
+        self.work       = []                # real seconds between sleeps, the thread's loop times
+        self._awake     = time.perf_counter()
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.start_time + self.now
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+    def localtime(self, secs=None):
+        return time.localtime(self.time() if secs is None else secs)
+
+    def strftime(self, format, t=None):
+        return time.strftime(format, self.localtime() if t is None else t)
+
+    def sleep(self, seconds):
+        self.work.append(time.perf_counter() - self._awake)
+        if self.speed is not None and seconds > 0:
+            time.sleep(seconds / self.speed)
+        self.advance(self.now + max(seconds, 0.0))
+        self._awake = time.perf_counter()
+
+    def advance(self, now):
+        if now > self.end:
+            raise TraceEnd()
+        self.now = now
+        if self.on_advance is not None:
+            self.on_advance(now)
+
+
+class SimPins:
+    # input pin values at the clock's time, from the trace's pin records
+    def __init__(self, pin_records):
+        self._records = pin_records
+        self._next    = 0
+        self.values   = {}
+        self.outputs  = {}
+
+    def advance(self, now):
+        while self._next < len(self._records) and self._records[self._next][0] <= now:
+            (name, value) = self._records[self._next][1]
+            self.values[name] = value
+            self._next += 1
+
+
+class SimBoard:
+    # board.Dn is pin n, like the Blinka pins the trace was recorded with
+    def __getattr__(self, name):
+        return name[1:] if name[:1] == 'D' and name[1:].isdigit() else name
+
+
+class SimDigitalio:
+    Direction = types.SimpleNamespace(INPUT="INPUT", OUTPUT="OUTPUT")
+
+    def __init__(self, pins):
+        self._pins = pins
+
+    def DigitalInOut(self, pin):
+        return _SimPin(self._pins, str(pin))
+
+
+class _SimPin:
+    def __init__(self, pins, name):
+        self._pins = pins
+        self._name = name
+        self.direction = SimDigitalio.Direction.INPUT
+
+    @property
+    def value(self):
+        return self._pins.values.get(self._name, False)
+
+    @value.setter
+    def value(self, value):
+        self._pins.outputs[self._name] = value
+
+    def deinit(self):
+        pass
+
+
+class SimSPI:
+    # the SPI bus and device, each conversion returns the next recorded result
+    def __init__(self, spi_records):
+        self._records   = spi_records
+        self._next      = 0
+        self.mismatches = 0                 # conversions whose command differs from the recording
+
+    def SPI(self, *args, **kwargs):         # busio.SPI
+        return self
+
+    @property
+    def spi_device(self):                   # adafruit_bus_device.spi_device
+        return types.SimpleNamespace(SPIDevice=lambda comm_port, cs: self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def write_readinto(self, out_buffer, in_buffer):
+        if self._next >= len(self._records):
+            raise TraceEnd()
+        (command, result) = self._records[self._next][1]
+        self._next += 1
+        if command != out_buffer[0]:
+            self.mismatches += 1
+        in_buffer[:] = result.to_bytes(len(in_buffer), byteorder='big')
+
+    def consumed(self):
+        return self._next
+
+
+def sim_neopixel():
+    # a neopixel module whose strings are lists, for loading the real fencepost driver
+    class NeoPixel(list):
+        def __init__(self, pin, n, brightness=1.0, auto_write=True, pixel_order=None):
+            list.__init__(self, [(0, 0, 0, 0)] * n)
+            self.shows = 0
+
+        def fill(self, color):
+            self[:] = [color] * len(self)
+
+        def show(self):
+            self.shows += 1
+
+    return types.SimpleNamespace(RGB="RGB", GRB="GRB", RGBW="RGBW", GRBW="GRBW", NeoPixel=NeoPixel)
+
+
+class SimBus:
+    # the event bus, publishes are kept for checks
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload):
+        self.published.append((topic, payload))
+
+    def subscribe(self, prefix, callback):
+        pass
+
+    def start(self):
+        pass
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(record.getMessage())
+
+def _capture_log(name):
+    # a logger outside han's hierarchy, so nothing is written to the node's log files
+    log = logging.getLogger("han_trace." + name)
+    log.propagate = False
+    log.handlers = [_ListHandler()]
+    log.setLevel(logging.DEBUG)
+    return log
+
+
+#
+# replay
+#
+
+def _import_han(reader):
+    # import han without starting the node, as the node that recorded the trace
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import han
+    han.host_name  = reader.host
+    han.node_type  = reader.node_type
+    han.bus        = SimBus()
+    han.server_log = _capture_log("server")
+    return han
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def _timing(name, seconds):
+    return "%s p50 %.3f ms  p99 %.3f ms  max %.3f ms  (%d loops)" % (
+        name, 1000 * _percentile(seconds, 0.5), 1000 * _percentile(seconds, 0.99),
+        1000 * max(seconds, default=0.0), len(seconds))
+
+def replay_flow(reader, speed=None):
+    # run flowThread's sampling loop over the recorded pin changes
+    # checks the totalizer against the recorded flow sensor pulses
+    han = _import_han(reader)
+    pins = SimPins(reader.of_kind(PIN))
+    clock = SimClock(reader.start_time, reader.duration() + TAIL_SECONDS, speed, pins.advance)
+    import han_flow_analytics
+    import han_checkpoint
+    (han.board, han.digitalio, han.han_flow_analytics) = (SimBoard(), SimDigitalio(pins), han_flow_analytics)
+    han.han_checkpoint = han_checkpoint
+    han.flowThread.CHECKPOINT_PATH = os.path.join(tempfile.mkdtemp(), "flow_checkpoint")   # start from 0 gallons
+    han.flow_log = _capture_log("flow")
+    han.time = clock
+
+    flow_pin = getattr(SimBoard(), han.flowThread.ZONE_MAP["flow_sns"])
+    pulses = 0
+    last = False
+    for (t, (name, value)) in reader.of_kind(PIN):
+        if name == flow_pin:
+            pulses += value and not last
+            last = value
+
+    t0 = time.perf_counter()
+    try:
+        han.flowThread()._sample(None)
+    except TraceEnd:
+        pass
+    elapsed = time.perf_counter() - t0
+
+    gallons = han.state.value("flow")[1]
+    counted = int(round(gallons * 10))
+    report = [ "%.0f s of trace replayed in %.2f s" % (clock.now, elapsed),
+               _timing("loop", clock.work),
+               "pulses recorded %d, counted %d" % (pulses, counted),
+               "minute records %d, bus events %d" % (len(han.flow_log.handlers[0].lines), len(han.bus.published)) ]
+    report += ["alert %s" % (payload, ) for (topic, payload) in han.bus.published if topic == "flow/alert"]
+    failures = []
+    if counted != pulses:
+        failures.append("%d flow pulses missed" % (pulses - counted))
+    return (report, failures)
+
+def replay_vi(reader, speed=None):
+    # run viThread over the recorded ADC conversions
+    # checks every conversion was read, with the recorded command
+    han = _import_han(reader)
+    spi = SimSPI(reader.of_kind(SPI))
+    clock = SimClock(reader.start_time, float('inf'), speed)
+    import han_vi
+    (han.board, han.digitalio, han.busio, han.adafruit_bus_device, han.han_vi) = \
+        (SimBoard(), SimDigitalio(SimPins([])), spi, spi, han_vi)
+    han.vi_log = _capture_log("vi")
+    han.time = clock
+
+    t0 = time.perf_counter()
+    try:
+        han.viThread().run()
+    except TraceEnd:
+        pass
+    elapsed = time.perf_counter() - t0
+
+    recorded = len(reader.of_kind(SPI))
+    report = [ "%.0f s of trace replayed in %.2f s" % (clock.now, elapsed),
+               _timing("loop", clock.work),
+               "conversions recorded %d, read %d, command mismatches %d" % (recorded, spi.consumed(), spi.mismatches),
+               "vi records %d, latest (vin, cur) = (%.2f, %.0f)" % ((len(han.vi_log.handlers[0].lines), ) + tuple(han.state.value("vi"))) ]
+    failures = []
+    if spi.consumed() != recorded or spi.mismatches:
+        failures.append("conversions out of step with the recording")
+    return (report, failures)
+
+def _send(port, buf):
+    # one-shot request like the clients, returns (round trip seconds, reply bytes)
+    t0 = time.perf_counter()
+    s = socket.create_connection(('127.0.0.1', port), timeout=10)
+    try:
+        s.sendall(buf)
+        s.shutdown(socket.SHUT_WR)
+        reply = b''
+        while True:
+            data = s.recv(4096)
+            if not data:
+                break
+            reply += data
+    finally:
+        s.close()
+    return (time.perf_counter() - t0, reply)
+
+def replay_messages(reader, speed=None):
+    # send the recorded messages to a real serverThread on a local port, lighting renders to a simulated string
+    # checks every message was answered and the lighting ends on the last DISPLAY message
+    sys.modules.setdefault('board', SimBoard())
+    sys.modules.setdefault('neopixel', sim_neopixel())
+    han = _import_han(reader)
+    import fencepost_neopixel_driver
+    han.npdrvr = fencepost_neopixel_driver
+
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    han.HOME_AUTOMATION_PORT = probe.getsockname()[1]
+    probe.close()
+    han.serverThread.CLIENT_RATE = float('inf')     # the recorded clients are all 127.0.0.1 here
+    han.serverThread(han.node_type).start()
+    if han.node_type in han.MSG_TYPES['DISPLAY']:
+        han.fpl_t = han.fpLightingThread()
+        han.fpl_t.start()
+    time.sleep(0.2)                         # let the server bind
+
+    messages = reader.of_kind(MSG)
+    latencies = []
+    failures = []
+    t0 = time.perf_counter()
+    for (t, buf) in messages:
+        if speed is not None:
+            delay = t / speed - (time.perf_counter() - t0)
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            latencies.append(_send(han.HOME_AUTOMATION_PORT, buf)[0])
+        except OSError as e:
+            failures.append("message at %.3f s not answered: %s" % (t, e))
+    elapsed = time.perf_counter() - t0
+
+    report = [ "%d messages over %.1f s of trace sent in %.2f s" % (len(messages), reader.duration(), elapsed),
+               _timing("round trip", latencies) ]
+    displays = [pickle.loads(buf) for (t, buf) in messages if buf and pickle.loads(buf)[0] == "DISPLAY"]
+    if han.fpl_t is not None:
+        deadline = time.monotonic() + 5.0
+        while han.lighting_mailbox.qsize() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2)                     # the last command is rendered
+        overruns = han.hm.counter("han_lighting_overruns_total").value
+        shows = han.npdrvr.pixels.shows
+        report.append("lighting %s, %d string updates, %d overruns" % (han.fpl_t.light_style, shows, overruns))
+        if displays and tuple(han.fpl_t.light_style) != tuple(displays[-1]):
+            failures.append("lighting is %s, last DISPLAY was %s" % (han.fpl_t.light_style, displays[-1]))
+    return (report, failures)
+
+
+def synth_flow(path, gpm=30.0, minutes=5, zone="D22"):
+    # a flow trace with one zone on at a constant flow, for replays without a node
+    # the sensor closes 40% of each 0.1 gallon pulse period
+    trace = TraceWriter(path, "flowmeter", "flowmeter", start_time=time.time() - minutes * 60 - 60)
+    board = SimBoard()
+    flow_pin = getattr(board, "D4")
+    zone_pin = getattr(board, zone)
+    period = 6.0 / gpm
+    records = [(0.0, zone_pin, True)]
+    t = 1.0
+    while t < minutes * 60:
+        records.append((t, flow_pin, True))
+        records.append((t + 0.4 * period, flow_pin, False))
+        t += period
+    records.append((t + 1.0, zone_pin, False))
+    for (t, name, value) in records:
+        trace.pin(name, value, t)
+    trace.close()
+    return len(records)
+
+
+def _speed(args):
+    if "--speed" not in args:
+        return None
+    value = args[args.index("--speed") + 1]
+    return None if value == "max" else float(value)
+
+def _option(args, name, default):
+    return type(default)(args[args.index(name) + 1]) if name in args else default
+
+def main(args):
+    if len(args) < 2:
+        print(__doc__)
+        return 2
+    (command, path) = args[:2]
+    if command == "synth-flow":
+        n = synth_flow(path, _option(args, "--gpm", 30.0), _option(args, "--minutes", 5))
+        print("%d pin changes written to %s" % (n, path))
+        return 0
+    reader = TraceReader(path)
+    if command == "info":
+        counts = {}
+        for (t, kind, value) in reader.records:
+            counts[KIND_NAMES[kind]] = counts.get(KIND_NAMES[kind], 0) + 1
+        print("%s (%s), %s, %.1f s, %s" % (reader.host, reader.node_type,
+              time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(reader.start_time)), reader.duration(), counts))
+        return 0
+    replays = { 'flow' : replay_flow, 'vi' : replay_vi, 'messages' : replay_messages }
+    (report, failures) = replays[command](reader, _speed(args))
+    for line in report:
+        print(line)
+    for line in failures:
+        print("FAILED:", line)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,142 @@
+"""
+
+On-node decimation and event capture for oversampled voltage/current.
+
+viThread can read the ADC at hundreds of Hz into preallocated blocks of
+raw ADC codes. Each block is reduced as soon as it is full:
+
+1. MinuteStats accumulates count, sum, sum of squares, min and max so that
+   the per-minute mean/min/max/RMS can be produced without keeping the
+   samples.
+2. EventTrigger watches for supply dips or overcurrent and captures a
+   pre-event and post-event window of samples around the first sample
+   that crossed the threshold.
+
+Block reductions use numpy when it is installed and fall back to the
+builtin sum/min/max over the array otherwise. All buffers are allocated
+once, so memory and log volume stay flat regardless of sample rate.
+
+"""
+
+import math
+import operator
+from array import array
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def block_stats(buf, n):
+    # (sum, sum of squares, min, max) of the first n codes in buf
+    if np is not None:
+        a = np.frombuffer(buf, dtype=np.uint32, count=n).astype(np.float64)
+        return (float(a.sum()), float(np.dot(a, a)), int(a.min()), int(a.max()))
+    mv = memoryview(buf)[:n]
+    return (sum(mv), sum(map(operator.mul, mv, mv)), min(mv), max(mv))
+
+
+class MinuteStats:
+    # running mean/min/max/RMS of raw codes, scaled on report
+    def __init__(self, scale):
+        self.scale = scale
+        self.reset()
+
+    def reset(self):
+        self.n     = 0
+        self.sum   = 0.0
+        self.sumsq = 0.0
+        self.min   = None
+        self.max   = None
+
+    def add_block(self, buf, n):
+        (s, ss, lo, hi) = block_stats(buf, n)
+        self.n     += n
+        self.sum   += s
+        self.sumsq += ss
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+
+    def report(self):
+        # (mean, min, max, rms) in engineering units, then reset for next interval
+        if self.n == 0:
+            return (0.0, 0.0, 0.0, 0.0)
+        k = self.scale
+        result = (k * self.sum / self.n, k * self.min, k * self.max, k * math.sqrt(self.sumsq / self.n))
+        self.reset()
+        return result
+
+
+class EventTrigger:
+    # capture windows around supply dips (vin code below dip_code) and
+    # overcurrent (cur code above over_code)
+    MAX_EVENTS = 16         # completed events kept in memory
+
+    def __init__(self, dip_code, over_code, pre, post):
+        self.dip_code  = dip_code
+        self.over_code = over_code
+        self.pre  = pre
+        self.post = post
+        self.ring_v = array('I', bytes(4 * pre))   # last pre samples of previous blocks
+        self.ring_i = array('I', bytes(4 * pre))
+        self.ring_n = 0                             # valid samples in ring
+        self.event  = None                          # event being captured
+        self.events = deque(maxlen=self.MAX_EVENTS)
+
+    def _find(self, vbuf, ibuf, n):
+        # index of first sample crossing a threshold, or -1
+        if np is not None:
+            v = np.frombuffer(vbuf, dtype=np.uint32, count=n)
+            i = np.frombuffer(ibuf, dtype=np.uint32, count=n)
+            hits = np.flatnonzero((v < self.dip_code) | (i > self.over_code))
+            return int(hits[0]) if len(hits) else -1
+        mv = memoryview(vbuf)[:n]
+        mi = memoryview(ibuf)[:n]
+        if min(mv) >= self.dip_code and max(mi) <= self.over_code:
+            return -1
+        for j in range(n):
+            if mv[j] < self.dip_code or mi[j] > self.over_code:
+                return j
+        return -1
+
+    def feed(self, vbuf, ibuf, n, t0, period):
+        # process a block of n samples, the first taken at time t0
+        # returns the completed event, if any
+        done = None
+        if self.event is not None:                  # continue post-event capture
+            k = min(n, self.post - len(self.event['post_v']))
+            self.event['post_v'].extend(vbuf[:k])
+            self.event['post_i'].extend(ibuf[:k])
+            if len(self.event['post_v']) >= self.post:
+                done = self._complete()
+        if self.event is None and done is None:
+            j = self._find(vbuf, ibuf, n)
+            if j >= 0:
+                pre_v = (self.ring_v[self.pre - self.ring_n:] + vbuf[:j])[-self.pre:]
+                pre_i = (self.ring_i[self.pre - self.ring_n:] + ibuf[:j])[-self.pre:]
+                k = min(n, j + self.post)
+                self.event = { 'time'   : t0 + j * period,
+                               'cause'  : 'dip' if vbuf[j] < self.dip_code else 'overcurrent',
+                               'pre_v'  : pre_v, 'pre_i'  : pre_i,
+                               'post_v' : vbuf[j:k], 'post_i' : ibuf[j:k] }
+                if k - j >= self.post:
+                    done = self._complete()
+        self._remember(vbuf, ibuf, n)
+        return done
+
+    def _complete(self):
+        event = self.event
+        self.event = None
+        self.events.append(event)
+        return event
+
+    def _remember(self, vbuf, ibuf, n):
+        # shift the last pre samples of this block into the ring
+        k = min(n, self.pre)
+        self.ring_v[:self.pre - k] = self.ring_v[k:]
+        self.ring_i[:self.pre - k] = self.ring_i[k:]
+        self.ring_v[self.pre - k:] = vbuf[n - k:n]
+        self.ring_i[self.pre - k:] = ibuf[n - k:n]
+        self.ring_n = min(self.pre, self.ring_n + k)